@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""Prints the build time, lookup rate and incremental insert rate of every
+coverage index for random chains of the given sizes.
+
+The insert rate is measured as during a walk: on top of a chain of the given
+size, every new interval is followed by the lookup of a batch of hashes.
+
+usage: coverage_index.py [-l lookups] [-i inserts] N[K|M]..."""
+
+import getopt
+import os
+import random
+import secrets
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    os.pardir))
+
+from n3map.tree import coverageindex
+from n3map.tree.coverageindex import ArrayIndex, coverage_indexes
+from n3map.tree.nsec3tree import NSEC3Tree
+
+# hashes looked up after every insert, about what the walker reads from a
+# prehash queue at a time
+BATCH = 64
+_HASH_MAX = 2**160 - 1
+
+
+def _random_intervals(size):
+    """Returns size disjoint intervals covering about half the hash space, in
+    random order"""
+    points = sorted(secrets.token_bytes(20) for i in range(2*size))
+    intervals = [(points[i], points[i+1]) for i in range(0, 2*size, 2)]
+    random.shuffle(intervals)
+    return intervals
+
+def _build(make_index, intervals):
+    tree = NSEC3Tree(hash_max=_HASH_MAX)
+    tree.index = make_index(tree)
+    for start, end in intervals:
+        tree.insert(start, None, end)
+    return tree
+
+def _insert_rate(tree, intervals, batches, lookup):
+    t0 = time.perf_counter()
+    for (start, end), batch in zip(intervals, batches):
+        tree.insert(start, None, end)
+        lookup(tree.index, batch)
+    return len(intervals)/(time.perf_counter() - t0)
+
+def _covers_batch(index, batch):
+    covers = index.covers
+    for i in range(0, len(batch), 20):
+        covers(batch[i:i + 20])
+
+def _covers_many_batch(index, batch):
+    index.covers_many(batch)
+
+def benchmark(sizes, lookups=100000, inserts=10000, out=sys.stdout):
+    out.write("coverage index benchmark, {:d} lookups, {:d} inserts\n".format(
+        lookups, inserts))
+    out.write("{:>10s} {:<12s} {:>10s} {:>16s} {:>16s}\n".format("records",
+        "index", "build (s)", "lookups/s", "inserts/s"))
+    indexes = [(index_name, index_type, _covers_batch) for index_name,
+            index_type in coverage_indexes.items()]
+    if coverageindex.HAS_NUMPY:
+        indexes += [('array+' + index_name,
+            (lambda tree, index_type=index_type:
+                ArrayIndex(tree, index_type(tree))),
+            _covers_many_batch)
+            for index_name, index_type in coverage_indexes.items()]
+    for size in sizes:
+        intervals = _random_intervals(size + inserts)
+        initial, added = intervals[:size], intervals[size:]
+        hashes = secrets.token_bytes(20*lookups)
+        batches = [secrets.token_bytes(20*BATCH) for i in range(inserts)]
+        for index_name, make_index, lookup in indexes:
+            t0 = time.perf_counter()
+            tree = _build(make_index, initial)
+            built = time.perf_counter() - t0
+            # the first lookup merges the intervals of an ArrayIndex
+            lookup(tree.index, hashes[:20])
+            t0 = time.perf_counter()
+            lookup(tree.index, hashes)
+            lookup_rate = lookups/(time.perf_counter() - t0)
+            insert_rate = _insert_rate(tree, added, batches, lookup)
+            out.write("{:>10d} {:<12s} {:>10.2f} {:>16.0f} {:>16.0f}\n"
+                    .format(size, index_name, built, lookup_rate,
+                        insert_rate))
+            out.flush()
+            del tree
+
+def _human_number(s):
+    units = {'K': 1000, 'M': 1000000}
+    if s[-1:].upper() in units:
+        return int(s[:-1])*units[s[-1:].upper()]
+    return int(s)
+
+def usage(argv):
+    sys.stderr.write("usage: " + os.path.basename(argv[0]) +
+            " [-l lookups] [-i inserts] N[K|M]...\n")
+    sys.exit(2)
+
+def main(argv):
+    lookups = 100000
+    inserts = 10000
+    try:
+        opts, args = getopt.gnu_getopt(argv[1:], "l:i:")
+        for opt, arg in opts:
+            if opt == '-l':
+                lookups = _human_number(arg)
+            if opt == '-i':
+                inserts = _human_number(arg)
+        sizes = [_human_number(arg) for arg in args]
+    except (getopt.GetoptError, ValueError):
+        usage(argv)
+    if len(sizes) == 0:
+        usage(argv)
+    benchmark(sizes, lookups, inserts)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""Prints the hash rate of every hashing backend, for a single process and
+for a number of processes running in parallel.
+
+This is n3map --benchmark-hash with a configurable duration.
+
+usage: hash_rate.py [-p processes] [-d seconds] ITERATIONS[:SALT] [zone]"""
+
+import getopt
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    os.pardir))
+
+from n3map import name
+from n3map import prehash
+
+
+def usage(argv):
+    sys.stderr.write("usage: " + os.path.basename(argv[0]) +
+            " [-p processes] [-d seconds] ITERATIONS[:SALT] [zone]\n" +
+            "SALT is given in hex, the zone defaults to example.com\n")
+    sys.exit(2)
+
+def main(argv):
+    processes = os.cpu_count() or 1
+    duration = 2.0
+    try:
+        opts, args = getopt.gnu_getopt(argv[1:], "p:d:")
+        for opt, arg in opts:
+            if opt == '-p':
+                processes = int(arg)
+            if opt == '-d':
+                duration = float(arg)
+    except (getopt.GetoptError, ValueError):
+        usage(argv)
+    if len(args) not in (1, 2) or processes < 1:
+        usage(argv)
+    iterations, _, salt = args[0].partition(':')
+    try:
+        iterations = int(iterations)
+        salt = bytes.fromhex(salt if salt != '-' else '')
+    except ValueError:
+        usage(argv)
+    zone = name.fqdn_from_text(args[1] if len(args) > 1 else 'example.com')
+    prehash.benchmark(zone, salt, iterations, processes, duration)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,6 @@
+#!/usr/bin/env python3
+
+import n3map.hashworker
+
+if __name__ == '__main__':
+    n3map.hashworker.main()
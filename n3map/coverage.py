@@ -0,0 +1,212 @@
+import bisect
+import struct
+import time
+
+from multiprocessing import shared_memory
+
+HAS_NUMPY = False
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:
+    pass
+
+from . import log
+from .ringbuffer import _load, _store, _fence
+
+# the walker republishes its coverage snapshot at most this often...
+SNAPSHOT_INTERVAL = 0.5
+# ...and spends at most this fraction of its time doing so
+SNAPSHOT_OVERHEAD = 0.05
+INITIAL_CAPACITY = 4096
+
+# sequence number (odd while the snapshot is being written), number of
+# intervals
+_header = struct.Struct('<QQ')
+_SEQ = 0
+_COUNT = 8
+_count = struct.Struct('<Q')
+_INTERVAL_SIZE = 40
+
+
+def _attach(shm_name):
+    try:
+        return shared_memory.SharedMemory(name=shm_name)
+    except FileNotFoundError:
+        # the walker already replaced the segment, a newer name is on its way
+        return None
+
+
+class CoverageSnapshotWriter(object):
+    """Publishes a sorted copy of the intervals of an NSEC3Chain in shared
+    memory so that the prehash processes can drop covered hashes themselves.
+
+    The snapshot is protected by a sequence lock: readers retry if the
+    sequence number was odd or changed while they were copying it. It is
+    stored and loaded with the barriers of the ring buffers."""
+
+    def __init__(self, capacity=INITIAL_CAPACITY):
+        self._shm = None
+        self._seq = 0
+        self._published_size = -1
+        self._last_publish = 0.0
+        self._publish_cost = 0.0
+        self._allocate(capacity)
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    def _allocate(self, capacity):
+        shm = shared_memory.SharedMemory(create=True,
+                size=_header.size + capacity*_INTERVAL_SIZE)
+        _header.pack_into(shm.buf, 0, self._seq, 0)
+        self._close_shm()
+        self._shm = shm
+        self._capacity = capacity
+
+    def _close_shm(self):
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+    def due(self, chain):
+        """Returns True if the chain changed and enough time has passed since
+        the last snapshot"""
+        if chain.size() == self._published_size:
+            return False
+        interval = max(SNAPSHOT_INTERVAL, self._publish_cost/SNAPSHOT_OVERHEAD)
+        return time.monotonic() - self._last_publish >= interval
+
+    def publish(self, chain):
+        """Writes a snapshot of chain.
+
+        Returns True if the snapshot had to be moved to a new, larger shared
+        memory segment. The readers must then be told the new name."""
+        t0 = time.monotonic()
+        intervals = chain.packed_intervals()
+        count = len(intervals)//_INTERVAL_SIZE
+        moved = False
+        if count > self._capacity:
+            self._allocate(max(count, 2*self._capacity))
+            moved = True
+        buf = self._shm.buf
+        self._seq += 1
+        _store(buf, _SEQ, self._seq)
+        _fence()
+        _count.pack_into(buf, _COUNT, count)
+        buf[_header.size:_header.size + len(intervals)] = intervals
+        self._seq += 1
+        _store(buf, _SEQ, self._seq)
+        self._published_size = chain.size()
+        self._last_publish = time.monotonic()
+        self._publish_cost = self._last_publish - t0
+        log.debug3("published coverage snapshot of {:d} intervals in "
+                "{:.3f}s".format(count, self._publish_cost))
+        return moved
+
+    def close(self):
+        self._close_shm()
+
+
+class CoverageSnapshotReader(object):
+    """Prehash process side of CoverageSnapshotWriter.
+
+    covers() only ever errs on the side of not covered: the snapshot may lag
+    behind the walker's chain, so the walker still checks every hash it
+    receives."""
+
+    def __init__(self, shm_name=None):
+        self._shm = None
+        self._seq = 0
+        self._starts = []
+        self._data = b''
+        # the same as arrays of 'S20', for covers_many()
+        self._start_array = None
+        self._end_array = None
+        if shm_name is not None:
+            self.attach(shm_name)
+
+    def attach(self, shm_name):
+        shm = _attach(shm_name)
+        if shm is None:
+            return
+        self.close()
+        self._shm = shm
+        self._seq = 0
+
+    def refresh(self):
+        """Copies the snapshot if the walker published a new one"""
+        if self._shm is None:
+            return
+        buf = self._shm.buf
+        while True:
+            seq = _load(buf, _SEQ)
+            if seq == self._seq:
+                return
+            if seq & 1:
+                # the walker is in the middle of an update
+                time.sleep(0)
+                continue
+            count = _count.unpack_from(buf, _COUNT)[0]
+            data = bytes(buf[_header.size:_header.size + count*_INTERVAL_SIZE])
+            _fence()
+            if _load(buf, _SEQ) == seq:
+                break
+        self._seq = seq
+        self._data = data
+        self._starts = [data[i:i+20] for i in range(0, len(data),
+            _INTERVAL_SIZE)]
+        if HAS_NUMPY:
+            intervals = np.frombuffer(data, dtype='S20').reshape(-1, 2)
+            self._start_array = intervals[:, 0].copy()
+            self._end_array = intervals[:, 1].copy()
+
+    def covers(self, h):
+        starts = self._starts
+        if len(starts) == 0:
+            return False
+        i = bisect.bisect_right(starts, h) - 1
+        if i < 0:
+            # can only be covered by the last interval, if it wraps around
+            i = len(starts) - 1
+            start = starts[i]
+            end = self._data[i*_INTERVAL_SIZE + 20:(i+1)*_INTERVAL_SIZE]
+            return start >= end and h <= end
+        start = starts[i]
+        end = self._data[i*_INTERVAL_SIZE + 20:(i+1)*_INTERVAL_SIZE]
+        if start >= end:
+            return True
+        return h <= end
+
+    def covers_many(self, hashes, stride=20, offset=0):
+        """Returns the indices of the uncovered ones among the digests packed
+        into hashes, which are stride bytes apart starting at offset. Like
+        CoverageIndex.covers_many(), it needs NumPy to check them all at
+        once."""
+        if len(hashes) < offset + 20:
+            return []
+        count = (len(hashes) - offset - 20)//stride + 1
+        if not HAS_NUMPY:
+            covers = self.covers
+            return [i for i in range(count) if not covers(
+                hashes[offset + i*stride:offset + i*stride + 20])]
+        if len(self._starts) == 0:
+            return list(range(count))
+        q = np.ndarray((count,), dtype='S20', buffer=hashes, offset=offset,
+                strides=(stride,))
+        starts = self._start_array
+        ends = self._end_array
+        i = np.searchsorted(starts, q, side='right') - 1
+        # only the last interval can wrap around, and it then covers
+        # everything from its start on and up to its end
+        covered = (i >= 0) & (q <= ends[i])
+        if starts[-1] >= ends[-1]:
+            covered |= (q >= starts[-1]) | (q <= ends[-1])
+        return np.flatnonzero(~covered).tolist()
+
+    def close(self):
+        if self._shm is not None:
+            self._shm.close()
+            self._shm = None
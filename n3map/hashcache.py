@@ -0,0 +1,155 @@
+import bisect
+import mmap
+import os
+import struct
+
+from . import log
+from .exception import N3MapError
+
+# the cache stops growing at this size
+MAX_SIZE = 1 << 30
+
+_MAGIC = b'N3MAPHC2'
+# first label counter, number of hashes
+_run_header = struct.Struct('<QI')
+
+
+class HashCacheError(N3MapError):
+    pass
+
+
+def _header(zone, salt, iterations, encoding):
+    zone_wire = zone.to_wire()
+    return b''.join((_MAGIC, struct.pack('<HB', iterations, len(salt)), salt,
+        struct.pack('<B', len(zone_wire)), zone_wire,
+        struct.pack('<B', len(encoding)), encoding.encode()))
+
+def _scan_runs(buf, offset):
+    """Returns the runs in buf starting at offset as (first counter, count,
+    offset of the digests) tuples and the offset where the last complete run
+    ends"""
+    runs = []
+    end = len(buf)
+    while offset + _run_header.size <= end:
+        start, count = _run_header.unpack_from(buf, offset)
+        data = offset + _run_header.size
+        if data + count*20 > end:
+            break
+        runs.append((start, count, data))
+        offset = data + count*20
+    return runs, offset
+
+def prepare(filename, zone, salt, iterations, encoding):
+    """Opens or creates the hash cache file for zone, salt, iterations and
+    label encoding before the prehash processes use it.
+
+    A cache for different NSEC3 parameters or labels is replaced, a run which
+    was only partly written when n3map was interrupted is truncated.
+
+    Returns the number of cached hashes"""
+    header = _header(zone, salt, iterations, encoding)
+    try:
+        with open(filename, 'a+b') as f:
+            f.seek(0)
+            if f.read(len(header)) != header:
+                if os.fstat(f.fileno()).st_size > 0:
+                    log.warn("hash cache ", filename, " belongs to a ",
+                            "different zone, NSEC3 parameters or label ",
+                            "encoding, replacing it")
+                f.truncate(0)
+                f.write(header)
+                return 0
+            f.seek(0)
+            runs, end = _scan_runs(f.read(), len(header))
+            f.truncate(end)
+    except OSError as e:
+        raise HashCacheError("failed to open hash cache: ", str(e))
+    cached = sum(r[1] for r in runs)
+    log.info("hash cache ", filename, ": {:d} hashes in {:d} runs".format(
+        cached, len(runs)))
+    return cached
+
+
+class HashCache(object):
+    """A prehash process' view of a hash cache file prepared by prepare().
+
+    The file consists of a header identifying the zone, NSEC3 parameters and
+    label encoding, followed by runs of hashes for consecutive label
+    counters: a (uint64 first counter, uint32 count) header and count 20-byte
+    digests.
+    The processes append new runs, each with a single write."""
+
+    def __init__(self, filename, zone, salt, iterations, encoding,
+            num_processes):
+        self._fd = os.open(filename, os.O_RDWR | os.O_APPEND)
+        size = os.fstat(self._fd).st_size
+        header_len = len(_header(zone, salt, iterations, encoding))
+        self._mmap = None
+        self.runs = []
+        if size > header_len:
+            self._mmap = mmap.mmap(self._fd, size, access=mmap.ACCESS_READ)
+            self.runs, end = _scan_runs(self._mmap, header_len)
+        self.runs.sort()
+        self._starts = [r[0] for r in self.runs]
+        # share what is left up to MAX_SIZE with the other processes
+        self._max_append = max(0, MAX_SIZE - size)//num_processes
+
+    def _find_run(self, counter):
+        i = bisect.bisect_right(self._starts, counter) - 1
+        if i >= 0 and counter < self.runs[i][0] + self.runs[i][1]:
+            return self.runs[i]
+        return None
+
+    def uncached(self, start, count):
+        """Yields the (start, count) parts of the range which are not
+        cached"""
+        end = start + count
+        i = max(0, bisect.bisect_right(self._starts, start) - 1)
+        while start < end:
+            if i < len(self.runs) and self.runs[i][0] < end:
+                run_start, run_count, _ = self.runs[i]
+                run_end = run_start + run_count
+                if run_end <= start:
+                    i += 1
+                    continue
+                if run_start > start:
+                    yield (start, run_start - start)
+                start = run_end
+                i += 1
+            else:
+                yield (start, end - start)
+                start = end
+
+    def ranges(self, generator, process_id, num_processes):
+        """Yields this process' share of the cached runs, then the ranges of
+        generator without the cached parts"""
+        for i in range(process_id, len(self.runs), num_processes):
+            yield self.runs[i][:2]
+        for start, count in generator:
+            yield from self.uncached(start, count)
+
+    def hash_range_func(self, hash_range):
+        """Wraps hash_range such that ranges within a cached run are read
+        from the cache and other ranges are appended to it"""
+        def cached_hash_range(start, count):
+            run = self._find_run(start)
+            if run is not None and start + count <= run[0] + run[1]:
+                offset = run[2] + (start - run[0])*20
+                return self._mmap[offset:offset + count*20]
+            hashes = hash_range(start, count)
+            self._append(start, count, hashes)
+            return hashes
+        return cached_hash_range
+
+    def _append(self, start, count, hashes):
+        size = _run_header.size + len(hashes)
+        if size > self._max_append:
+            return
+        self._max_append -= size
+        os.write(self._fd, _run_header.pack(start, count) + hashes)
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        os.close(self._fd)
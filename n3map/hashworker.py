@@ -0,0 +1,337 @@
+import gc
+import getopt
+import multiprocessing
+import multiprocessing.connection
+import os
+import queue
+import secrets
+import socket
+import struct
+import sys
+import threading
+import time
+
+from . import log
+from . import name
+from . import prehash
+from .exception import N3MapError
+from .queryprovider import host_port_from_s
+
+# lanes of label counters reserved for remote workers by default, see
+# --max-hash-workers
+MAX_REMOTE_WORKERS = 64
+# label counters per range of a lane, as for the local processes
+LANE_GAP = 1024
+KEY_ENV = 'N3MAP_HASHWORKER_KEY'
+# seconds a connecting worker has to complete the handshake
+HANDSHAKE_TIMEOUT = 10.0
+# delays between attempts to accept a connection after an error, e.g. when
+# running out of file descriptors
+MIN_ACCEPT_DELAY = 0.01
+MAX_ACCEPT_DELAY = 1.0
+
+# the parameters the walker sends to a remote worker: initial label counter,
+# lane, number of lanes, iterations, label encoding and length of the salt,
+# followed by the salt and the zone in wire format. An empty message tells the
+# worker that all lanes are taken.
+_params = struct.Struct('<QIIH8sB')
+_MAX_PARAMS = _params.size + 255 + 255
+# a run of hashes sent by a remote worker: first label counter, count,
+# followed by count digests
+_run_header = struct.Struct('<QI')
+_MAX_RUN = _run_header.size + LANE_GAP*20
+
+
+def parse_address(s):
+    """Returns (address, family) for 'host:port' or the path of a Unix
+    socket"""
+    if '/' in s:
+        return s, 'AF_UNIX'
+    host, port = host_port_from_s(s)
+    return (host, port), ('AF_INET6' if ':' in host else 'AF_INET')
+
+def authkey():
+    """Returns the key shared by the walker and its remote workers. If
+    N3MAP_HASHWORKER_KEY is not set, a random one is logged."""
+    key = os.environ.get(KEY_ENV)
+    if key is None:
+        key = secrets.token_hex(16)
+        log.info("hash worker key: ", key, " (set ", KEY_ENV,
+                " to choose one)")
+    return key.encode()
+
+def _set_timeout(conn, timeout):
+    """Sets a timeout in seconds on the blocking reads and writes of conn,
+    0 for none. Connections have no timeouts of their own."""
+    timeval = struct.pack('@ll', int(timeout), int(timeout % 1 * 1000000))
+    with socket.socket(fileno=os.dup(conn.fileno())) as sock:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, timeval)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, timeval)
+
+
+class HashWorkerListener(object):
+    """Accepts connections from remote hash workers while the walker runs and
+    hands each of them a lane of label counters.
+
+    Lanes first_lane..num_lanes-1 are interleaved with the lanes of the local
+    PreHashProcesses. A lane which is freed by a worker leaving is handed to
+    the next worker to join, continuing where the previous one stopped.
+    Workers joining while all lanes are taken are refused and counted in
+    refused."""
+
+    def __init__(self, address, authkey, first_lane, num_lanes):
+        addr, family = parse_address(address)
+        try:
+            # the handshake is done by _authenticate(), so that a slow
+            # client does not hold up the others
+            self._listener = multiprocessing.connection.Listener(addr,
+                    family)
+        except OSError as e:
+            raise N3MapError("failed to listen for hash workers on ",
+                    address, ": ", str(e))
+        self._authkey = authkey
+        self.num_lanes = num_lanes
+        self.refused = 0
+        self._first_lane = first_lane
+        self._free_lanes = list(range(first_lane, num_lanes))
+        self._lane_state = {}
+        self._accepted = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._accept, daemon=True)
+        self._thread.start()
+        log.info("listening for hash workers on ", address)
+
+    def _accept(self):
+        delay = MIN_ACCEPT_DELAY
+        while not self._closed:
+            try:
+                conn = self._listener.accept()
+            except OSError as e:
+                if self._closed:
+                    return
+                if delay == MIN_ACCEPT_DELAY:
+                    log.warn("failed to accept a hash worker: ", str(e))
+                time.sleep(delay)
+                delay = min(MAX_ACCEPT_DELAY, 2*delay)
+                continue
+            delay = MIN_ACCEPT_DELAY
+            threading.Thread(target=self._authenticate, args=(conn,),
+                    daemon=True).start()
+
+    def _authenticate(self, conn):
+        """Runs the same mutual challenge as a Listener with an authkey,
+        for a single connection. A client that does not complete it within
+        HANDSHAKE_TIMEOUT seconds is dropped."""
+        try:
+            _set_timeout(conn, HANDSHAKE_TIMEOUT)
+            multiprocessing.connection.deliver_challenge(conn, self._authkey)
+            multiprocessing.connection.answer_challenge(conn, self._authkey)
+            _set_timeout(conn, 0)
+        except (OSError, EOFError, multiprocessing.AuthenticationError):
+            conn.close()
+            return
+        self._accepted.put(conn)
+
+    def _lane_init(self, lane, label_counter_init):
+        state = self._lane_state.get(lane)
+        if state is None:
+            return label_counter_init
+        # skip the ranges of the lane up to the last counter it reported
+        stride = LANE_GAP*self.num_lanes
+        first = lane*LANE_GAP + label_counter_init
+        return label_counter_init + ((state - first)//stride + 1)*stride
+
+    def join_workers(self, label_counter_init, zone, salt, iterations,
+            element_size, coverage_snapshot, encoding):
+        """Starts a RelayProcess for every worker that connected since the
+        last call.
+
+        Returns the new (HashQueue, RelayProcess) pairs"""
+        workers = []
+        while True:
+            try:
+                conn = self._accepted.get_nowait()
+            except queue.Empty:
+                return workers
+            if len(self._free_lanes) == 0:
+                self.refused += 1
+                log.warn("all {:d} lanes for hash workers are taken, "
+                        "refusing a worker (see --max-hash-workers)".format(
+                            self.num_lanes - self._first_lane))
+                try:
+                    conn.send_bytes(b'')
+                except OSError:
+                    pass
+                conn.close()
+                continue
+            lane = self._free_lanes.pop(0)
+            par, chld = multiprocessing.Pipe(True)
+            relay = RelayProcess(chld, conn, lane, self.num_lanes)
+            relay.start()
+            # the relay has its own copy
+            conn.close()
+            hash_queue = prehash.HashQueue(par)
+            ring = hash_queue.open()
+            hash_queue.send((self._lane_init(lane, label_counter_init), zone,
+                salt, iterations, 'auto', element_size, ring,
+                coverage_snapshot, encoding))
+            log.info("hash worker joined on lane {:d}".format(lane))
+            workers.append((hash_queue, relay))
+
+    def has_left(self, worker):
+        """Returns True if worker is a remote worker which disconnected and
+        whose hashes were all read"""
+        hash_queue, relay = worker
+        return (isinstance(relay, RelayProcess) and not relay.is_alive()
+                and hash_queue.available() == 0)
+
+    def leave(self, worker):
+        hash_queue, relay = worker
+        self._lane_state[relay.id] = hash_queue.ring.progress()[1]
+        self._free_lanes.append(relay.id)
+        self._free_lanes.sort()
+        hash_queue.close()
+        relay.join()
+        log.info("hash worker left lane {:d}".format(relay.id))
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._listener.close()
+
+
+class RelayProcess(prehash.PreHashProcess):
+    """The walker's side of a remote hash worker. It forwards the NSEC3
+    parameters and the worker's lane, drops the covered hashes from the runs
+    it receives and feeds the others into a ring buffer, just like a local
+    PreHashProcess."""
+
+    def __init__(self, pipe, conn, lane, num_lanes):
+        super(RelayProcess, self).__init__(pipe, None, lane, name.hex_label,
+                1, 'auto', num_lanes=num_lanes)
+        self.conn = conn
+
+    def run(self):
+        try:
+            log.logger = None
+            (label_counter_init,  self.zone, self.salt,
+                    self.iterations, self.backend,
+                    self.element_size, ring,
+                    coverage_snapshot, encoding) = self.pipe.recv()
+            self._attach(ring, coverage_snapshot)
+            self.conn.send_bytes(_params.pack(label_counter_init, self.id,
+                self.num_lanes, self.iterations, encoding.encode(),
+                len(self.salt)) + self.salt + self.zone.to_wire())
+            self._relay_hashes()
+        except (EOFError, OSError):
+            # the worker left
+            pass
+        except KeyboardInterrupt:
+            sys.exit(3)
+
+    def _relay_hashes(self):
+        conn = self.conn
+        coverage = self.coverage
+        total_tested = 0
+        while True:
+            ready = multiprocessing.connection.wait((conn, self.pipe))
+            if self.pipe in ready:
+                self._handle_control_messages()
+            if conn not in ready:
+                continue
+            data = conn.recv_bytes(_MAX_RUN)
+            if len(data) < _run_header.size:
+                return
+            start, count = _run_header.unpack_from(data)
+            if len(data) != _run_header.size + count*20:
+                # a malformed run, drop the worker
+                return
+            coverage.refresh()
+            uncovered = []
+            for i in coverage.covers_many(data, 20, _run_header.size):
+                offset = _run_header.size + i*20
+                uncovered.append((start + i, data[offset:offset + 20]))
+            total_tested += count
+            self._write_uncovered(uncovered, total_tested, start + count - 1)
+
+
+def _hash_worker(address, key, backend):
+    addr, family = parse_address(address)
+    try:
+        conn = multiprocessing.connection.Client(addr, family, authkey=key)
+        data = conn.recv_bytes(_MAX_PARAMS)
+        if len(data) == 0:
+            log.fatal("the walker refused the worker, all lanes are taken")
+        (label_counter_init, lane, num_lanes, iterations, encoding,
+                salt_length) = _params.unpack_from(data)
+        salt = data[_params.size:_params.size + salt_length]
+        zone = name.domainname_from_wire(data[_params.size + salt_length:])
+        label_fun = name.label_encodings[encoding.rstrip(b'\0').decode()]
+        if backend == 'auto':
+            backend = prehash.autotune(label_fun, zone, salt,
+                    iterations, start=label_counter_init)[0][0]
+        log.info("hashing lane {:d} of {} with backend {}".format(lane,
+            str(zone), backend))
+        hash_range = prehash.hash_backends[backend].hash_range_func(
+                label_fun, zone, salt, iterations)
+        for start, count in prehash._process_range_generator(LANE_GAP, lane,
+                num_lanes, label_counter_init):
+            conn.send_bytes(_run_header.pack(start, count) +
+                    hash_range(start, count))
+    except (EOFError, ConnectionError):
+        log.info("walker closed the connection")
+    except (struct.error, KeyError, UnicodeError,
+            name.InvalidDomainNameError):
+        log.fatal("invalid parameters received from ", address)
+    except (OSError, multiprocessing.AuthenticationError) as e:
+        log.fatal("failed to connect to ", address, ": ", str(e))
+    except KeyboardInterrupt:
+        sys.exit(3)
+
+def usage(argv):
+    sys.stderr.write("usage: " + os.path.basename(argv[0]) +
+            " [-p processes] [-b backend] [-v] address\n" +
+            "address is host:port or the path of a Unix socket, the key is" +
+            " read from " + KEY_ENV + "\n")
+    sys.exit(2)
+
+def hashworker_main(argv):
+    log.logger = log.Logger()
+    processes = os.cpu_count() or 1
+    backend = 'auto'
+    try:
+        opts, args = getopt.gnu_getopt(argv[1:], "p:b:v")
+    except getopt.GetoptError as err:
+        usage(argv)
+    for opt, arg in opts:
+        if opt == '-p':
+            try:
+                processes = int(arg)
+            except ValueError:
+                usage(argv)
+        if opt == '-b':
+            if arg != 'auto' and arg not in prehash.hash_backends:
+                usage(argv)
+            backend = arg
+        if opt == '-v':
+            log.logger.loglevel += 1
+    if len(args) != 1 or processes < 1:
+        usage(argv)
+    key = os.environ.get(KEY_ENV)
+    if key is None:
+        log.fatal(KEY_ENV, " is not set")
+    gc.collect()
+    workers = [multiprocessing.Process(target=_hash_worker,
+        args=(args[0], key.encode(), backend)) for i in range(processes)]
+    for p in workers:
+        p.start()
+    for p in workers:
+        p.join()
+    return 0
+
+def main():
+    try:
+        sys.exit(hashworker_main(sys.argv))
+    except KeyboardInterrupt:
+        sys.stderr.write("\nreceived SIGINT, terminating\n")
+        sys.exit(3)
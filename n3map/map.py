@@ -8,6 +8,7 @@ from datetime import timedelta
 
 from . import log
 from . import db
+from . import hashworker
 from . import prehash
 from . import queryprovider
 from .query import query_ns_records
@@ -15,6 +16,7 @@ from . import rrfile
 from .exception import N3MapError, FileParseError, HashLimitReached
 from .nsec3walker import NSEC3Walker
 from .predict import create_zone_predictor
+from .rrtypes.nsec3 import NSEC3List
 from .nsecwalker import NSECWalkerN, NSECWalkerMixed, NSECWalkerA
 
 import n3map.name
@@ -65,6 +67,20 @@ def _human_number(s):
             raise ValueError
     return n
 
+def _nsec3_parameters(s):
+    m = re.fullmatch(r'([0-9]+)(:([0-9a-fA-F]*|-))?', s)
+    if m is None:
+        raise ValueError
+    iterations = int(m.group(1))
+    salt = m.group(3)
+    if salt is None or salt == '-':
+        salt = b''
+    else:
+        salt = bytes.fromhex(salt)
+    if len(salt) > 255:
+        raise ValueError
+    return (iterations, salt)
+
 def check_part_of_zone(rr, zone):
     if not rr.part_of_zone(zone):
         raise N3MapError(("not all read records are part of the specified zone"))
@@ -94,13 +110,14 @@ def read_input_file(input_filename, cont, zone, zone_type):
         else:
             log.fatal("unable to open input file: \n", str(e))
     try:
-        chain = []
         if zone_type == 'nsec3':
+            chain = NSEC3List(zone)
             for rr in records_file.nsec3_reader():
                 check_part_of_zone(rr, zone)
                 chain.append(rr)
             label_counter = records_file.label_counter
         elif zone_type == 'nsec':
+            chain = []
             for rr in records_file.nsec_reader():
                 check_part_of_zone(rr, zone)
                 chain.append(rr)
@@ -127,6 +144,11 @@ def n3map_main(argv):
     except N3MapError as e:
         log.fatal_exit(2, e)
 
+    if options['benchmark_hash'] is not None:
+        iterations, salt = options['benchmark_hash']
+        prehash.benchmark(zone, salt, iterations, options['processes'])
+        return 0
+
     if options['use_db']:
         if options['db_userfile']:
             try:
@@ -166,6 +188,8 @@ def n3map_main(argv):
     walker = None
     process_pool = None
     hash_queues = None
+    hash_listener = None
+    wordlist = None
     if options['progress']:
         log.logger = log.ProgressLineLogger.from_logger(log.logger)
 
@@ -226,9 +250,20 @@ def n3map_main(argv):
                             zone_type = options['zone_type'])
 
         if options['zone_type'] == 'nsec3':
+            num_lanes = None
+            if options['hash_listen'] is not None:
+                num_lanes = (options['processes'] +
+                        options['max_hash_workers'])
+            if options['wordlist'] is not None:
+                wordlist = prehash.read_wordlist(options['wordlist'], zone)
             (hash_queues, process_pool) = prehash.create_prehash_pool(
                 options['processes'], options['queue_element_size'],
-                options['use_openssl'])
+                options['hash_backend'], options['hash_cache'], num_lanes,
+                options['hash_threads'], wordlist)
+            if options['hash_listen'] is not None:
+                hash_listener = hashworker.HashWorkerListener(
+                        options['hash_listen'], hashworker.authkey(),
+                        options['processes'], num_lanes)
             if options['predict']:
                 proc,pipe = create_zone_predictor()
                 predictor = (proc,pipe)
@@ -275,7 +310,9 @@ def n3map_main(argv):
                                  stats=stats,
                                  predictor=predictor,
                                  aggressive=options['aggressive'],
-                                 hashlimit=options['hashlimit']
+                                 hashlimit=options['hashlimit'],
+                                 hash_listener=hash_listener,
+                                 wordlist=wordlist
                                  )
 
         elif options['zone_type'] == 'nsec':
@@ -329,6 +366,7 @@ def n3map_main(argv):
                          .format( str(zone), str(elapsed)))
             finished = True
 
+        qprovider.rtt_stats()
         if output_rrfile is not None:
             output_rrfile.write_stats(stats)
             if finished and options['continue'] is not None:
@@ -374,8 +412,14 @@ def default_options():
             'predict' : False,
             'processes' : _def_num_of_processes(),
             'progress' : True,
-            'queue_element_size' : 256,
-            'use_openssl' : True,
+            'queue_element_size' : None,
+            'hash_backend' : 'auto',
+            'benchmark_hash' : None,
+            'hash_cache' : None,
+            'hash_listen' : None,
+            'max_hash_workers' : hashworker.MAX_REMOTE_WORKERS,
+            'hash_threads' : False,
+            'wordlist' : None,
             'ipproto' : '',
             'detect_only' : False,
             'use_db' : False,
@@ -425,6 +469,13 @@ def parse_arguments(argv):
             'no-prefix-labels',
             'timeout=',
             'no-openssl',
+            'hash-backend=',
+            'benchmark-hash=',
+            'hash-cache=',
+            'hash-listen=',
+            'max-hash-workers=',
+            'hash-threads',
+            'wordlist=',
             'verbose',
             'color=',
             'version',
@@ -606,7 +657,38 @@ def parse_arguments(argv):
                 invalid_argument(opt, arg)
 
         elif opt in ('--no-openssl',):
-            options['use_openssl'] = False
+            options['hash_backend'] = 'python'
+
+        elif opt in ('--hash-backend',):
+            if arg != 'auto' and arg not in prehash.hash_backends:
+                invalid_argument(opt, arg)
+            options['hash_backend'] = arg
+
+        elif opt in ('--hash-cache',):
+            options['hash_cache'] = arg
+
+        elif opt in ('--hash-listen',):
+            options['hash_listen'] = arg
+
+        elif opt in ('--max-hash-workers',):
+            try:
+                options['max_hash_workers'] = int(arg)
+            except ValueError:
+                invalid_argument(opt, arg)
+            if options['max_hash_workers'] < 1:
+                invalid_argument(opt, arg)
+
+        elif opt in ('--hash-threads',):
+            options['hash_threads'] = True
+
+        elif opt in ('--wordlist',):
+            options['wordlist'] = arg
+
+        elif opt in ('--benchmark-hash',):
+            try:
+                options['benchmark_hash'] = _nsec3_parameters(arg)
+            except ValueError:
+                invalid_argument(opt, arg)
 
         elif opt in ('-v', '--verbose'):
             log.logger.loglevel += 1
@@ -659,6 +741,9 @@ def parse_arguments(argv):
     if options['init_db'] == True and len(args) < 1:
         args = 'foo'
 
+    if options['benchmark_hash'] is not None and len(args) < 1:
+        args = ['example.com']
+
     if len(args) < 1:
         log.fatal_exit(2, 'missing arguments', "\n", "Try `",
                 str(os.path.basename(argv[0])),
@@ -756,9 +841,18 @@ NSEC3 Options:
                                records already received. Note that this option
                                might slow down the enumeration process
                                (experimental)
-      --processes=N          defines the number of pre-hashing processes.
-                               Default is 1 or the number of CPUs - 1 on
-                               multiprocessor systems ({processes:d} on this system)
+      --wordlist=FILE        also probe the names in FILE (one per line,
+                               relative to the zone) and record the owner
+                               names of the chain found among them
+      --processes=N          defines the maximum number of pre-hashing
+                               processes. Default is 1 or the number of
+                               CPUs - 1 on multiprocessor systems
+                               ({processes:d} on this system). Only as many as
+                               needed to keep up with the queries are running
+      --hash-threads         pre-hash in threads of the n3map process instead
+                               of separate processes. Starts faster; the
+                               OpenSSL-based backends hash without holding
+                               the GIL
       --hashlimit=N[K|M|G|T]
                              stop the enumeration after checking N hashes, even
                                if it is not finished. Default = 0 (unlimited).
@@ -766,14 +860,34 @@ NSEC3 Options:
 Advanced NSEC3 Options:
   Use with caution.
       --label-counter=N      set the initial label counter
-      --queue-element-size=N set the queue elment size. (default {queue_element_sz:d})
+      --queue-element-size=N set the queue elment size. (default: adapted
+                               to the zone coverage and the hash rate)
+      --hash-backend=NAME    use the hashing backend NAME: 'auto' (default) or
+                               one of {hash_backends:s}.
+                               'auto' times all backends for the zone's
+                               NSEC3 parameters and picks the fastest one
       --no-openssl           do not use OpenSSL for hashing (slower, especially
-                              at high iteration counts)
+                              at high iteration counts). Same as
+                              --hash-backend=python
+      --hash-cache=FILE      keep all computed hashes in FILE and reuse them
+                               when the zone is mapped again with the same
+                               NSEC3 parameters (up to 1 GiB)
+      --hash-listen=ADDR     accept remote hash workers (n3map-hashworker) on
+                               ADDR (host:port or the path of a Unix
+                               socket). The shared key is read from
+                               N3MAP_HASHWORKER_KEY or chosen at random
+      --max-hash-workers=N   accept up to N remote hash workers at a time
+                               (default {max_hash_workers:d}), more are refused
+      --benchmark-hash=ITERATIONS[:SALT]
+                             print the hash rate of all hashing backends for
+                               the given NSEC3 parameters (SALT in hex) and
+                               exit. The zone argument is optional.
 
 General Options:
   -q, --quiet                do not display progress information during enumeration
       --limit-rate=N{{/s|/m|/h}}
-                             limit the query rate (default = unlimited)
+                             limit the query rate (default = unlimited). Each
+                               server gets at most its share of the rate.
       --max-retries=N        limit the maximum number of retries when a DNS query
                                times out. Defaults to {max_retries:d}.
                                N=-1 means no limit.
@@ -782,7 +896,9 @@ General Options:
                                return. Defaults to {max_errors:d}.
                                N=-1 means no limit (use with extreme caution).
       --timeout=N            timeout to wait for a server response,
-                               in miliseconds (default {timeout:d})
+                               in miliseconds (default {timeout:d}). Servers
+                               which responded get a shorter timeout based
+                               on their round-trip time.
       --detection-attempts=N limit the maximum number of zone type (NSEC/NSEC3)
                                detection attempts. N=0 specifies no limit.
                                (default {detection_attempts:d})
@@ -795,10 +911,11 @@ General Options:
       -4                     Use IPv4 only.
       -6                     Use IPv6 only.
 '''.format(qmode=def_opts['query_mode'], processes=def_opts['processes'],
-        queue_element_sz=def_opts['queue_element_size'],
+        hash_backends=', '.join(prehash.hash_backends),
         timeout=def_opts['timeout'], max_retries=def_opts['max_retries'],
         max_errors=def_opts['max_errors'],
-        detection_attempts=def_opts['detection_attempts'])
+        detection_attempts=def_opts['detection_attempts'],
+        max_hash_workers=def_opts['max_hash_workers'])
     )
 
 def main():
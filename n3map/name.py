@@ -24,10 +24,24 @@ def hex_label(l):
 #def binary_label(l: int):
 #    return l.to_bytes((l.bit_length() + 7) // 8, 'big')
 
-## XXX: much slower than hex_label
-#def b32_label(l: int):
-#     return base64.b32encode(l.to_bytes((l.bit_length() + 7) // 8,
-#         'big')).rstrip(b'=')
+_b32hex_digits = b"0123456789abcdefghijklmnopqrstuv"
+
+def b32_label(l):
+    """Lowercase base32hex representation of l, without leading zeros"""
+    digits = bytearray()
+    while True:
+        digits.append(_b32hex_digits[l & 0x1f])
+        l >>= 5
+        if l == 0:
+            break
+    digits.reverse()
+    return bytes(digits)
+
+# counter label encodings, densest last
+label_encodings = {
+        'hex' : hex_label,
+        'b32' : b32_label,
+    }
 
 def label_generator(label_fun, init=0):
     l = init
@@ -1,19 +1,27 @@
 from . import log
 from . import util
 from .exception import ZoneChangedError
+from .tree import coverageindex
+from .tree.coverageindex import coverage_indexes
 from .tree.nsec3tree import NSEC3Tree, OverLapError
-from .rrtypes.nsec3 import SHA1_MAX
+from .rrtypes.nsec3 import SHA1_MAX, NSEC3List
 
 class NSEC3Chain(object):
-    def __init__(self, iterable=None, ignore_overlapping=False):
+    def __init__(self, iterable=None, ignore_overlapping=False,
+            index='radix'):
+        """index names the coverage index answering covers(), see
+        tree.coverageindex.coverage_indexes"""
         self.tree = NSEC3Tree(hash_max=SHA1_MAX)
+        self.tree.index = coverage_indexes[index](self.tree)
+        if coverageindex.HAS_NUMPY:
+            self.tree.index = coverageindex.ArrayIndex(self.tree,
+                    self.tree.index)
         self.salt = None
         self.iterations = None
         self.zone = None
         self.tree.ignore_overlapping = ignore_overlapping
         if iterable is not None:
-            for nsec3 in iterable:
-                self.insert(nsec3)
+            self.bulk_load(iterable)
 
     def _sortedvalues(self):
         values = []
@@ -50,9 +58,7 @@ class NSEC3Chain(object):
         Returns True if the record didn't already exist in the tree, False
         otherwise
         """
-        self._check_zone(nsec3)
-        self._check_salt(nsec3)
-        self._check_iterations(nsec3)
+        self._check_record(nsec3)
 
         key = nsec3.hashed_owner
         int_end = nsec3.next_hashed_owner
@@ -63,6 +69,45 @@ class NSEC3Chain(object):
                     "another NSEC3 record")
         return (not was_updated)
 
+    def bulk_load(self, nsec3_records):
+        """Inserts many records at once, e.g. those of an input file.
+
+        Sorts the records once and builds the tree in linear time, which is
+        much faster than inserting them one by one. Falls back to insert()
+        if the chain is not empty."""
+        if self.size() > 0:
+            for nsec3 in nsec3_records:
+                self.insert(nsec3)
+            return
+        if isinstance(nsec3_records, NSEC3List):
+            for nsec3 in nsec3_records.prototypes():
+                self._check_record(nsec3)
+            intervals = nsec3_records.intervals()
+        else:
+            intervals = self._checked_intervals(nsec3_records)
+        ends = {}
+        for key, next_hashed_owner in intervals:
+            int_end = ends.get(key)
+            if int_end is not None and int_end != next_hashed_owner:
+                log.warn("next hashed owner changed for existing NSEC3 "
+                        "record\n", "zone may have changed")
+            ends[key] = next_hashed_owner
+        try:
+            self.tree.bulk_load(sorted(ends.items()))
+        except OverLapError:
+            raise ZoneChangedError("NSEC3 record overlaps with " +
+                    "another NSEC3 record")
+
+    def _check_record(self, nsec3):
+        self._check_zone(nsec3)
+        self._check_salt(nsec3)
+        self._check_iterations(nsec3)
+
+    def _checked_intervals(self, nsec3_records):
+        for nsec3 in nsec3_records:
+            self._check_record(nsec3)
+            yield (nsec3.hashed_owner, nsec3.next_hashed_owner)
+
     def find_hash(self, h):
         n = self.tree.find(h)
         if n is None:
@@ -70,18 +115,90 @@ class NSEC3Chain(object):
         else:
             return n.value
 
+    def is_owner(self, nsec3_hash):
+        """Returns True if nsec3_hash is the hashed owner name or the next
+        hashed owner name of a record in the chain"""
+        n = self.tree.find_interval(nsec3_hash)
+        return n is not None and nsec3_hash in (n.key, n.int_end)
+
     def covers(self, nsec3_hash):
-        return (self.tree.find_interval(nsec3_hash) is not None)
+        return self.tree.index.covers(nsec3_hash)
+
+    def covers_many(self, hashes, stride=20, offset=0):
+        """Returns the indices of the hashes not covered by the chain.
+
+        hashes is a buffer of packed digests, stride bytes apart starting at
+        offset. Vectorized if numpy is available."""
+        return self.tree.index.covers_many(hashes, stride, offset)
+
+    def gap(self, nsec3_hash):
+        """Returns the hashed owner name of the record preceding nsec3_hash.
+        For an uncovered hash, it identifies the gap of the chain the hash
+        falls into."""
+        if self.size() == 0:
+            return None
+        n = self.tree.floor(nsec3_hash)
+        if n is None:
+            n = self.tree.maximum()
+        return n.key if n is not None else None
+
+    def memory_per_record(self):
+        """Estimates the bytes of memory taken per record by the chain and
+        its indexes"""
+        n = self.size()
+        if n == 0:
+            return 0
+        return int(self.tree.memory_per_node() +
+                self.tree.index.memory_usage()/n)
+
+    def num_gaps(self):
+        """Returns the number of uncovered gaps of the chain"""
+        return self.tree.num_gaps()
+
+    def gap_at(self, i):
+        """Returns the gap of rank i by size as (size, start, end), see
+        NSEC3Tree.gap_at()"""
+        return self.tree.gap_at(i)
+
+    def largest_gaps(self, n):
+        return self.tree.largest_gaps(n)
+
+    def gap_histogram(self):
+        """Returns the number of gaps by the bit length of their size"""
+        return self.tree.gap_histogram()
 
     def covers_zone(self):
         return (self.tree.hash_max <= self.tree.covered_distance)
 
     def coverage(self):
-        return float(self.tree.covered_distance)/float(self.tree.hash_max)
+        # int division rounds correctly, converting both sides to float
+        # first loses the uncovered remainder near full coverage
+        return self.tree.covered_distance/self.tree.hash_max
+
+    def uncovered(self):
+        """Returns the uncovered fraction of the hash space"""
+        return ((self.tree.hash_max - self.tree.covered_distance)/
+                self.tree.hash_max)
+
+    def largest_gap(self):
+        """Returns the size of the largest gap as a fraction of the hash
+        space, or 0.0 if there is none"""
+        gaps = self.tree.largest_gaps(1)
+        if len(gaps) == 0:
+            return 0.0
+        return gaps[0][0]/self.tree.hash_max
 
     def size(self):
         return self.tree.size()
 
+    def packed_intervals(self):
+        """Returns the covered intervals sorted by hashed owner name, as
+        concatenated (hashed owner, next hashed owner) pairs of 20 bytes
+        each"""
+        parts = []
+        self.tree.inorder(lambda n: parts.extend((n.key, n.int_end)))
+        return b''.join(parts)
+
     def get_list(self):
         return self._sortedvalues()
 
@@ -1,23 +1,148 @@
 #define PY_SSIZE_T_CLEAN
+/* SHA1_Transform() is deprecated, but there is no other way to get at
+ * OpenSSL's raw SHA-1 compression function */
+#define OPENSSL_SUPPRESS_DEPRECATED
 #include <Python.h>
+#include <stdint.h>
 #include <openssl/evp.h>
+#include <openssl/sha.h>
+
+#ifndef OPENSSL_NO_DEPRECATED_3_0
+#define HAVE_SHA1_TRANSFORM
+#endif
+
+/* the multi-buffer backends need GCC vector extensions and x86 function
+ * target attributes */
+#if defined(__GNUC__) && (defined(__x86_64__) || defined(__i386__))
+#define HAVE_MULTIBUFFER
+#endif
+
+/* acquire/release accesses for the ring buffers shared with the hashing
+ * processes, see ringbuffer.py */
+#if defined(__GNUC__)
+#define HAVE_ATOMICS
+#endif
+
+#define NSEC3_HASH_LENGTH 20
+#define SHA1_BLOCK_SIZE 64
+/* 0x80 terminator + 64 bit message length */
+#define SHA1_PADDING_MIN 9
+/* longest salt for which digest || salt fits into a single SHA-1 block */
+#define SINGLE_BLOCK_MAX_SALT \
+	(SHA1_BLOCK_SIZE - NSEC3_HASH_LENGTH - SHA1_PADDING_MIN)
+
+#define STORE_BE32(p, v) do { \
+	(p)[0] = ((v) >> 24) & 0xff; \
+	(p)[1] = ((v) >> 16) & 0xff; \
+	(p)[2] = ((v) >> 8) & 0xff; \
+	(p)[3] = (v) & 0xff; \
+} while (0)
+#define LOAD_BE32(p) \
+	(((uint32_t) (p)[0] << 24) | ((uint32_t) (p)[1] << 16) | \
+	 ((uint32_t) (p)[2] << 8) | (uint32_t) (p)[3])
+/* see RFC1035, section 2.3.4 "Size limits" */
+#define MAX_DOMAINNAME 255
+#define MAX_SALT 255
+/* a 64 bit counter never needs more than 16 hex digits */
+#define MAX_COUNTER_LABEL 16
+
+#define SHA1_BLOCKS(len) \
+	(((len) + SHA1_PADDING_MIN + SHA1_BLOCK_SIZE - 1) / SHA1_BLOCK_SIZE)
+/* padded dn || salt */
+#define MAX_MSG_BLOCKS SHA1_BLOCKS(MAX_DOMAINNAME + MAX_SALT)
+/* padded digest || salt */
+#define MAX_ITER_BLOCKS SHA1_BLOCKS(NSEC3_HASH_LENGTH + MAX_SALT)
+#define MAX_LANES 16
 
 struct hash_ctx {
 	int iterations;
 	Py_ssize_t salt_length;
 	const unsigned char *salt;
+#ifdef HAVE_SHA1_TRANSFORM
+	/* pre-padded digest || salt block, see hash_ctx_init() */
+	int single_block;
+	unsigned char block[SHA1_BLOCK_SIZE];
+#endif
+#ifdef HAVE_MULTIBUFFER
+	/* padded digest || salt as big-endian words, the digest words are
+	 * filled in per iteration */
+	int iter_blocks;
+	uint32_t iter_words[MAX_ITER_BLOCKS * 16];
+#endif
+};
+
+typedef unsigned char hash_msg[MAX_MSG_BLOCKS * SHA1_BLOCK_SIZE];
+
+struct hash_backend {
+	const char *name;
+	/* number of messages hashed in lockstep */
+	int lanes;
+	/* hashes lanes messages with the same number of blocks, NULL for the
+	 * scalar OpenSSL backend */
+	void (*hash_group)(const struct hash_ctx *ctx, hash_msg *msgs,
+			int nblocks, unsigned char *out);
+	int available;
 };
 
+static void hash_ctx_init(struct hash_ctx *ctx);
+
 int compute_hash(const unsigned char *dn, unsigned int dn_length,
 		struct hash_ctx *ctx, unsigned char *result,
 		unsigned int *presult_len);
+static int compute_hash_ctx(EVP_MD_CTX *mdctx, const unsigned char *dn,
+		unsigned int dn_length, struct hash_ctx *ctx,
+		unsigned char *result, unsigned int *presult_len);
+static int hash_range(const struct hash_backend *backend,
+		EVP_MD_CTX *mdctx, struct hash_ctx *ctx,
+		unsigned long long counter, Py_ssize_t count,
+		const unsigned char *zone, Py_ssize_t zone_length,
+		int label_bits, unsigned char *out);
 
 PyMODINIT_FUNC PyInit_nsec3hash(void);
 static PyObject *py_compute_hash(PyObject *self, PyObject *args);
+static PyObject *py_compute_hashes(PyObject *self, PyObject *args,
+		PyObject *kwargs);
+static PyObject *py_compute_names(PyObject *self, PyObject *args,
+		PyObject *kwargs);
+static PyObject *py_backends(PyObject *self, PyObject *args);
+#ifdef HAVE_ATOMICS
+static PyObject *py_load_acquire(PyObject *self, PyObject *args);
+static PyObject *py_store_release(PyObject *self, PyObject *args);
+static PyObject *py_fence(PyObject *self, PyObject *args);
+#endif
 
 static PyMethodDef nsec3_methods[] = {
 	{"compute_hash", py_compute_hash, METH_VARARGS,
 		"compute an NSEC3 hash"},
+	{"compute_hashes", (PyCFunction)(void(*)(void)) py_compute_hashes,
+		METH_VARARGS | METH_KEYWORDS,
+		"compute_hashes(counter_start, count, zone_wire, salt, iterations,\n"
+		"               backend=None, encoding='hex')\n\n"
+		"compute the NSEC3 hashes of the counter labels counter_start to\n"
+		"counter_start+count-1 below zone_wire. Returns the concatenated\n"
+		"digests (20*count bytes). backend defaults to the module's\n"
+		"'backend' attribute. encoding is 'hex' or 'b32' (base32hex)"},
+	{"compute_names", (PyCFunction)(void(*)(void)) py_compute_names,
+		METH_VARARGS | METH_KEYWORDS,
+		"compute_names(names_wire, salt, iterations, backend=None)\n\n"
+		"compute the NSEC3 hashes of the concatenated domain names in wire\n"
+		"format names_wire. Returns the concatenated digests in the order\n"
+		"of the names"},
+	{"backends", py_backends, METH_NOARGS,
+		"return the names of the hashing backends usable on this CPU"},
+#ifdef HAVE_ATOMICS
+	{"load_acquire", py_load_acquire, METH_VARARGS,
+		"load_acquire(buffer, offset)\n\n"
+		"read the 64 bit unsigned integer at offset of buffer with acquire\n"
+		"semantics: later reads see at least what was written before the\n"
+		"matching store_release()"},
+	{"store_release", py_store_release, METH_VARARGS,
+		"store_release(buffer, offset, value)\n\n"
+		"write the 64 bit unsigned integer value at offset of buffer with\n"
+		"release semantics: earlier writes become visible no later"},
+	{"fence", py_fence, METH_NOARGS,
+		"full memory barrier"},
+#endif
 	{NULL, NULL, 0, NULL}
 };
 
@@ -31,6 +156,441 @@ static struct PyModuleDef nsec3hash_module = {
 
 static PyObject *nsec3hash_error;
 
+/* All iterations after the first one hash digest || salt. If the salt is short
+ * enough, this always is a single SHA-1 block with fixed padding, so we only
+ * need to build it once and can then skip the generic EVP machinery */
+static void hash_ctx_init(struct hash_ctx *ctx)
+{
+	unsigned char msg[MAX_ITER_BLOCKS * SHA1_BLOCK_SIZE];
+	Py_ssize_t length = NSEC3_HASH_LENGTH + ctx->salt_length;
+	int nblocks = SHA1_BLOCKS(length);
+	unsigned long long bits = (unsigned long long) length * 8;
+	int i;
+
+	memset(msg, 0, sizeof(msg));
+	memcpy(msg + NSEC3_HASH_LENGTH, ctx->salt, ctx->salt_length);
+	msg[length] = 0x80;
+	for (i = 0; i < 8; i++)
+		msg[nblocks * SHA1_BLOCK_SIZE - 1 - i] = (bits >> (8 * i)) & 0xff;
+
+#ifdef HAVE_SHA1_TRANSFORM
+	ctx->single_block = (ctx->salt_length <= SINGLE_BLOCK_MAX_SALT);
+	if (ctx->single_block)
+		memcpy(ctx->block, msg, SHA1_BLOCK_SIZE);
+#endif
+#ifdef HAVE_MULTIBUFFER
+	ctx->iter_blocks = nblocks;
+	for (i = 0; i < nblocks * 16; i++)
+		ctx->iter_words[i] = LOAD_BE32(msg + 4 * i);
+#endif
+}
+
+#ifdef HAVE_SHA1_TRANSFORM
+static void iterate_single_block(struct hash_ctx *ctx, unsigned char *result)
+{
+	SHA_CTX sha;
+	int i;
+
+	for (i = 0; i < ctx->iterations; i++) {
+		memcpy(ctx->block, result, NSEC3_HASH_LENGTH);
+		sha.h0 = 0x67452301UL;
+		sha.h1 = 0xefcdab89UL;
+		sha.h2 = 0x98badcfeUL;
+		sha.h3 = 0x10325476UL;
+		sha.h4 = 0xc3d2e1f0UL;
+		SHA1_Transform(&sha, ctx->block);
+		STORE_BE32(result, sha.h0);
+		STORE_BE32(result + 4, sha.h1);
+		STORE_BE32(result + 8, sha.h2);
+		STORE_BE32(result + 12, sha.h3);
+		STORE_BE32(result + 16, sha.h4);
+	}
+}
+#endif
+
+static int compute_hash_ctx(EVP_MD_CTX *mdctx, const unsigned char *dn,
+		unsigned int dn_length, struct hash_ctx *ctx,
+		unsigned char *result, unsigned int *presult_len)
+{
+	int i = 0;
+
+	if (1 != EVP_DigestInit_ex(mdctx, EVP_sha1(), NULL))
+		return -1;
+	if (1 != EVP_DigestUpdate(mdctx, dn, dn_length))
+		return -1;
+	if (1 != EVP_DigestUpdate(mdctx, ctx->salt, ctx->salt_length))
+		return -1;
+	if (1 != EVP_DigestFinal_ex(mdctx, result, presult_len))
+		return -1;
+
+#ifdef HAVE_SHA1_TRANSFORM
+	if (ctx->single_block) {
+		iterate_single_block(ctx, result);
+		return 0;
+	}
+#endif
+	while (i++ < ctx->iterations) {
+		if (1 != EVP_DigestInit_ex2(mdctx, NULL, NULL))
+			return -1;
+		if (1 != EVP_DigestUpdate(mdctx, result, *presult_len))
+			return -1;
+		if (1 != EVP_DigestUpdate(mdctx, ctx->salt, ctx->salt_length))
+			return -1;
+		if (1 != EVP_DigestFinal_ex(mdctx, result, presult_len))
+			return -1;
+	}
+	return 0;
+}
+
+int compute_hash(const unsigned char *dn, unsigned int dn_length,
+		struct hash_ctx *ctx, unsigned char *result,
+		unsigned int *presult_len)
+{
+	int ret = -1;
+	EVP_MD_CTX *mdctx;
+
+	if ((mdctx = EVP_MD_CTX_new()) == NULL)
+		return -1;
+	ret = compute_hash_ctx(mdctx, dn, dn_length, ctx, result, presult_len);
+	EVP_MD_CTX_free(mdctx);
+	return ret;
+}
+
+#ifdef HAVE_MULTIBUFFER
+/*
+ * Multi-buffer SHA-1: every vector element ("lane") holds the state of a
+ * different message, so LANES independent candidates are hashed in lockstep
+ * using plain SIMD integer instructions. The same source is compiled once per
+ * instruction set; the vector width follows from the number of lanes.
+ */
+#define ROTL32(x, n) (((x) << (n)) | ((x) >> (32 - (n))))
+#define SHA1_F1(b, c, d) ((d) ^ ((b) & ((c) ^ (d))))
+#define SHA1_F2(b, c, d) ((b) ^ (c) ^ (d))
+#define SHA1_F3(b, c, d) (((b) & (c)) | ((d) & ((b) | (c))))
+
+#define SHA1_MB_ROUNDS(FROM, TO, F, K) \
+	for (i = (FROM); i < (TO); i++) { \
+		if (i >= 16) \
+			w[i & 15] = ROTL32(w[(i + 13) & 15] ^ w[(i + 8) & 15] ^ \
+					w[(i + 2) & 15] ^ w[i & 15], 1); \
+		t = ROTL32(a, 5) + F(b, c, d) + e + w[i & 15] + (K); \
+		e = d; \
+		d = c; \
+		c = ROTL32(b, 30); \
+		b = a; \
+		a = t; \
+	}
+
+#define DEFINE_MULTIBUFFER_BACKEND(NAME, LANES, TARGET) \
+typedef uint32_t NAME##_vec __attribute__((vector_size(4 * (LANES)))); \
+\
+__attribute__((target(TARGET))) \
+static void NAME##_compress(NAME##_vec *h, NAME##_vec *w) \
+{ \
+	NAME##_vec a = h[0], b = h[1], c = h[2], d = h[3], e = h[4], t; \
+	int i; \
+\
+	SHA1_MB_ROUNDS(0, 20, SHA1_F1, 0x5a827999U) \
+	SHA1_MB_ROUNDS(20, 40, SHA1_F2, 0x6ed9eba1U) \
+	SHA1_MB_ROUNDS(40, 60, SHA1_F3, 0x8f1bbcdcU) \
+	SHA1_MB_ROUNDS(60, 80, SHA1_F2, 0xca62c1d6U) \
+	h[0] += a; \
+	h[1] += b; \
+	h[2] += c; \
+	h[3] += d; \
+	h[4] += e; \
+} \
+\
+__attribute__((target(TARGET))) \
+static void NAME##_init(NAME##_vec *h) \
+{ \
+	NAME##_vec zero = {0}; \
+\
+	h[0] = zero + 0x67452301U; \
+	h[1] = zero + 0xefcdab89U; \
+	h[2] = zero + 0x98badcfeU; \
+	h[3] = zero + 0x10325476U; \
+	h[4] = zero + 0xc3d2e1f0U; \
+} \
+\
+__attribute__((target(TARGET))) \
+static void NAME##_hash_group(const struct hash_ctx *ctx, hash_msg *msgs, \
+		int nblocks, unsigned char *out) \
+{ \
+	NAME##_vec h[5], w[16], digest[5], zero = {0}; \
+	int blk, i, l, it; \
+\
+	NAME##_init(h); \
+	for (blk = 0; blk < nblocks; blk++) { \
+		for (i = 0; i < 16; i++) \
+			for (l = 0; l < (LANES); l++) \
+				w[i][l] = LOAD_BE32(msgs[l] + \
+						blk * SHA1_BLOCK_SIZE + 4 * i); \
+		NAME##_compress(h, w); \
+	} \
+	for (it = 0; it < ctx->iterations; it++) { \
+		memcpy(digest, h, sizeof(digest)); \
+		NAME##_init(h); \
+		for (blk = 0; blk < ctx->iter_blocks; blk++) { \
+			for (i = 0; i < 16; i++) \
+				w[i] = zero + ctx->iter_words[blk * 16 + i]; \
+			if (blk == 0) \
+				memcpy(w, digest, sizeof(digest)); \
+			NAME##_compress(h, w); \
+		} \
+	} \
+	for (l = 0; l < (LANES); l++) \
+		for (i = 0; i < 5; i++) \
+			STORE_BE32(out + l * NSEC3_HASH_LENGTH + 4 * i, h[i][l]); \
+}
+
+DEFINE_MULTIBUFFER_BACKEND(sse2, 4, "sse2")
+DEFINE_MULTIBUFFER_BACKEND(avx2, 8, "avx2")
+DEFINE_MULTIBUFFER_BACKEND(avx512, 16, "avx512f")
+#endif
+
+/* in order of preference */
+static struct hash_backend backends[] = {
+#ifdef HAVE_MULTIBUFFER
+	{"avx512", 16, avx512_hash_group, 0},
+	{"avx2", 8, avx2_hash_group, 0},
+	{"sse2", 4, sse2_hash_group, 0},
+#endif
+	{"openssl", 1, NULL, 1},
+	{NULL, 0, NULL, 0},
+};
+
+static const struct hash_backend *default_backend;
+
+static const struct hash_backend *find_backend(const char *name)
+{
+	struct hash_backend *b;
+
+	for (b = backends; b->name != NULL; b++) {
+		if (b->available && strcmp(b->name, name) == 0)
+			return b;
+	}
+	return NULL;
+}
+
+/* label encodings: bits per character */
+#define LABEL_HEX 4
+#define LABEL_B32 5
+
+/* writes the lowercase hex (label_bits 4) or base32hex (label_bits 5)
+ * representation of counter (without leading zeros) to buf and returns its
+ * length. Same as name.hex_label() and name.b32_label() */
+static unsigned int counter_label(unsigned long long counter, int label_bits,
+		unsigned char *buf)
+{
+	static const char digits[] = "0123456789abcdefghijklmnopqrstuv";
+	unsigned long long mask = (1ULL << label_bits) - 1;
+	unsigned char tmp[MAX_COUNTER_LABEL];
+	unsigned int n = 0, i;
+
+	do {
+		tmp[n++] = digits[counter & mask];
+		counter >>= label_bits;
+	} while (counter);
+	for (i = 0; i < n; i++)
+		buf[i] = tmp[n - 1 - i];
+	return n;
+}
+
+/* writes the wire format of <label(counter)>.zone to dn, returns its length */
+static unsigned int counter_dn(unsigned long long counter, int label_bits,
+		const unsigned char *zone, Py_ssize_t zone_length,
+		unsigned char *dn)
+{
+	unsigned int label_length = counter_label(counter, label_bits, dn + 1);
+
+	dn[0] = (unsigned char) label_length;
+	memcpy(dn + 1 + label_length, zone, zone_length);
+	return 1 + label_length + zone_length;
+}
+
+/* appends the salt and the SHA-1 padding to dn, returns the number of blocks */
+static int pad_msg(unsigned char *msg, unsigned int dn_length,
+		const struct hash_ctx *ctx)
+{
+	Py_ssize_t length = dn_length + ctx->salt_length;
+	int nblocks = SHA1_BLOCKS(length);
+	unsigned long long bits = (unsigned long long) length * 8;
+	int i;
+
+	memcpy(msg + dn_length, ctx->salt, ctx->salt_length);
+	msg[length] = 0x80;
+	memset(msg + length + 1, 0, nblocks * SHA1_BLOCK_SIZE - length - 1);
+	for (i = 0; i < 8; i++)
+		msg[nblocks * SHA1_BLOCK_SIZE - 1 - i] = (bits >> (8 * i)) & 0xff;
+	return nblocks;
+}
+
+/* hashes the n (at most backend->lanes) names in msgs, in lockstep if the
+ * backend supports it and they take the same number of blocks */
+static int hash_msgs(const struct hash_backend *backend,
+		EVP_MD_CTX *mdctx, struct hash_ctx *ctx, hash_msg *msgs,
+		const unsigned int *dn_lengths, int n, unsigned char *out)
+{
+	int nblocks[MAX_LANES];
+	unsigned char group_out[MAX_LANES * NSEC3_HASH_LENGTH];
+	unsigned int result_len;
+	int l, lanes = backend->lanes, same_length = 1;
+
+	if (backend->hash_group != NULL) {
+		for (l = 0; l < n; l++) {
+			nblocks[l] = pad_msg(msgs[l], dn_lengths[l], ctx);
+			same_length = same_length && (nblocks[l] == nblocks[0]);
+		}
+		if (same_length) {
+			/* unused lanes of the last group hash copies */
+			for (l = n; l < lanes; l++)
+				memcpy(msgs[l], msgs[0],
+						nblocks[0] * SHA1_BLOCK_SIZE);
+			backend->hash_group(ctx, msgs, nblocks[0], group_out);
+			memcpy(out, group_out, n * NSEC3_HASH_LENGTH);
+			return 0;
+		}
+	}
+	for (l = 0; l < n; l++) {
+		if (-1 == compute_hash_ctx(mdctx, msgs[l], dn_lengths[l], ctx,
+					out + l * NSEC3_HASH_LENGTH, &result_len))
+			return -1;
+	}
+	return 0;
+}
+
+static int hash_range(const struct hash_backend *backend,
+		EVP_MD_CTX *mdctx, struct hash_ctx *ctx,
+		unsigned long long counter, Py_ssize_t count,
+		const unsigned char *zone, Py_ssize_t zone_length,
+		int label_bits, unsigned char *out)
+{
+	hash_msg msgs[MAX_LANES];
+	unsigned int dn_lengths[MAX_LANES];
+	Py_ssize_t i = 0, n;
+	int l, lanes = backend->lanes;
+
+	while (i < count) {
+		n = (count - i < lanes) ? count - i : lanes;
+		for (l = 0; l < n; l++)
+			dn_lengths[l] = counter_dn(counter + l, label_bits,
+					zone, zone_length, msgs[l]);
+		if (-1 == hash_msgs(backend, mdctx, ctx, msgs, dn_lengths, n,
+					out + i * NSEC3_HASH_LENGTH))
+			return -1;
+		i += n;
+		counter += n;
+	}
+	return 0;
+}
+
+/* returns the length of the uncompressed domain name in wire format at the
+ * start of buf, -1 if it is truncated, compressed or too long */
+static Py_ssize_t wire_name_length(const unsigned char *buf,
+		Py_ssize_t length)
+{
+	Py_ssize_t i = 0;
+
+	while (i < length && i < MAX_DOMAINNAME) {
+		if (buf[i] == 0)
+			return i + 1;
+		if (buf[i] > 63)
+			return -1;
+		i += buf[i] + 1;
+	}
+	return -1;
+}
+
+/* hashes count names in wire format, concatenated in names, which were
+ * checked with wire_name_length() */
+static int hash_names(const struct hash_backend *backend,
+		EVP_MD_CTX *mdctx, struct hash_ctx *ctx,
+		const unsigned char *names, Py_ssize_t names_length,
+		Py_ssize_t count, unsigned char *out)
+{
+	hash_msg msgs[MAX_LANES];
+	unsigned int dn_lengths[MAX_LANES];
+	const unsigned char *end = names + names_length;
+	Py_ssize_t i = 0, n;
+	int l, lanes = backend->lanes;
+
+	while (i < count) {
+		n = (count - i < lanes) ? count - i : lanes;
+		for (l = 0; l < n; l++) {
+			dn_lengths[l] = wire_name_length(names, end - names);
+			memcpy(msgs[l], names, dn_lengths[l]);
+			names += dn_lengths[l];
+		}
+		if (-1 == hash_msgs(backend, mdctx, ctx, msgs, dn_lengths, n,
+					out + i * NSEC3_HASH_LENGTH))
+			return -1;
+		i += n;
+	}
+	return 0;
+}
+
+#ifdef HAVE_MULTIBUFFER
+/* known-answer check of a multi-buffer backend against the OpenSSL one */
+static int selftest_backend(const struct hash_backend *backend)
+{
+	static const unsigned char zone[] =
+		"\x07" "example" "\x03" "com" "\x00";
+	static const unsigned char long_zone[] =
+		"\x3f" "0123456789012345678901234567890123456789012345678901234567890ab"
+		"\x3f" "0123456789012345678901234567890123456789012345678901234567890ab"
+		"\x07" "example" "\x00";
+	unsigned char salt[40];
+	unsigned char expected[40 * NSEC3_HASH_LENGTH];
+	unsigned char result[40 * NSEC3_HASH_LENGTH];
+	const struct hash_backend *reference = find_backend("openssl");
+	struct hash_ctx ctx;
+	EVP_MD_CTX *mdctx;
+	int i, ok = 1;
+
+	for (i = 0; i < (int) sizeof(salt); i++)
+		salt[i] = i * 7;
+	if ((mdctx = EVP_MD_CTX_new()) == NULL)
+		return 0;
+	for (i = 0; i < 2 && ok; i++) {
+		/* single-block iterations, then a salt that needs two blocks */
+		ctx.salt = salt;
+		ctx.salt_length = i ? sizeof(salt) : 8;
+		ctx.iterations = i ? 2 : 3;
+		hash_ctx_init(&ctx);
+		/* crosses a change in label length */
+		ok = (hash_range(reference, mdctx, &ctx, 0xffe0, 40,
+				i ? long_zone : zone,
+				i ? sizeof(long_zone) - 1 : sizeof(zone) - 1,
+				LABEL_HEX + i, expected) == 0 &&
+			hash_range(backend, mdctx, &ctx, 0xffe0, 40,
+				i ? long_zone : zone,
+				i ? sizeof(long_zone) - 1 : sizeof(zone) - 1,
+				LABEL_HEX + i, result) == 0 &&
+			memcmp(expected, result, sizeof(result)) == 0);
+	}
+	EVP_MD_CTX_free(mdctx);
+	return ok;
+}
+
+static void detect_backends(void)
+{
+	struct hash_backend *b;
+
+	__builtin_cpu_init();
+	for (b = backends; b->name != NULL; b++) {
+		if (strcmp(b->name, "avx512") == 0)
+			b->available = __builtin_cpu_supports("avx512f");
+		else if (strcmp(b->name, "avx2") == 0)
+			b->available = __builtin_cpu_supports("avx2");
+		else if (strcmp(b->name, "sse2") == 0)
+			b->available = __builtin_cpu_supports("sse2");
+		if (b->available && b->hash_group != NULL)
+			b->available = selftest_backend(b);
+	}
+}
+#endif
+
 PyMODINIT_FUNC PyInit_nsec3hash(void)
 {
 	PyObject *m;
@@ -38,6 +598,10 @@ PyMODINIT_FUNC PyInit_nsec3hash(void)
 	if (m == NULL) {
 		return NULL;
 	}
+#ifdef Py_GIL_DISABLED
+	/* the backends only share state which is set up here */
+	PyUnstable_Module_SetGIL(m, Py_MOD_GIL_NOT_USED);
+#endif
 
 	nsec3hash_error = PyErr_NewException("nsec3hash.error", NULL, NULL);
 	Py_XINCREF(nsec3hash_error);
@@ -48,46 +612,215 @@ PyMODINIT_FUNC PyInit_nsec3hash(void)
 		return NULL;
 	}
 
+#ifdef HAVE_MULTIBUFFER
+	detect_backends();
+#endif
+	for (default_backend = backends; !default_backend->available;
+			default_backend++)
+		;
+	if (PyModule_AddStringConstant(m, "backend",
+				default_backend->name) < 0) {
+		Py_DECREF(m);
+		return NULL;
+	}
+
 	return m;
 }
 
-int compute_hash(const unsigned char *dn, unsigned int dn_length,
-		struct hash_ctx *ctx, unsigned char *result,
-		unsigned int *presult_len)
+static PyObject *py_backends(PyObject *self, PyObject *args)
 {
-	int i = 0;
-	int ret = -1;
-	EVP_MD_CTX *mdctx;
+	PyObject *lst;
+	PyObject *name;
+	struct hash_backend *b;
 
-	if ((mdctx = EVP_MD_CTX_new()) == NULL)
-		goto allocerror;
-	if (1 != EVP_DigestInit_ex(mdctx, EVP_sha1(), NULL))
-		goto error;
-	if (1 != EVP_DigestUpdate(mdctx, dn, dn_length))
-		goto error;
-	if (1 != EVP_DigestUpdate(mdctx, ctx->salt, ctx->salt_length))
-		goto error;
-	if (1 != EVP_DigestFinal_ex(mdctx, result, presult_len))
-		goto error;
+	if ((lst = PyList_New(0)) == NULL)
+		return NULL;
+	for (b = backends; b->name != NULL; b++) {
+		if (!b->available)
+			continue;
+		if ((name = PyUnicode_FromString(b->name)) == NULL ||
+				PyList_Append(lst, name) < 0) {
+			Py_XDECREF(name);
+			Py_DECREF(lst);
+			return NULL;
+		}
+		Py_DECREF(name);
+	}
+	return lst;
+}
 
-	while (i++ < ctx->iterations) {
-		if (1 != EVP_DigestInit_ex2(mdctx, NULL, NULL))
-			goto error;
-		if (1 != EVP_DigestUpdate(mdctx, result, *presult_len))
-			goto error;
-		if (1 != EVP_DigestUpdate(mdctx, ctx->salt, ctx->salt_length))
-			goto error;
-		if (1 != EVP_DigestFinal_ex(mdctx, result, presult_len))
-			goto error;
+static PyObject *py_compute_hashes(PyObject *self, PyObject *args,
+		PyObject *kwargs)
+{
+	static char *kwlist[] = {"counter_start", "count", "zone_wire", "salt",
+		"iterations", "backend", "encoding", NULL};
+	struct hash_ctx ctx;
+	PyObject *counter_obj;
+	unsigned long long counter;
+	Py_ssize_t count;
+	const unsigned char *zone;
+	Py_ssize_t zone_length;
+	const char *backend_name = NULL;
+	const struct hash_backend *backend = default_backend;
+	const char *encoding = "hex";
+	int label_bits;
+	unsigned char *out;
+	PyObject *result;
+	EVP_MD_CTX *mdctx;
+	int ok;
+
+	/* "K" would silently wrap negative and too large counters */
+	if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O!ny#y#i|zs", kwlist,
+				&PyLong_Type, &counter_obj, &count,
+				&zone, &zone_length,
+				&ctx.salt,
+				&ctx.salt_length,
+				&ctx.iterations,
+				&backend_name,
+				&encoding))
+		return NULL;
+	if (strcmp(encoding, "hex") == 0) {
+		label_bits = LABEL_HEX;
+	} else if (strcmp(encoding, "b32") == 0) {
+		label_bits = LABEL_B32;
+	} else {
+		PyErr_Format(PyExc_ValueError, "unknown label encoding: %s",
+				encoding);
+		return NULL;
+	}
+	counter = PyLong_AsUnsignedLongLong(counter_obj);
+	if (counter == (unsigned long long) -1 && PyErr_Occurred()) {
+		if (!PyErr_ExceptionMatches(PyExc_OverflowError))
+			return NULL;
+		PyErr_Clear();
+		PyErr_SetString(PyExc_ValueError,
+				"counter_start must be in [0, 2**64)");
+		return NULL;
 	}
+	if (count < 0) {
+		PyErr_SetString(PyExc_ValueError, "count must not be negative");
+		return NULL;
+	}
+	if (count > PY_SSIZE_T_MAX / NSEC3_HASH_LENGTH ||
+			(count > 0 && counter > ULLONG_MAX -
+			 (unsigned long long) (count - 1))) {
+		PyErr_SetString(PyExc_ValueError, "count too large");
+		return NULL;
+	}
+	if (ctx.iterations < 0) {
+		PyErr_SetString(PyExc_ValueError,
+				"iterations must not be negative");
+		return NULL;
+	}
+	if (zone_length + 1 + MAX_COUNTER_LABEL > MAX_DOMAINNAME) {
+		PyErr_SetString(PyExc_ValueError, "zone name too long");
+		return NULL;
+	}
+	if (ctx.salt_length > MAX_SALT) {
+		PyErr_SetString(PyExc_ValueError, "salt too long");
+		return NULL;
+	}
+	if (backend_name != NULL &&
+			(backend = find_backend(backend_name)) == NULL) {
+		PyErr_Format(PyExc_ValueError, "unknown or unsupported backend: %s",
+				backend_name);
+		return NULL;
+	}
+	hash_ctx_init(&ctx);
 
-	ret = 0;
+	result = PyBytes_FromStringAndSize(NULL, count * NSEC3_HASH_LENGTH);
+	if (result == NULL)
+		return NULL;
+	out = (unsigned char *) PyBytes_AS_STRING(result);
 
-error:
+	if ((mdctx = EVP_MD_CTX_new()) == NULL) {
+		Py_DECREF(result);
+		return PyErr_NoMemory();
+	}
+	/* zone and salt are read-only buffers which the arguments keep alive,
+	 * so other threads may run meanwhile */
+	Py_BEGIN_ALLOW_THREADS
+	ok = hash_range(backend, mdctx, &ctx, counter, count, zone,
+			zone_length, label_bits, out);
+	Py_END_ALLOW_THREADS
+	if (-1 == ok) {
+		EVP_MD_CTX_free(mdctx);
+		Py_DECREF(result);
+		PyErr_SetString(nsec3hash_error, "compute_hashes() failed");
+		return NULL;
+	}
 	EVP_MD_CTX_free(mdctx);
-allocerror:
-	return ret;
+	return result;
+}
+
+static PyObject *py_compute_names(PyObject *self, PyObject *args,
+		PyObject *kwargs)
+{
+	static char *kwlist[] = {"names_wire", "salt", "iterations", "backend",
+		NULL};
+	struct hash_ctx ctx;
+	const unsigned char *names;
+	Py_ssize_t names_length, i, length, count = 0;
+	const char *backend_name = NULL;
+	const struct hash_backend *backend = default_backend;
+	unsigned char *out;
+	PyObject *result;
+	EVP_MD_CTX *mdctx;
+	int ok;
+
+	if (!PyArg_ParseTupleAndKeywords(args, kwargs, "y#y#i|z", kwlist,
+				&names, &names_length,
+				&ctx.salt,
+				&ctx.salt_length,
+				&ctx.iterations,
+				&backend_name))
+		return NULL;
+	for (i = 0; i < names_length; i += length) {
+		length = wire_name_length(names + i, names_length - i);
+		if (length == -1) {
+			PyErr_SetString(PyExc_ValueError,
+					"invalid domain name in wire format");
+			return NULL;
+		}
+		count++;
+	}
+	if (ctx.salt_length > MAX_SALT) {
+		PyErr_SetString(PyExc_ValueError, "salt too long");
+		return NULL;
+	}
+	if (ctx.iterations < 0) {
+		PyErr_SetString(PyExc_ValueError,
+				"iterations must not be negative");
+		return NULL;
+	}
+	if (backend_name != NULL &&
+			(backend = find_backend(backend_name)) == NULL) {
+		PyErr_Format(PyExc_ValueError, "unknown or unsupported backend: %s",
+				backend_name);
+		return NULL;
+	}
+	hash_ctx_init(&ctx);
 
+	result = PyBytes_FromStringAndSize(NULL, count * NSEC3_HASH_LENGTH);
+	if (result == NULL)
+		return NULL;
+	out = (unsigned char *) PyBytes_AS_STRING(result);
+
+	if ((mdctx = EVP_MD_CTX_new()) == NULL) {
+		Py_DECREF(result);
+		return PyErr_NoMemory();
+	}
+	Py_BEGIN_ALLOW_THREADS
+	ok = hash_names(backend, mdctx, &ctx, names, names_length, count, out);
+	Py_END_ALLOW_THREADS
+	if (-1 == ok) {
+		EVP_MD_CTX_free(mdctx);
+		Py_DECREF(result);
+		PyErr_SetString(nsec3hash_error, "compute_names() failed");
+		return NULL;
+	}
+	EVP_MD_CTX_free(mdctx);
+	return result;
 }
 
 static PyObject *py_compute_hash(PyObject *self, PyObject *args)
@@ -105,9 +838,81 @@ static PyObject *py_compute_hash(PyObject *self, PyObject *args)
 				&ctx.salt_length,
 				&ctx.iterations))
 		return NULL;
+	if (ctx.salt_length > MAX_SALT) {
+		PyErr_SetString(PyExc_ValueError, "salt too long");
+		return NULL;
+	}
+	if (ctx.iterations < 0) {
+		PyErr_SetString(PyExc_ValueError,
+				"iterations must not be negative");
+		return NULL;
+	}
+	hash_ctx_init(&ctx);
 	if (-1 == compute_hash(dn, dn_length, &ctx, result, &result_len)) {
 		PyErr_SetString(nsec3hash_error, "compute_hash() failed");
 		return NULL;
 	}
 	return Py_BuildValue("y#", result, result_len);
 }
+
+#ifdef HAVE_ATOMICS
+/* returns the aligned 64 bit word at offset of buffer, NULL on error */
+static uint64_t *atomic_word(Py_buffer *buffer, Py_ssize_t offset)
+{
+	if (offset < 0 || offset % sizeof(uint64_t) != 0 ||
+			offset + (Py_ssize_t) sizeof(uint64_t) > buffer->len ||
+			((uintptr_t) buffer->buf) % sizeof(uint64_t) != 0) {
+		PyErr_SetString(PyExc_ValueError,
+				"offset out of range or unaligned");
+		return NULL;
+	}
+	return (uint64_t *) ((char *) buffer->buf + offset);
+}
+
+static PyObject *py_load_acquire(PyObject *self, PyObject *args)
+{
+	Py_buffer buffer;
+	Py_ssize_t offset;
+	uint64_t *word;
+	uint64_t value;
+
+	if (!PyArg_ParseTuple(args, "w*n", &buffer, &offset))
+		return NULL;
+	if ((word = atomic_word(&buffer, offset)) == NULL) {
+		PyBuffer_Release(&buffer);
+		return NULL;
+	}
+	value = __atomic_load_n(word, __ATOMIC_ACQUIRE);
+	PyBuffer_Release(&buffer);
+	return PyLong_FromUnsignedLongLong(value);
+}
+
+static PyObject *py_store_release(PyObject *self, PyObject *args)
+{
+	Py_buffer buffer;
+	Py_ssize_t offset;
+	PyObject *value_obj;
+	unsigned long long value;
+	uint64_t *word;
+
+	if (!PyArg_ParseTuple(args, "w*nO!", &buffer, &offset, &PyLong_Type,
+				&value_obj))
+		return NULL;
+	/* raises OverflowError for negative or too large values */
+	value = PyLong_AsUnsignedLongLong(value_obj);
+	if (PyErr_Occurred() ||
+			(word = atomic_word(&buffer, offset)) == NULL) {
+		PyBuffer_Release(&buffer);
+		return NULL;
+	}
+	__atomic_store_n(word, (uint64_t) value, __ATOMIC_RELEASE);
+	PyBuffer_Release(&buffer);
+	Py_RETURN_NONE;
+}
+
+static PyObject *py_fence(PyObject *self, PyObject *args)
+{
+	__atomic_thread_fence(__ATOMIC_SEQ_CST);
+	Py_RETURN_NONE;
+}
+#endif
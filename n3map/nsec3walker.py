@@ -1,27 +1,55 @@
-import itertools
+import collections
+import os
 import secrets
+import time
 
 from . import log
 from . import name
 from . import prehash
+from . import ringbuffer
 from . import util
 from . import walker
 
+from .coverage import CoverageSnapshotWriter
 from .queryprovider import create_aggressive_qp
 
 from .statusline import format_statusline_nsec3
 
 from .exception import N3MapError, NSEC3WalkError, HashLimitReached
 from .nsec3chain import NSEC3Chain
+from .rrtypes.nsec3 import SHA1_MAX
+
+# in aggressive mode, up to this many candidates per parallel query are put
+# aside while their gap is being resolved by another query
+DEFERRED_PER_QUERY = 4
+# how often to check for remote hash workers joining or leaving
+HASH_WORKER_INTERVAL = 0.5
+# the number of local hashing workers is adapted every SCALE_INTERVAL: it is
+# doubled if the walker waited for hashes for more than STARVED_FRACTION of
+# the interval and decreased by one if the workers buffered more candidates
+# than the walker used in BACKLOG_INTERVALS intervals
+SCALE_INTERVAL = 0.5
+STARVED_FRACTION = 0.05
+BACKLOG_INTERVALS = 4
 
 
 class NSEC3Walker(walker.Walker):
     def __init__(self, zone, queryprovider, hash_queues, prehash_pool,
             nsec3_records, ignore_overlapping=False, label_counter=None,
             output_file=None, stats=None, predictor=None, aggressive=0,
-            hashlimit=0):
+            hashlimit=0, hash_listener=None, wordlist=None):
         super(NSEC3Walker, self).__init__(zone, queryprovider, output_file, stats)
         self.stats['tested_hashes'] = 0
+        self.stats['duplicate_answers'] = 0
+        # the names of the wordlist the prehash workers hashed and which were
+        # not covered yet, by hash
+        self._wordlist = wordlist
+        self._word_hashes = {}
+        self._words_pending = len(wordlist) if wordlist is not None else 0
+        # owner names of the chain found in the wordlist, by hashed owner
+        self.cracked = {}
+        if wordlist is not None:
+            self.stats['cracked_owners'] = 0
         self.hashlimit = hashlimit
 
         self._prediction_current = None
@@ -32,12 +60,17 @@ class NSEC3Walker(walker.Walker):
 
         self._write_chain(nsec3_records)
         self.nsec3_chain = NSEC3Chain(ignore_overlapping=ignore_overlapping)
+        self.nsec3_chain.bulk_load(nsec3_records)
         self._update_predictor_state()
-        for rr in nsec3_records:
-            self.nsec3_chain.insert(rr)
-            self._update_predictor_state()
 
         self._prehash_processes = prehash_pool
+        self._hash_listener = hash_listener
+        self._hash_worker_check = 0.0
+        # remote workers are appended to the pool, the local ones come first
+        self._num_local_workers = len(prehash_pool)
+        # leave a CPU to the queries and the statusline
+        self._max_active_workers = min(self._num_local_workers,
+                max(1, (os.cpu_count() or 1) - 1))
 
         if label_counter is not None:
             log.debug2("setting initial label counter to 0x{0:x}".format(
@@ -52,7 +85,10 @@ class NSEC3Walker(walker.Walker):
             self._label_counter_init = 0
 
         self._label_counter_state = 0
-        self._hash_queues = itertools.cycle(hash_queues)
+        self._label_fun = name.hex_label
+        self._coverage_snapshot = None
+        self._hash_queues = list(hash_queues)
+        self._next_hash_queue = 0
         self._reset_prehashing()
         self._aggressive = aggressive
 
@@ -61,8 +97,8 @@ class NSEC3Walker(walker.Walker):
         if len(recv_nsec3) == 0:
             if res.status() == "NOERROR":
                 # Tarpit detection
-                for record in res._result.sections[2]:
-                    if 'IN NSEC \\000' in record.to_text():
+                for nsec in res.find_NSEC():
+                    if nsec.next_owner.labels[0].label == b'\x00':
                         log.fatal("Tarpit detected by Cloudflare: https://blog.cloudflare.com/black-lies/")
                 if self.stats['queries'] == 25 and self.stats['tested_hashes'] == 0:
                         log.fatal('Did not receive any NSEC3 records after 25 queries, zone is probably not NSEC3 enabled or there is some zone walking mitigation in place')
@@ -81,6 +117,7 @@ class NSEC3Walker(walker.Walker):
                 return
         ns.reset_errors()
         if not self._insert_records(recv_nsec3):
+            self.stats['duplicate_answers'] += 1
             log.warn("did not receive any new NSEC3 records for query: ",
                      str(query_dn))
 
@@ -108,29 +145,68 @@ class NSEC3Walker(walker.Walker):
                         ' '.join(rr.types))
                 self._write_record(rr)
                 self._update_predictor_state()
+                for h in (rr.hashed_owner, rr.next_hashed_owner):
+                    if h in self._word_hashes:
+                        self._crack(h, self._word_hashes.pop(h))
         return got_new
 
     def _map_aggressive(self):
         queries = {}
+        # number of in-flight queries per gap of the chain
+        gaps = collections.Counter()
+        self._deferred = []
         max_queries = self._aggressive
         oldqp = self.queryprovider
         self.queryprovider = create_aggressive_qp(self.queryprovider,
                                                   max_queries)
         try:
+            got_results = False
             while not self.nsec3_chain.covers_zone():
                 num_queries = len(queries)
-                query_dn,dn_hash = self._find_uncovered_dn(num_queries > 0)
+                query_dn,dn_hash = self._find_aggressive_dn(gaps,
+                        got_results, num_queries > 0)
                 results = self.queryprovider.collectresponses(
                         block=(num_queries >= max_queries))
+                got_results = len(results) > 0
                 for qid, (res, ns) in results:
-                    self._process_query_result(queries.pop(qid),res, ns)
+                    query_dn_done, gap = queries.pop(qid)
+                    gaps[gap] -= 1
+                    if gaps[gap] == 0:
+                        del gaps[gap]
+                    self._process_query_result(query_dn_done, res, ns)
                 if query_dn is None or self.nsec3_chain.covers(dn_hash):
                     continue
-                queries[self.queryprovider.query_ff(query_dn, rrtype='A')] = query_dn
+                gap = self.nsec3_chain.gap(dn_hash)
+                gaps[gap] += 1
+                qid = self.queryprovider.query_ff(query_dn, rrtype='A')
+                queries[qid] = (query_dn, gap)
         finally:
             self.queryprovider.stop()
             self.queryprovider = oldqp
 
+    def _find_aggressive_dn(self, gaps, recheck, break_early):
+        """Like _find_uncovered_dn(), but prefers hashes in gaps of the chain
+        which no in-flight query is expected to resolve.
+
+        Hashes in busy gaps are put aside and retried when responses came
+        in (recheck), as the gap may have been split by then."""
+        chain = self.nsec3_chain
+        deferred = self._deferred
+        if recheck:
+            deferred[:] = [c for c in deferred if not chain.covers(c[1])]
+            for i, (query_dn, dn_hash) in enumerate(deferred):
+                if chain.gap(dn_hash) not in gaps:
+                    del deferred[i]
+                    return query_dn, dn_hash
+        while True:
+            query_dn, dn_hash = self._find_uncovered_dn(break_early)
+            if query_dn is None or chain.gap(dn_hash) not in gaps:
+                return query_dn, dn_hash
+            deferred.append((query_dn, dn_hash))
+            if len(deferred) > DEFERRED_PER_QUERY*self._aggressive:
+                # all gaps we find are busy, query the oldest candidate anyway
+                return deferred.pop(0)
+
     def _map_normal(self):
         while not self.nsec3_chain.covers_zone():
             query_dn,dn_hash = self._find_uncovered_dn()
@@ -151,6 +227,9 @@ class NSEC3Walker(walker.Walker):
             self._map_normal()
 
         self._write_number_of_records(self.nsec3_chain.size())
+        self._write_cracked()
+        self._memory_stats()
+        self._gap_stats()
         self._stop_prehashing()
         self._stop_predictor()
 
@@ -166,6 +245,9 @@ class NSEC3Walker(walker.Walker):
         except (KeyboardInterrupt, N3MapError) as e:
             if self._output_file is not None:
                 self._output_file.write_label_counter(self._label_counter_state)
+            self._write_cracked()
+            self._memory_stats()
+            self._gap_stats()
             self._stop_prehashing()
             self._stop_predictor()
             raise e
@@ -179,42 +261,212 @@ class NSEC3Walker(walker.Walker):
     def _find_uncovered_dn(self, break_early=False):
         is_covered = self.nsec3_chain.covers
         while True:
-            for ptlabel,dn_hash in self._prehash_iter:
+            for counter,dn_hash in self._prehash_iter:
+                if counter & prehash.WORD_FLAG:
+                    dn = self._word_candidate(counter & ~prehash.WORD_FLAG,
+                            dn_hash)
+                    if dn is not None:
+                        return dn,dn_hash
+                    continue
                 if not is_covered(dn_hash):
-                    dn = name.DomainName(name.Label(ptlabel), *self.zone.labels)
+                    dn = name.DomainName(name.Label(self._label_fun(counter)),
+                            *self.zone.labels)
                     owner_b32 = util.base32_ext_hex_encode( dn_hash).lower()
                     hashed_dn = name.DomainName( name.Label(owner_b32), *self.zone.labels)
                     log.debug3('found uncovered dn: ', str(dn), '; hashed: ', str(hashed_dn))
                     return dn,dn_hash
 
-            self.stats['tested_hashes'] += len(self._prehash_list)
-            if (self.hashlimit > 0 and
-                    self.stats['tested_hashes'] >= self.hashlimit):
-                raise HashLimitReached
-            hashes, label_counter_state = next(self._hash_queues).recv()
-            if self._label_counter_state < label_counter_state:
-                self._label_counter_state = label_counter_state
-            self._prehash_list = hashes
-            self._prehash_iter = iter(hashes)
+            self._publish_coverage()
+            self._prehash_iter = self._next_hashes()
             log.update()
             if break_early:
                 return None,None
 
+    def _word_candidate(self, index, dn_hash):
+        """Returns the wordlist entry if it is worth a query"""
+        dn = self._wordlist[index]
+        self._words_pending -= 1
+        if self.nsec3_chain.is_owner(dn_hash):
+            self._crack(dn_hash, dn)
+            return None
+        # cracked when a record with this hashed owner shows up
+        self._word_hashes[dn_hash] = dn
+        if self.nsec3_chain.covers(dn_hash):
+            return None
+        log.debug3('probing wordlist name: ', str(dn))
+        return dn
+
+    def _crack(self, hashed_owner, dn):
+        self.cracked[hashed_owner] = dn
+        self.stats['cracked_owners'] = len(self.cracked)
+        log.info("cracked hashed owner name ",
+                util.base32_ext_hex_encode(hashed_owner).lower().decode(),
+                ": ", str(dn))
+
+    def _memory_stats(self):
+        self.stats['memory_per_record'] = self.nsec3_chain.memory_per_record()
+
+    def _gap_stats(self):
+        """Describes the uncovered part of the hash space in the stats"""
+        chain = self.nsec3_chain
+        n = chain.num_gaps()
+        self.stats['uncovered_gaps'] = n
+        if n == 0:
+            return
+        self.stats['largest_gap'] = "{:.3g}".format(chain.largest_gap())
+        self.stats['median_gap'] = "{:.3g}".format(
+                chain.gap_at(n//2)[0]/SHA1_MAX)
+        for bits, count in sorted(chain.gap_histogram().items()):
+            log.debug1("gaps of 2^{:d} to 2^{:d} hashes: {:d}".format(bits - 1,
+                bits, count))
+
+    def _write_cracked(self):
+        if self._output_file is not None and len(self.cracked) > 0:
+            self._output_file.write_cracked(self.cracked)
+
+    def _next_hashes(self):
+        """Waits until any of the prehash processes has hashes available"""
+        delay = ringbuffer.MIN_DELAY
+        while True:
+            self._update_hash_workers()
+            hash_queues = self._hash_queues
+            for i in range(len(hash_queues)):
+                queue = hash_queues[self._next_hash_queue % len(hash_queues)]
+                self._next_hash_queue += 1
+                tested, label_counter_state = queue.progress()
+                self.stats['tested_hashes'] += tested
+                if self._label_counter_state < label_counter_state:
+                    self._label_counter_state = label_counter_state
+                if (self.hashlimit > 0 and
+                        self.stats['tested_hashes'] >= self.hashlimit):
+                    raise HashLimitReached
+                available = queue.available()
+                if available > 0:
+                    self._candidates_read += available
+                    self._scale_workers()
+                    if self._words_pending > 0:
+                        # the word slots must not be filtered by coverage
+                        return queue.read()
+                    return queue.read_uncovered(self.nsec3_chain.covers_many)
+            time.sleep(delay)
+            self._hash_wait += delay
+            delay = ringbuffer.backoff(delay)
+            self._scale_workers()
+            log.update()
+
+    def _scale_workers(self):
+        """Runs as many local workers as needed to keep up with the queries,
+        up to _max_active_workers"""
+        now = time.monotonic()
+        elapsed = now - self._scale_start
+        if elapsed < SCALE_INTERVAL:
+            return
+        local_workers = self._prehash_processes[:self._num_local_workers]
+        active = self._active_workers
+        if self._hash_wait > STARVED_FRACTION*elapsed:
+            active = min(2*active, self._max_active_workers)
+        elif self._hash_wait == 0.0:
+            buffered = sum(q.available() for q, p in local_workers)
+            if buffered > BACKLOG_INTERVALS*self._candidates_read:
+                active = max(1, active - 1)
+        if active != self._active_workers:
+            log.debug2("changing number of hashing workers to {:d}".format(
+                active))
+            prehash.set_active_workers(local_workers, active)
+            self._active_workers = active
+            self.stats['hash_workers'] = active
+        self._scale_start = now
+        self._hash_wait = 0.0
+        self._candidates_read = 0
+
+
+    def _update_hash_workers(self):
+        listener = self._hash_listener
+        now = time.monotonic()
+        if listener is None or now < self._hash_worker_check:
+            return
+        self._hash_worker_check = now + HASH_WORKER_INTERVAL
+        for worker in listener.join_workers(self._label_counter_init,
+                self.zone, self.nsec3_chain.salt, self.nsec3_chain.iterations,
+                self.stats['queue_element_size'],
+                self._coverage_snapshot.name, self.stats['label_encoding']):
+            self._prehash_processes.append(worker)
+            self._hash_queues.append(worker[0])
+        if listener.refused > 0:
+            self.stats['hash_workers_refused'] = listener.refused
+        for worker in list(self._prehash_processes):
+            if listener.has_left(worker):
+                tested, label_counter_state = worker[0].progress()
+                self.stats['tested_hashes'] += tested
+                self._prehash_processes.remove(worker)
+                self._hash_queues.remove(worker[0])
+                listener.leave(worker)
+
+    def _publish_coverage(self):
+        snapshot = self._coverage_snapshot
+        if snapshot is not None and snapshot.due(self.nsec3_chain):
+            if snapshot.publish(self.nsec3_chain):
+                prehash.attach_coverage_snapshot(self._prehash_processes,
+                        snapshot.name)
+            self._adapt_element_size()
+
+    def _element_target(self):
+        # a single queue element should keep all parallel queries busy
+        return max(prehash.ELEMENT_TARGET, self._aggressive)
+
+    def _adapt_element_size(self):
+        if self._max_element_size is None:
+            return
+        element_size = prehash.adapted_element_size(
+                self.nsec3_chain.coverage(), self._max_element_size,
+                self._element_target())
+        if element_size != self.stats['queue_element_size']:
+            log.debug2("changing queue element size to {:d}".format(
+                element_size))
+            prehash.set_element_size(self._prehash_processes, element_size)
+            self.stats['queue_element_size'] = element_size
 
     def _start_prehashing(self):
-        for pipe, proc in self._prehash_processes:
-            pipe.send((self._label_counter_init, self.zone,
-                self.nsec3_chain.salt, self.nsec3_chain.iterations))
+        encoding, blocks = prehash.choose_label_encoding(self.zone,
+                self.nsec3_chain.salt, self._label_counter_init)
+        log.info("using {} labels, hashing {:d} SHA-1 block(s) per name"
+                .format(encoding, blocks))
+        self._label_fun = name.label_encodings[encoding]
+        self.stats['label_encoding'] = encoding
+        self.stats['hash_input_blocks'] = blocks
+        self._coverage_snapshot = CoverageSnapshotWriter()
+        self._coverage_snapshot.publish(self.nsec3_chain)
+        (backend, element_size,
+                self._max_element_size) = prehash.start_prehash_pool(
+                self._prehash_processes, self._label_counter_init, self.zone,
+                self.nsec3_chain.salt, self.nsec3_chain.iterations,
+                coverage_snapshot=self._coverage_snapshot.name,
+                coverage=self.nsec3_chain.coverage(),
+                target=self._element_target(), encoding=encoding)
+        self.stats['hash_backend'] = backend
+        self.stats['queue_element_size'] = element_size
+        # start with a single worker, more are added when the walker has to
+        # wait for hashes
+        self._active_workers = 1
+        self.stats['hash_workers'] = 1
+        prehash.set_active_workers(self._prehash_processes,
+                self._active_workers)
+        self._scale_start = time.monotonic()
+        self._hash_wait = 0.0
+        self._candidates_read = 0
         self._prehash_started = True
 
     def _reset_prehashing(self):
-        self._prehash_list = []
-        self._prehash_iter = iter(self._prehash_list)
+        self._prehash_iter = iter(())
         self._prehash_started = False
 
     def _stop_prehashing(self):
-        for pipe, proc in self._prehash_processes:
-            proc.terminate()
+        if self._hash_listener is not None:
+            self._hash_listener.close()
+        prehash.stop_prehash_pool(self._prehash_processes)
+        if self._coverage_snapshot is not None:
+            self._coverage_snapshot.close()
+            self._coverage_snapshot = None
         self._reset_prehashing()
 
     def _stop_predictor(self):
@@ -223,8 +475,9 @@ class NSEC3Walker(walker.Walker):
 
     def _update_predictor_state(self):
         if self._predictor_proc is not None:
-            self._predictor_pipe.send((self.nsec3_chain.coverage(),
-                                       self.nsec3_chain.size()))
+            self._predictor_pipe.send((self.nsec3_chain.uncovered(),
+                                       self.nsec3_chain.size(),
+                                       self.nsec3_chain.num_gaps()))
             if self._predictor_pipe.poll():
                 self._prediction_current = self._predictor_pipe.recv()
 
@@ -235,6 +488,8 @@ class NSEC3Walker(walker.Walker):
                     self.nsec3_chain.size(),
                     self.stats['tested_hashes'],
                     self.nsec3_chain.coverage(),
+                    self.nsec3_chain.num_gaps(),
+                    self.nsec3_chain.largest_gap(),
                     self.queryprovider.query_rate(),
                     self._prediction_current
                 )
@@ -23,13 +23,15 @@ except ImportError:
     pass
 
 
+# x is the uncovered fraction of the hash space rather than the coverage, so
+# that it keeps its precision close to full coverage
 def np_func(p,x):
     a,b = p
-    return b - np.sqrt(np.exp(a)*(np.ones(len(x))-x))
+    return b - np.sqrt(np.exp(a)*x)
 
 def np_dfunc(p,x,y):
     a,b = p
-    return np.array([-0.5 * np.sqrt(-np.exp(a)*(x-np.ones(len(x)))),
+    return np.array([-0.5 * np.sqrt(np.exp(a)*x),
             np.ones(len(x))])
 
 def np_residuals(p,x,y):
@@ -65,6 +67,7 @@ class PredictorProcess(multiprocessing.Process):
         self.daemon = True
         self.pipe = pipe
         self._coverage_data = []
+        self._min_size = 0
 
     def run(self):
         try:
@@ -80,13 +83,15 @@ class PredictorProcess(multiprocessing.Process):
             log.logger = None
             repredict_threshold = 20
             while True:
-                cov,rec = self.pipe.recv()
-                self._coverage_data.append((cov,rec))
+                unc,rec,gaps = self.pipe.recv()
+                self._coverage_data.append((unc,rec))
                 for i in range(repredict_threshold):
                     if not self.pipe.poll():
                         break;
-                    cov,rec = self.pipe.recv()
-                    self._coverage_data.append((cov,rec))
+                    unc,rec,gaps = self.pipe.recv()
+                    self._coverage_data.append((unc,rec))
+                # every gap starts at a record that was not received yet
+                self._min_size = rec + gaps
                 size = self._predict_zone_size()
                 self.pipe.send(int(size))
         except EOFError:
@@ -107,11 +112,10 @@ class PredictorProcess(multiprocessing.Process):
         subset.append(self._coverage_data[-1])
 
         xdata,ydata = list(zip(*subset))
-        lastcov = xdata[-1]
+        lastcov = 1.0 - xdata[-1]
         if lastcov < 1e-8:
             lastcov = 1e-8
         binit = (1/lastcov*ydata[-1])
         ainit = 2.0*math.log(binit)
         a,b = compute_fit([ainit,binit],xdata,ydata)
-        current_records = self._coverage_data[-1][1]
-        return b if b >= current_records else current_records
+        return b if b >= self._min_size else self._min_size
@@ -1,12 +1,24 @@
+import abc
+import collections
 import gc
 import multiprocessing
+import multiprocessing.resource_tracker
 import os
+import queue
+import struct
 import sys
+import threading
+import time
 
+from . import hashcache
 from . import log
-from . import rrtypes
+from .coverage import CoverageSnapshotReader
+from . import ringbuffer
+from .ringbuffer import RingBuffer
+from .rrtypes import nsec3
 from . import name
 from .name import DomainName,Label
+from .exception import N3MapError
 
 
 HAS_NSEC3HASH = False
@@ -16,96 +28,649 @@ try:
 except ImportError:
     pass
 
-def _process_label_generator(label_fun, gap, process_id, num_processes, init=0):
-    start = l = int(process_id*gap+init)
-    end = start + gap
+# how long each backend is timed by autotune()
+CALIBRATION_TIME = 0.05
+# unless the user sets the queue element size, it is adapted to the coverage
+# so that an element yields about ELEMENT_TARGET uncovered candidates, but
+# computing an element should not take longer than MAX_ELEMENT_TIME
+ELEMENT_TARGET = 32
+MAX_ELEMENT_TIME = 0.1
+MIN_ELEMENT_SIZE = 16
+MAX_ELEMENT_SIZE = 65536
+# capacity of the ring buffers in candidates
+RING_SLOTS = 16384
+# how often a paused worker checks whether it was stopped
+PAUSE_POLL = 0.5
+# the label encoding is chosen for label counters up to this far beyond the
+# initial label counter
+LABEL_COUNTER_RANGE = 1 << 40
+# marks ring buffer slots holding the index of a wordlist entry instead of a
+# label counter
+WORD_FLAG = 1 << 63
+
+# ring buffer slot: label counter, hash. The walker rebuilds the label from the
+# counter for the few candidates it actually queries.
+_slot = struct.Struct('<Q20s')
+
+
+class HashBackend(abc.ABC):
+    """Computes the NSEC3 hashes of ranges of label counters."""
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+
+    def supports(self, label_fun):
+        return True
+
+    @abc.abstractmethod
+    def hash_range_func(self, label_fun, zone, salt, iterations):
+        """Returns a function hash_range(start, count) which returns the
+        concatenated hashes of the labels for counters start..start+count-1"""
+
+    @abc.abstractmethod
+    def hash_names_func(self, salt, iterations):
+        """Returns a function hash_names(names) which returns the concatenated
+        hashes of the DomainNames names"""
+
+
+class PerNameHashBackend(HashBackend):
+    def __init__(self, name, description, hash_func):
+        super(PerNameHashBackend, self).__init__(name, description)
+        self._hash_func = hash_func
+
+    def hash_range_func(self, label_fun, zone, salt, iterations):
+        hash_func = self._hash_func
+        zone_labels = zone.labels
+        def hash_range(start, count):
+            return b''.join(hash_func(DomainName(Label(label_fun(l)),
+                *zone_labels), salt, iterations)
+                for l in range(start, start + count))
+        return hash_range
+
+    def hash_names_func(self, salt, iterations):
+        hash_func = self._hash_func
+        def hash_names(names):
+            return b''.join(hash_func(dn, salt, iterations) for dn in names)
+        return hash_names
+
+
+class BatchHashBackend(HashBackend):
+    def __init__(self, name, description, cbackend):
+        super(BatchHashBackend, self).__init__(name, description)
+        self._cbackend = cbackend
+
+    def supports(self, label_fun):
+        return label_fun in _encoding_names
+
+    def hash_range_func(self, label_fun, zone, salt, iterations):
+        zone_wire = zone.to_wire()
+        cbackend = self._cbackend
+        encoding = _encoding_names[label_fun]
+        def hash_range(start, count):
+            return nsec3hash.compute_hashes(start, count, zone_wire, salt,
+                    iterations, backend=cbackend, encoding=encoding)
+        return hash_range
+
+    def hash_names_func(self, salt, iterations):
+        cbackend = self._cbackend
+        def hash_names(names):
+            return nsec3hash.compute_names(b''.join(dn.to_wire()
+                for dn in names), salt, iterations, backend=cbackend)
+        return hash_names
+
+
+_encoding_names = {label_fun: encoding for encoding, label_fun in
+        name.label_encodings.items()}
+
+
+hash_backends = collections.OrderedDict()
+
+def register_hash_backend(backend):
+    hash_backends[backend.name] = backend
+
+def _hash_openssl(dn, salt, iterations):
+    return nsec3hash.compute_hash(dn.to_wire(), salt, iterations)
+
+register_hash_backend(PerNameHashBackend('python', 'hashlib, one name at a time',
+    nsec3.compute_hash))
+if HAS_NSEC3HASH:
+    register_hash_backend(PerNameHashBackend('openssl',
+        'OpenSSL, one name at a time', _hash_openssl))
+    for cbackend in nsec3hash.backends():
+        if cbackend == 'openssl':
+            register_hash_backend(BatchHashBackend('batch',
+                'OpenSSL, batched', cbackend))
+        else:
+            register_hash_backend(BatchHashBackend(cbackend,
+                '{} multi-buffer, batched'.format(cbackend.upper()),
+                cbackend))
+
+
+def measure_hash_rate(hash_range, start=0, duration=CALIBRATION_TIME):
+    """Returns the number of hashes per second computed by hash_range"""
+    count = MIN_ELEMENT_SIZE
+    n = 0
+    t0 = time.perf_counter()
     while True:
-        if l >= end:
-            start += int(num_processes*gap)
-            end = start + gap
-            l = start
-        lblstr = label_fun(l)
-        yield (lblstr, l)
-        l += 1
-
-def create_prehash_pool(num_processes, element_size,
-        use_cext):
+        hash_range(start + n, count)
+        n += count
+        elapsed = time.perf_counter() - t0
+        if elapsed >= duration:
+            return n/elapsed
+        count *= 2
+
+def _max_element_size(hash_rate):
+    return max(MIN_ELEMENT_SIZE,
+            min(MAX_ELEMENT_SIZE, int(hash_rate*MAX_ELEMENT_TIME)))
+
+def adapted_element_size(coverage, max_element_size, target=ELEMENT_TARGET):
+    """Returns the queue element size (a power of two) which yields about
+    target uncovered hashes at the given coverage"""
+    wanted = target/max(1.0 - coverage, 1.0/max_element_size)
+    size = 1 << (int(wanted) - 1).bit_length()
+    return max(MIN_ELEMENT_SIZE, min(max_element_size, size))
+
+def sha1_blocks(length):
+    """Returns the number of 64-byte blocks SHA-1 compresses for a message of
+    length bytes"""
+    return (length + 8)//64 + 1
+
+def choose_label_encoding(zone, salt, label_counter_init=0):
+    """Picks the label encoding which keeps the first hash input of a
+    candidate (its name in wire format and the salt) within the fewest SHA-1
+    blocks, for label counters up to label_counter_init+LABEL_COUNTER_RANGE.
+    Hex labels are preferred if they need no more blocks.
+
+    Returns (encoding, number of blocks)"""
+    fixed_length = len(zone.to_wire()) + 1 + len(salt)
+    last = label_counter_init + LABEL_COUNTER_RANGE
+    best = None
+    for encoding, label_fun in name.label_encodings.items():
+        blocks = sha1_blocks(fixed_length + len(label_fun(last)))
+        if best is None or blocks < best[1]:
+            best = (encoding, blocks)
+    return best
+
+def autotune(label_fun, zone, salt, iterations, start=0, candidates=None):
+    """Times all (or the given) usable backends for the zone's actual NSEC3
+    parameters and label length.
+
+    Returns a list of (backend name, hashes per second), fastest first"""
+    if candidates is None:
+        candidates = hash_backends.keys()
+    rates = []
+    for backend_name in candidates:
+        backend = hash_backends[backend_name]
+        if not backend.supports(label_fun):
+            continue
+        hash_range = backend.hash_range_func(label_fun, zone, salt, iterations)
+        rates.append((backend_name, measure_hash_rate(hash_range, start)))
+    rates.sort(key=lambda r: r[1], reverse=True)
+    return rates
+
+
+def read_wordlist(filename, zone):
+    """Reads a wordlist of names relative to zone, one per line. Empty lines,
+    lines starting with '#' and names which are invalid below zone are
+    skipped.
+
+    Returns a list of the absolute DomainNames"""
+    words = []
+    skipped = 0
+    try:
+        with open(filename, 'r', encoding='ascii', errors='replace') as f:
+            lines = [l.strip().lower() for l in f]
+    except OSError as e:
+        raise N3MapError("failed to read wordlist: ", str(e))
+    for line in dict.fromkeys(lines):
+        if len(line) == 0 or line.startswith('#'):
+            continue
+        try:
+            words.append(DomainName(*name.domainname_from_text(
+                line.rstrip('.')).labels, *zone.labels))
+        except N3MapError:
+            skipped += 1
+    log.info("read {:d} names from wordlist {}".format(len(words), filename))
+    if skipped > 0:
+        log.warn("skipped {:d} invalid names in wordlist".format(skipped))
+    return words
+
+def _process_range_generator(gap, process_id, num_processes, init=0):
+    """Yields (start, count) ranges of label counters for process_id"""
+    start = int(process_id*gap+init)
+    while True:
+        yield (start, gap)
+        start += int(num_processes*gap)
+
+class HashQueue(object):
+    """The walker's end of a PreHashProcess.
+
+    The hashes arrive through a RingBuffer, the pipe only carries control
+    messages."""
+
+    def __init__(self, pipe):
+        self.pipe = pipe
+        self.ring = None
+        self._tested = 0
+
+    def send(self, msg):
+        self.pipe.send(msg)
+
+    def open(self):
+        """Creates the ring buffer and returns what the worker needs to
+        attach to it: its name, or the RingBuffer itself for a thread"""
+        if isinstance(self.pipe, ThreadPipe):
+            self.ring = RingBuffer(_slot.size, RING_SLOTS, shared=False)
+            return self.ring
+        self.ring = RingBuffer(_slot.size, RING_SLOTS)
+        return self.ring.name
+
+    def progress(self):
+        """Returns the number of hashes tested since the last call and the
+        process' label counter state"""
+        tested, label_counter_state = self.ring.progress()
+        new = tested - self._tested
+        self._tested = tested
+        return new, label_counter_state
+
+    def available(self):
+        return self.ring.available()
+
+    def read(self):
+        """Yields the (label counter, hash) pairs that are currently
+        available"""
+        ring = self.ring
+        buf = ring.buf
+        unpack_slot = _slot.unpack_from
+        for i in range(ring.available()):
+            record = unpack_slot(buf, ring.read_offset(0))
+            ring.release(1)
+            yield record
+
+    def read_uncovered(self, covers_many):
+        """Like read(), but filters all available pairs at once. covers_many
+        is NSEC3Chain.covers_many() or alike."""
+        ring = self.ring
+        n = ring.available()
+        data = ring.read_slots(n)
+        ring.release(n)
+        unpack_slot = _slot.unpack_from
+        for i in covers_many(data, _slot.size, _slot.size - 20):
+            yield unpack_slot(data, i*_slot.size)
+
+    def close(self):
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+
+
+def create_prehash_pool(num_processes, element_size, backend='auto',
+        hash_cache=None, num_lanes=None, threads=False, wordlist=None):
+    """element_size may be None to let start_prehash_pool() pick it.
+    hash_cache is the name of a file to cache the computed hashes in.
+
+    The names of wordlist (see read_wordlist()) are split across the
+    workers, which hash them interleaved with their label counters. A paused
+    worker still hashes its share of the list, so that the whole list gets
+    hashed early in the walk.
+
+    The label counters are split into num_lanes interleaved lanes (by default
+    one per process). Lanes beyond num_processes are left to remote
+    workers.
+
+    If threads is True, the pool consists of PreHashThreads instead of
+    processes."""
+    if backend != 'auto' and backend not in hash_backends:
+        raise N3MapError("hashing backend not available: ", backend)
+    if not threads and not ringbuffer.SHARED_SUPPORTED:
+        log.warn("cannot share memory with pre-hashing processes on this "
+                "platform, using threads instead")
+        threads = True
+    if threads:
+        worker_class, pipe = PreHashThread, thread_pipe
+    else:
+        worker_class, pipe = PreHashProcess, multiprocessing.Pipe
+        # the processes must share our resource tracker, otherwise theirs
+        # would unlink the shared memory segments they attached to when they
+        # exit
+        multiprocessing.resource_tracker.ensure_running()
     processes = []
     hash_queues = []
     for i in range(num_processes):
-        par,chld = multiprocessing.Pipe(True)
-        p = PreHashProcess(chld, element_size, i, name.hex_label,
-                num_processes, use_cext)
+        par,chld = pipe()
+        p = worker_class(chld, element_size, i, name.hex_label,
+                num_processes, backend, hash_cache, num_lanes)
+        if wordlist is not None:
+            p.wordlist = wordlist[i::num_processes]
         p.start()
-        processes.append((par,p))
-        hash_queues.append(par)
+        queue = HashQueue(par)
+        processes.append((queue,p))
+        hash_queues.append(queue)
 
     return hash_queues, processes
 
+def start_prehash_pool(prehash_pool, label_counter_init, zone, salt,
+        iterations, coverage_snapshot=None, coverage=0.0,
+        target=ELEMENT_TARGET, encoding='hex'):
+    """Resolves the pool's hashing backend and queue element size and starts
+    the precomputation.
 
-class PreHashProcess(multiprocessing.Process):
-    def __init__ (self, pipe, element_size,
-            process_id, label_fun, num_processes,  use_cext):
-        multiprocessing.Process.__init__(self)
-        # Kills this Process when parent exits
-        self.daemon = True
+    coverage_snapshot is the name of a CoverageSnapshotWriter's shared memory
+    segment. If given, the processes only send hashes which it doesn't cover.
+    encoding names the label encoding (see choose_label_encoding()).
+
+    Returns (backend name, element size, maximum element size). The maximum
+    is None if the element size was set by the user and must not be adapted
+    by set_element_size()."""
+    proc = prehash_pool[0][1]
+    backend = proc.backend
+    element_size = proc.element_size
+    max_element_size = None
+    label_fun = name.label_encodings[encoding]
+    if proc.hash_cache is not None:
+        hashcache.prepare(proc.hash_cache, zone, salt, iterations, encoding)
+    if backend == 'auto' and not HAS_NSEC3HASH:
+        log.error("failed to import nsec3hash module, ",
+                  "falling back to Python-based hashing\n",
+                  "use --no-openssl to avoid printing this error")
+        backend = 'python'
+    if backend == 'auto' or element_size is None:
+        rates = autotune(label_fun, zone, salt, iterations,
+                start=label_counter_init,
+                candidates=(None if backend == 'auto' else (backend,)))
+        for backend_name, rate in rates:
+            log.debug2("hashing backend {}: {:.0f} h/s".format(backend_name,
+                rate))
+        backend, rate = rates[0]
+        if element_size is None:
+            max_element_size = _max_element_size(rate)
+            element_size = adapted_element_size(coverage, max_element_size,
+                    target)
+        log.debug1("using hashing backend {} at {:.0f} h/s per process, "
+                "queue element size {:d}".format(backend, rate, element_size))
+    for queue, proc in prehash_pool:
+        ring = queue.open()
+        queue.send((label_counter_init, zone, salt, iterations, backend,
+            element_size, ring, coverage_snapshot, encoding))
+    return backend, element_size, max_element_size
+
+def set_element_size(prehash_pool, element_size):
+    for queue, proc in prehash_pool:
+        queue.send(('element_size', element_size))
+
+def attach_coverage_snapshot(prehash_pool, coverage_snapshot):
+    """Tells the processes that the coverage snapshot moved"""
+    for queue, proc in prehash_pool:
+        queue.send(('coverage', coverage_snapshot))
+
+def set_active_workers(prehash_pool, active):
+    """Lets the first active workers of the pool hash and pauses the
+    others"""
+    for i, (queue, proc) in enumerate(prehash_pool):
+        queue.send(('pause', i >= active))
+
+def stop_prehash_pool(prehash_pool):
+    for queue, proc in prehash_pool:
+        proc.terminate()
+        queue.close()
 
+
+def _benchmark_worker(pipe, backend, zone, salt, iterations, start, duration):
+    hash_range = hash_backends[backend].hash_range_func(name.hex_label, zone,
+            salt, iterations)
+    pipe.send(measure_hash_rate(hash_range, start, duration))
+    pipe.close()
+
+def benchmark(zone, salt, iterations, num_processes, duration=2.0,
+        out=sys.stdout):
+    """Prints the hash rate of every backend, for a single process and for
+    num_processes processes running in parallel"""
+    out.write("hashing benchmark: zone = {}, salt = {}, iterations = {:d}\n"
+            .format(str(zone), salt.hex() if len(salt) > 0 else '-',
+                iterations))
+    out.write("{:<10s} {:>16s} {:>16s}   {}\n".format("backend", "h/s per core",
+        "h/s ({:d} proc)".format(num_processes), "description"))
+    for backend_name, backend in hash_backends.items():
+        hash_range = backend.hash_range_func(name.hex_label, zone, salt,
+                iterations)
+        single = measure_hash_rate(hash_range, 0, duration)
+        pipes = []
+        procs = []
+        for i in range(num_processes):
+            par, chld = multiprocessing.Pipe(False)
+            p = multiprocessing.Process(target=_benchmark_worker,
+                    args=(chld, backend_name, zone, salt, iterations,
+                        i << 32, duration), daemon=True)
+            p.start()
+            pipes.append(par)
+            procs.append(p)
+        total = sum(pipe.recv() for pipe in pipes)
+        for p in procs:
+            p.join()
+        out.write("{:<10s} {:>16.0f} {:>16.0f}   {}\n".format(backend_name,
+            single, total, backend.description))
+        out.flush()
+
+
+class PreHashWorker(object):
+    """Computes hashes for a lane of label counters and writes the uncovered
+    ones into a ring buffer. Run by a PreHashProcess or a PreHashThread."""
+
+    def __init__ (self, pipe, element_size,
+            process_id, label_fun, num_processes, backend, hash_cache=None,
+            num_lanes=None):
         self.pipe = pipe
         self.id = process_id
         self.element_size = element_size
-        self.use_cext = use_cext
+        self.backend = backend
         self.label_fun = label_fun
         self.num_processes = num_processes
-
-        if self.use_cext and not HAS_NSEC3HASH:
-            log.error("failed to import nsec3hash module, ",
-                      "falling back to Python-based hashing\n",
-                      "use --no-openssl to avoid printing this error")
-            self.use_cext = False
+        self.num_lanes = num_lanes or num_processes
+        self.hash_cache = hash_cache
 
         self.zone = None
+        self.coverage = None
+        self.ring = None
         self.generator = None
         self.salt = None
         self.iterations = None
+        self.paused = False
+        # the share of the wordlist, every num_processes-th name starting
+        # with the one at index process_id
+        self.wordlist = None
+        self._next_word = 0
+        self._hash_names = None
+
+    def _run_worker(self):
+        (label_counter_init,  self.zone, self.salt,
+                self.iterations, self.backend,
+                self.element_size, ring,
+                coverage_snapshot, encoding) = self.pipe.recv()
+        self.label_fun = name.label_encodings[encoding]
+        self._attach(ring, coverage_snapshot)
+        self.generator = _process_range_generator(gap = 1024,
+                process_id = self.id,
+                num_processes = self.num_lanes,
+                init = label_counter_init)
+        hash_range = hash_backends[self.backend].hash_range_func(
+                self.label_fun, self.zone, self.salt, self.iterations)
+        self._hash_names = hash_backends[self.backend].hash_names_func(
+                self.salt, self.iterations)
+        if self.hash_cache is not None:
+            cache = hashcache.HashCache(self.hash_cache, self.zone,
+                    self.salt, self.iterations, encoding,
+                    self.num_processes)
+            self.generator = cache.ranges(self.generator, self.id,
+                    self.num_processes)
+            hash_range = cache.hash_range_func(hash_range)
+        self._precompute_hashes(hash_range)
+
+    def _attach(self, ring, coverage_snapshot):
+        if not isinstance(ring, RingBuffer):
+            ring = RingBuffer(_slot.size, name=ring)
+        self.ring = ring
+        self.coverage = CoverageSnapshotReader(coverage_snapshot)
+
+    def _handle_control_messages(self):
+        while self.pipe.poll():
+            msg = self.pipe.recv()
+            if msg[0] == 'coverage':
+                self.coverage.attach(msg[1])
+            elif msg[0] == 'element_size':
+                self.element_size = msg[1]
+            elif msg[0] == 'pause':
+                self.paused = msg[1]
+
+    def _wait_control_messages(self, timeout):
+        self.pipe.poll(timeout)
+        self._handle_control_messages()
+
+    def _write_uncovered(self, uncovered, total_tested, label_counter_state):
+        """Writes the (label counter, hash) pairs into the ring buffer"""
+        ring = self.ring
+        buf = ring.buf
+        pack_slot = _slot.pack_into
+        # an element may not fit into the ring at low coverage
+        while True:
+            chunk = uncovered[:ring.capacity]
+            del uncovered[:ring.capacity]
+            ring.wait_free(len(chunk), self._wait_control_messages)
+            for k, (counter, dn_hash) in enumerate(chunk):
+                pack_slot(buf, ring.offset(k), counter, dn_hash)
+            if len(uncovered) > 0:
+                ring.commit(len(chunk))
+                continue
+            # the walker also needs the number of tested hashes for its
+            # statistics, not just the uncovered ones
+            ring.commit(len(chunk), (total_tested, label_counter_state))
+            break
+
+    def _precompute_hashes(self, hash_range):
+        generator = self.generator
+        coverage = self.coverage
+        total_tested = 0
+        start, count = next(generator)
+        while True:
+            self._handle_control_messages()
+            while self.paused and not self._has_words():
+                self._wait_control_messages(PAUSE_POLL)
+            coverage.refresh()
+            element_size = self.element_size
+            uncovered = []
+            tested = self._hash_words(uncovered, max(1, element_size//2))
+            while tested < element_size and not self.paused:
+                if count == 0:
+                    start, count = next(generator)
+                n = min(count, element_size - tested)
+                hashes = hash_range(start, n)
+                for i in coverage.covers_many(hashes):
+                    uncovered.append((start + i, hashes[i*20:(i+1)*20]))
+                start += n
+                count -= n
+                tested += n
+            total_tested += tested
+            self._write_uncovered(uncovered, total_tested, start - 1)
+
+    def _hash_words(self, candidates, n):
+        """Appends the next n names of the wordlist to candidates. They are
+        not filtered by the coverage, as the walker also looks for hashed
+        owner names among them.
+
+        Returns the number of names hashed"""
+        if not self._has_words():
+            return 0
+        start = self._next_word
+        end = min(len(self.wordlist), start + n)
+        hashes = self._hash_names(self.wordlist[start:end])
+        for k in range(end - start):
+            index = self.id + (start + k)*self.num_processes
+            candidates.append((WORD_FLAG | index, hashes[k*20:(k+1)*20]))
+        self._next_word = end
+        return end - start
+
+    def _has_words(self):
+        return (self.wordlist is not None and
+                self._next_word < len(self.wordlist))
+
+
+class PreHashProcess(PreHashWorker, multiprocessing.Process):
+    def __init__ (self, pipe, element_size,
+            process_id, label_fun, num_processes, backend, hash_cache=None,
+            num_lanes=None):
+        multiprocessing.Process.__init__(self)
+        # Kills this Process when parent exits
+        self.daemon = True
+        PreHashWorker.__init__(self, pipe, element_size, process_id,
+                label_fun, num_processes, backend, hash_cache, num_lanes)
 
     def run(self):
         try:
             os.nice(15)
             gc.collect()
             log.logger = None
-            (label_counter_init,  self.zone, self.salt,
-                    self.iterations) = self.pipe.recv()
-            self.generator = _process_label_generator(label_fun =
-                    self.label_fun, gap = 1024, process_id = self.id,
-                    num_processes = self.num_processes,
-                    init = label_counter_init)
-            if self.use_cext:
-                self._precompute_hashes(self._hash_cext)
-            else:
-                self._precompute_hashes(self._hash)
+            self._run_worker()
         except KeyboardInterrupt:
             sys.exit(3)
 
 
-    def _hash(self, dn):
-        return rrtypes.nsec3.compute_hash(dn, self.salt,
-                self.iterations)
+class ThreadPipe(object):
+    """One end of a pipe between two threads of the walker, with the subset
+    of the multiprocessing.Connection interface that a PreHashWorker uses"""
 
-    def _hash_cext(self, dn):
-        return nsec3hash.compute_hash(dn.to_wire(), self.salt,
-                self.iterations)
+    def __init__(self, incoming, outgoing):
+        self._incoming = incoming
+        self._outgoing = outgoing
+        self._pending = collections.deque()
 
-    def _precompute_hashes(self, hash_func):
-        counter_state = 0
-        element_size = self.element_size
-        generator = self.generator
-        while True:
-            element = []
-            for i in range(element_size):
-                ptlabel, counter_state = next(generator)
-                dn = DomainName(Label(ptlabel), *self.zone.labels)
-                hashed_owner =  hash_func(dn)
-                element.append((ptlabel,hashed_owner))
+    def send(self, msg):
+        self._outgoing.put(msg)
+
+    def poll(self, timeout=0.0):
+        if len(self._pending) == 0:
+            try:
+                self._pending.append(self._incoming.get(timeout > 0,
+                    timeout))
+            except queue.Empty:
+                return False
+        return True
+
+    def recv(self):
+        if len(self._pending) > 0:
+            return self._pending.popleft()
+        return self._incoming.get()
+
+def thread_pipe():
+    a, b = queue.SimpleQueue(), queue.SimpleQueue()
+    return ThreadPipe(a, b), ThreadPipe(b, a)
+
+
+class PreHashThread(PreHashWorker, threading.Thread):
+    """A PreHashWorker running as a thread of the walker. The batch backends
+    release the GIL while hashing, and its ring buffer is plain memory."""
+
+    def __init__ (self, pipe, element_size,
+            process_id, label_fun, num_processes, backend, hash_cache=None,
+            num_lanes=None):
+        threading.Thread.__init__(self, daemon=True)
+        PreHashWorker.__init__(self, pipe, element_size, process_id,
+                label_fun, num_processes, backend, hash_cache, num_lanes)
+        self._stopped = False
+
+    def run(self):
+        if sys.platform.startswith('linux'):
+            # Linux applies the nice value to the thread only
+            try:
+                os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 15)
+            except OSError:
+                pass
+        self._run_worker()
 
-            self.pipe.send((element, counter_state))
+    def terminate(self):
+        """Makes the thread exit at its next check for control messages"""
+        self._stopped = True
 
+    def _handle_control_messages(self):
+        if self._stopped:
+            sys.exit()
+        PreHashWorker._handle_control_messages(self)
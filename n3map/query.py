@@ -1,8 +1,13 @@
+import collections
 import struct
 import itertools
+import secrets
+import socket
+import time
 
 import dns.resolver
 import dns.exception
+import dns.inet
 import dns.message
 import dns.name
 import dns.query
@@ -137,34 +142,317 @@ class DNSPythonResult(object):
                     _rrtypes_to_text(types)))
         return nsec3
 
-def dnspython_query(dname, ns_ip, ns_port, rrtype, timeout):
-    # XXX:
-    qname = dns.name.from_wire(dname.to_wire(), 0)[0]
+# RD, as set by dns.message.make_query()
+_QUERY_FLAGS = dns.flags.RD
+_QR = 0x8000
+_TC = 0x0200
+_OPT = 41
+_TSIG = 250
+# root owner, OPT, 4096 bytes payload, no extended rcode, version 0, DO bit,
+# no options
+_OPT_RR = b'\x00' + struct.pack('!HHBBHH', _OPT, 4096, 0, 0, 0x8000, 0)
+# rcodes which servers may send without echoing the question
+_RCODES_WITHOUT_QUESTION = (dns.rcode.FORMERR, dns.rcode.SERVFAIL,
+        dns.rcode.NOTIMP, dns.rcode.REFUSED)
 
-    q = dns.message.make_query(qname,
-                               rrtype,
-                               want_dnssec=True,
-                               payload = 4096)
-    r = dns.query.udp(q, ns_ip, port=ns_port, timeout=timeout,
-            ignore_unexpected=True)
-    if r.flags & dns.flags.TC:
-        r = dns.query.tcp(q, ns_ip, port=ns_port, timeout=timeout)
+_header = struct.Struct('!HHHHHH')
+_rr_header = struct.Struct('!HHIH')
+_query_templates = {}
 
-    return DNSPythonResult(r)
+def _query_template(rrtype):
+    t = _query_templates.get(rrtype)
+    if t is None:
+        head = struct.pack('!HHHHH', _QUERY_FLAGS, 1, 0, 0, 1)
+        tail = struct.pack('!HH', dns.rdatatype.from_text(rrtype),
+                dns.rdataclass.IN) + _OPT_RR
+        t = _query_templates[rrtype] = (head, tail)
+    return t
+
+def query_wire(dname, rrtype, msg_id):
+    """Returns the query for dname in wire format, with the DO bit set and
+    a payload size of 4096.
+
+    The header and the OPT record come from a template per rrtype, only the
+    ID and the qname are filled in."""
+    head, tail = _query_template(rrtype)
+    return b''.join((msg_id.to_bytes(2, 'big'), head, dname.to_wire(), tail))
+
+def response_matches(wire, request):
+    """Returns True if wire is a response to request, both in wire format.
+
+    Like dns.message.Message.is_response(), it compares the ID and the
+    question, ignoring the case of the qname."""
+    if len(wire) < 12 or wire[:2] != request[:2]:
+        return False
+    flags = int.from_bytes(wire[2:4], 'big')
+    if not flags & _QR:
+        return False
+    qdcount = int.from_bytes(wire[4:6], 'big')
+    if qdcount == 0:
+        return flags & 0xf in _RCODES_WITHOUT_QUESTION
+    end = len(request) - len(_OPT_RR)
+    if qdcount != 1 or len(wire) < end:
+        return False
+    if wire[12:end] == request[12:end]:
+        return True
+    return (wire[12:end-4].lower() == request[12:end-4].lower() and
+            wire[end-4:end] == request[end-4:end])
+
+def truncated(wire):
+    return bool(int.from_bytes(wire[2:4], 'big') & _TC)
+
+def _read_name(wire, pos):
+    """Returns the labels of the name at pos, including the empty root label,
+    and the position after it. Compression pointers must point backwards,
+    as dnspython requires."""
+    labels = []
+    end = None
+    limit = pos
+    while True:
+        n = wire[pos]
+        if n == 0:
+            labels.append(b'')
+            pos += 1
+            break
+        elif n <= name.MAX_LABEL:
+            label = wire[pos+1:pos+1+n]
+            if len(label) != n:
+                raise ValueError('truncated label')
+            labels.append(label)
+            pos += 1 + n
+        elif n >= 0xc0:
+            target = ((n & 0x3f) << 8) | wire[pos+1]
+            if target >= limit:
+                raise ValueError('bad compression pointer')
+            if end is None:
+                end = pos + 2
+            pos = limit = target
+        else:
+            raise ValueError('unknown label type')
+    return labels, (end if end is not None else pos)
+
+def _domainname(labels):
+    return name.DomainName(*[name.Label(l) for l in labels])
+
+_bitmap_types = {}
+# bounds the cache, in case a server makes up type bitmaps
+_MAX_BITMAPS = 1024
+
+def _types_from_bitmap(bitmap):
+    """Returns the types of a type bitmap field in text form, cached"""
+    types = _bitmap_types.get(bitmap)
+    if types is not None:
+        return types
+    window_list = []
+    pos = 0
+    last = -1
+    while pos < len(bitmap):
+        win_nr = bitmap[pos]
+        length = bitmap[pos+1]
+        if win_nr <= last or length == 0 or length > 32:
+            raise ValueError('bad type bitmap')
+        window = bitmap[pos+2:pos+2+length]
+        if len(window) != length:
+            raise ValueError('truncated type bitmap')
+        window_list.append((win_nr, window))
+        last = win_nr
+        pos += 2 + length
+    types = rrtypes.rr.intern_types(
+            _rrtypes_to_text(_rrtypes_from_window_list(window_list)))
+    if len(_bitmap_types) >= _MAX_BITMAPS:
+        _bitmap_types.clear()
+    _bitmap_types[bitmap] = types
+    return types
+
+
+class WireResult(object):
+    """Result decoded straight from the wire format.
+
+    Only the header and the records the walkers look at are decoded: the
+    NSEC, NSEC3, SOA, NS, DNSKEY and RRSIG records of class IN in the answer
+    and authority sections. Like dnspython, only the first record of an RRset
+    is used. Raises ValueError, IndexError or N3MapError for responses it
+    cannot decode, which are left to dnspython by decode_response()."""
+
+    def __init__(self, wire):
+        (msg_id, flags, qdcount, ancount, nscount,
+                arcount) = _header.unpack_from(wire, 0)
+        self._rcode = flags & 0xf
+        pos = 12
+        for i in range(qdcount):
+            pos = _read_name(wire, pos)[1] + 4
+        self._answer, self._answer_rrsets, pos = self._read_section(wire,
+                pos, ancount)
+        self._authority, authority_rrsets, pos = self._read_section(wire,
+                pos, nscount)
+        for i in range(arcount):
+            pos = _read_name(wire, pos)[1]
+            rdtype, rdclass, ttl, rdlen = _rr_header.unpack_from(wire, pos)
+            pos += _rr_header.size + rdlen
+            if rdtype == _OPT:
+                # extended rcode
+                self._rcode |= (ttl >> 24) << 4
+            elif rdtype == _TSIG:
+                raise ValueError('signed message')
+        if pos != len(wire):
+            raise ValueError('trailing data')
+
+    def _read_section(self, wire, pos, count):
+        """Returns the decoded records by type, the number of RRsets and the
+        position after the section"""
+        records = collections.defaultdict(list)
+        rrsets = set()
+        for i in range(count):
+            labels, pos = _read_name(wire, pos)
+            rdtype, rdclass, ttl, rdlen = _rr_header.unpack_from(wire, pos)
+            pos += _rr_header.size
+            end = pos + rdlen
+            if end > len(wire):
+                raise ValueError('truncated rdata')
+            covers = 0
+            if rdtype == dns.rdatatype.RRSIG:
+                covers = int.from_bytes(wire[pos:pos+2], 'big')
+            key = (tuple(l.lower() for l in labels), rdtype, rdclass, covers)
+            if key in rrsets:
+                pos = end
+                continue
+            rrsets.add(key)
+            if rdclass == dns.rdataclass.IN:
+                rr = self._read_rdata(wire, pos, end, labels, rdtype, ttl)
+                if rr is not None:
+                    records[rdtype].append(rr)
+            pos = end
+        return records, len(rrsets), pos
+
+    def _read_rdata(self, wire, pos, end, labels, rdtype, ttl):
+        if rdtype == dns.rdatatype.NSEC3:
+            algorithm, flags, iterations, salt_len = struct.unpack_from(
+                    '!BBHB', wire, pos)
+            pos += 5
+            salt = wire[pos:pos+salt_len]
+            pos += salt_len
+            hash_len = wire[pos]
+            next_hashed_owner = wire[pos+1:pos+1+hash_len]
+            pos += 1 + hash_len
+            if pos > end:
+                raise ValueError('truncated NSEC3 rdata')
+            return rrtypes.nsec3.NSEC3(_domainname(labels), ttl, 'IN',
+                    algorithm, flags, iterations, salt, next_hashed_owner,
+                    _types_from_bitmap(wire[pos:end]))
+        elif rdtype == dns.rdatatype.NSEC:
+            next_labels, pos = _read_name(wire, pos)
+            if pos > end:
+                raise ValueError('truncated NSEC rdata')
+            return rrtypes.nsec.NSEC(_domainname(labels), ttl, 'IN',
+                    _domainname(next_labels), _types_from_bitmap(wire[pos:end]))
+        elif rdtype == dns.rdatatype.RRSIG:
+            type_covered = int.from_bytes(wire[pos:pos+2], 'big')
+            signer, pos = _read_name(wire, pos + 18)
+            if pos > end:
+                raise ValueError('truncated RRSIG rdata')
+            return (_domainname(labels), type_covered, _domainname(signer))
+        elif rdtype in (dns.rdatatype.SOA, dns.rdatatype.NS,
+                dns.rdatatype.DNSKEY):
+            return _domainname(labels)
+        return None
+
+    def _section(self, in_answer):
+        return self._answer if in_answer else self._authority
+
+    def status(self):
+        return dns.rcode.to_text(self._rcode)
+
+    def find_SOA(self, in_answer=True):
+        owners = self._section(in_answer)[dns.rdatatype.SOA]
+        return owners[0] if len(owners) > 0 else None
+
+    def find_NS(self, in_answer=True):
+        owners = self._section(in_answer)[dns.rdatatype.NS]
+        return owners[0] if len(owners) > 0 else None
+
+    def find_DNSKEY(self):
+        owners = self._answer[dns.rdatatype.DNSKEY]
+        return owners[0] if len(owners) > 0 else None
+
+    def answer_length(self):
+        return self._answer_rrsets
+
+    def find_RRSIG_signer(self, owner, type_covered, in_answer=True):
+        type_covered = dns.rdatatype.from_text(type_covered)
+        for rrsig_owner, covered, signer in self._section(in_answer)[
+                dns.rdatatype.RRSIG]:
+            if covered == type_covered and owner == rrsig_owner:
+                return signer
+        return None
+
+    def find_NSEC(self, in_answer=False):
+        return list(self._section(in_answer)[dns.rdatatype.NSEC])
+
+    def all_NSEC_rrs(self):
+        return itertools.chain(self.find_NSEC(in_answer=False),
+                               self.find_NSEC(in_answer=True))
+
+    def find_NSEC3(self):
+        return list(self._authority[dns.rdatatype.NSEC3])
+
+
+def decode_response(wire):
+    """Returns the result for the response wire.
+
+    Decodes it with WireResult, or with dnspython if the response is
+    malformed or unusual. Raises dns.exception.DNSException if dnspython
+    cannot decode it either."""
+    try:
+        return WireResult(wire)
+    except (ValueError, IndexError, struct.error, exception.N3MapError):
+        return DNSPythonResult(dns.message.from_wire(wire))
+
+def udp_query(dname, ns_ip, ns_port, rrtype, timeout):
+    """Sends a query for dname to the nameserver and returns the result,
+    retrying over TCP if the response is truncated. Responses not matching
+    the query are ignored."""
+    request = query_wire(dname, rrtype, secrets.randbelow(65536))
+    deadline = time.monotonic() + timeout
+    with socket.socket(dns.inet.af_for_address(ns_ip),
+            socket.SOCK_DGRAM) as sock:
+        sock.connect((ns_ip, ns_port))
+        sock.send(request)
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise dns.exception.Timeout
+            sock.settimeout(remaining)
+            try:
+                wire = sock.recv(65535)
+            except socket.timeout:
+                raise dns.exception.Timeout
+            except ConnectionRefusedError:
+                # e.g. an ICMP port unreachable, wait for the timeout like
+                # an unconnected socket would
+                continue
+            if response_matches(wire, request):
+                break
+    if truncated(wire):
+        return DNSPythonResult(dns.query.tcp(dns.message.from_wire(request),
+            ns_ip, port=ns_port, timeout=timeout))
+    return decode_response(wire)
+
+def checked_result(res):
+    """Returns res, or the error if its status is neither NOERROR nor
+    NXDOMAIN"""
+    if res.status() != 'NOERROR' and res.status() != 'NXDOMAIN':
+        return exception.UnexpectedResponseStatus(res.status())
+    return res
 
 
 def query(dname, ns, rrtype, timeout):
     try:
-        res = dnspython_query(dname, ns.ip_str(), ns.port, rrtype, timeout)
+        res = udp_query(dname, ns.ip_str(), ns.port, rrtype, timeout)
     except dns.exception.Timeout:
         return exception.TimeOutError()
-    except dns.query.BadResponse:
+    except (OSError, dns.exception.DNSException):
         return exception.QueryError()
-    except dns.name.BadLabelType:
-        raise exception.N3MapError('Unable to resolve ' + str(dname), ' bad DNS name')
-    if res.status() != 'NOERROR' and res.status() != 'NXDOMAIN':
-        return exception.UnexpectedResponseStatus(res.status())
-    return res
+    return checked_result(res)
 
 def query_ns_records(zone):
     try:
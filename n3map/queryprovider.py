@@ -1,12 +1,17 @@
+import asyncio
 import collections
+import random
+import secrets
 import socket
 import time
 import itertools
-import threading
-import queue
 import re
 import ipaddress
 
+import dns.asyncquery
+import dns.exception
+import dns.message
+
 from . import vis
 from .util import printsafe
 from . import query
@@ -26,6 +31,26 @@ from .exception import (
 
 DEFAULT_PORT = 53
 QR_MEASUREMENTS = 256
+# in-flight queries per UDP socket before another one is opened, out of the
+# 65536 message IDs
+MAX_QUERIES_PER_SOCKET = 16384
+RCVBUF_PER_QUERY = 4096
+MAX_RCVBUF = 1 << 24
+
+# congestion control of the aggressive mode, see NameServer
+INITIAL_WINDOW = 4
+MIN_WINDOW = 1
+WINDOW_DECREASE = 0.5
+# the queries of a window are spread over a little less than a round trip
+PACING_GAIN = 1.25
+# retransmission timeout, see RFC 6298
+RTT_GAIN = 1/8
+RTTVAR_GAIN = 1/4
+RTTVAR_FACTOR = 4
+MIN_RTO = 0.05
+MAX_RTO = 60.0
+# RTT samples kept per nameserver for the stats
+RTT_SAMPLES = 4096
 
 
 class QueryProvider(object):
@@ -47,14 +72,42 @@ class QueryProvider(object):
         self.stats = stats if stats is not None else {}
         self.stats['queries'] = 0
         self._qr_measurements = collections.deque(maxlen=QR_MEASUREMENTS)
+        # the response times of removed nameservers, for rtt_stats()
+        self._removed_rtts = []
 
     def _ns_cycle(self, step=1):
         self.next_ns_idx = (self.next_ns_idx + step) % len(self.ns_list)
 
     def _next_ns(self):
-        ns = self.ns_list[self.next_ns_idx]
-        self._ns_cycle()
-        return ns
+        """Picks the nameserver for the next query: the one expected to
+        answer sooner out of two picked at random (power of two choices),
+        which sends most queries to fast and healthy servers while still
+        spreading them.
+
+        If query_interval is set, only servers which got no query for their
+        share of it are picked, waiting for the next one if necessary."""
+        min_interval = self._min_ns_interval()
+        now = time.monotonic()
+        ready = [ns for ns in self.ns_list if
+                ns.next_send_time(min_interval) <= now]
+        if len(ready) == 0:
+            ns = min(self.ns_list,
+                    key=lambda ns: ns.next_send_time(min_interval))
+            self._wait_until(ns.next_send_time(min_interval))
+            return ns
+        if len(ready) == 1:
+            return ready[0]
+        a, b = random.sample(ready, 2)
+        if (a.expected_completion(self.timeout) <=
+                b.expected_completion(self.timeout)):
+            return a
+        return b
+
+    def _min_ns_interval(self):
+        if self.query_interval is None:
+            return 0.0
+        # the share of the query rate of each server
+        return self.query_interval * len(self.ns_list)
 
     def _remove_ns(self, ns):
         try:
@@ -63,6 +116,7 @@ class QueryProvider(object):
             # may have been already removed
             return
         removed_ns = self.ns_list.pop(ns_idx)
+        self._removed_rtts.extend(removed_ns.rtt_samples)
 
         log.warn("removed misbehaving/unresponsive nameserver ", str(removed_ns))
 
@@ -110,7 +164,15 @@ class QueryProvider(object):
         try:
             self.stats['queries'] += 1
             log.debug2('query: ', query_dn, '; ns = ', ns, '; rrtype = ', rrtype)
-            return query.query(query_dn, ns, rrtype, self.timeout)
+            sent = time.monotonic()
+            ns.last_send = sent
+            res = query.query(query_dn, ns, rrtype,
+                    ns.query_timeout(self.timeout))
+            if isinstance(res, TimeOutError):
+                ns.backoff()
+            elif not isinstance(res, N3MapError):
+                ns.rtt_sample(time.monotonic() - sent)
+            return res
         finally:
             log.logger.unblock_signals()
 
@@ -137,6 +199,23 @@ class QueryProvider(object):
                 continue
 
 
+    def rtt_stats(self):
+        """Puts the percentiles of the response times of the nameservers in
+        the stats, including the ones removed during the walk"""
+        rtts = sorted(itertools.chain(self._removed_rtts,
+            itertools.chain.from_iterable(ns.rtt_samples for ns in
+                self.ns_list)))
+        if len(rtts) == 0:
+            return
+        for p in (50, 90, 99):
+            self.stats['rtt_p{:d}_ms'.format(p)] = "{:.3g}".format(
+                    1000*rtts[min(len(rtts) - 1, len(rtts)*p//100)])
+        for ns in self.ns_list:
+            if ns.srtt is not None:
+                log.debug1("{}: smoothed RTT {:.3g}ms, timeout {:.3g}ms"
+                        .format(ns, 1000*ns.srtt,
+                            1000*ns.query_timeout(self.timeout)))
+
     def query_rate(self):
         t = time.monotonic()
         # discard any data older than 2 seconds:
@@ -163,6 +242,15 @@ class QueryProvider(object):
 
         self._last_query_time = time.monotonic()
 
+    def _wait_until(self, t):
+        # the loop is needed because time.sleep()
+        # may be interrupted by a signal
+        while True:
+            diff = t - time.monotonic()
+            if diff <= 0:
+                break
+            time.sleep(diff)
+
 
 class Query(object):
     def __init__(self, id, query_dn, ns, rrtype, timeout):
@@ -172,16 +260,32 @@ class Query(object):
         self.rrtype = rrtype
         self.timeout = timeout
 
-def create_aggressive_qp(queryprovider, num_threads):
-    return AggressiveQueryProvider(queryprovider.ns_list,
-                                   queryprovider.timeout,
-                                   queryprovider.max_retries,
-                                   queryprovider.max_errors,
-                                   queryprovider.stats,
-                                   queryprovider.query_interval,
-                                   num_threads)
+def create_aggressive_qp(queryprovider, max_queries):
+    qp = AggressiveQueryProvider(queryprovider.ns_list,
+                                 queryprovider.timeout,
+                                 queryprovider.max_retries,
+                                 queryprovider.max_errors,
+                                 queryprovider.stats,
+                                 queryprovider.query_interval,
+                                 max_queries)
+    # the servers are shared, and so are the RTTs of the removed ones
+    qp._removed_rtts = queryprovider._removed_rtts
+    return qp
 
 class AggressiveQueryProvider(QueryProvider):
+    """Keeps up to max_queries queries in flight from a single thread.
+
+    The queries are sent over a few long-lived UDP sockets per nameserver,
+    each of which can carry a query per message ID at a time. Responses are
+    matched to their queries by the socket and ID. The sockets and the
+    timers of the queries are driven by an asyncio event loop, which runs
+    whenever responses are collected. Truncated responses are retried over
+    TCP.
+
+    Queries are only sent to a nameserver while its congestion window is
+    open and its pacing allows, see NameServer. If query_interval is set,
+    each nameserver gets at most its share of the query rate."""
+
     def __init__(self,
                  ns_list,
                  timeout,
@@ -189,7 +293,7 @@ class AggressiveQueryProvider(QueryProvider):
                  max_errors,
                  stats=None,
                  query_interval=None,
-                 num_threads=1):
+                 max_queries=1):
         super(AggressiveQueryProvider,self).__init__(
                  ns_list,
                  timeout,
@@ -200,36 +304,222 @@ class AggressiveQueryProvider(QueryProvider):
         self._current_queryid = 0
         self._active_queries = {}
         self._results = {}
-        self._query_queue = queue.Queue()
-        self._result_queue = queue.Queue()
-        self._querythreads = []
-        self._start_query_threads(num_threads)
-
-    def _start_query_threads(self,num=1):
-        for i in range(num):
-            qt = QueryThread(self._query_queue, self._result_queue)
-            self._querythreads.append(qt)
-            qt.start()
+        self._max_queries = max_queries
+        self._loop = asyncio.new_event_loop()
+        # sockets by nameserver
+        self._sockets = {}
+        # (socket, message ID) -> (Query, request in wire format, timer)
+        self._pending = {}
+        self._pending_per_socket = collections.Counter()
+        self._tcp_tasks = set()
+        self._responses = collections.deque()
+        self._response_waiter = None
+        self.stats['timeouts_coalesced'] = 0
+        for ns in ns_list:
+            ns.reset_window(max_queries)
 
     def stop(self):
-        for i in range(len(self._querythreads)):
-            self._query_queue.put(None)
-        for qt in self._querythreads:
-            qt.join()
+        for q, request, timer, sent in self._pending.values():
+            timer.cancel()
+        self._pending.clear()
+        for task in self._tcp_tasks:
+            task.cancel()
+        if len(self._tcp_tasks) > 0:
+            self._loop.run_until_complete(asyncio.gather(*self._tcp_tasks,
+                return_exceptions=True))
+        for socks in self._sockets.values():
+            for sock in socks:
+                self._loop.remove_reader(sock.fileno())
+                sock.close()
+        self._sockets.clear()
+        self._loop.close()
 
     def _gen_query_id(self):
         self._current_queryid += 1
         return self._current_queryid
 
-    def _sendquery(self, query):
+    def _open_socket(self, ns):
+        family = socket.AF_INET6 if ns.ip.version == 6 else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        try:
+            # room for the responses arriving while the walker is busy
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                    min(RCVBUF_PER_QUERY*self._max_queries, MAX_RCVBUF))
+        except OSError:
+            pass
+        try:
+            sock.connect((ns.ip_str(), ns.port))
+        except OSError as e:
+            sock.close()
+            raise N3MapError("failed to open socket to ", str(ns), ": ",
+                    str(e))
+        self._loop.add_reader(sock.fileno(), self._read_responses, sock)
+        return sock
+
+    def _socket_for(self, ns):
+        """Returns the least loaded socket to ns, opening another one if
+        they all carry many queries"""
+        socks = self._sockets.setdefault(ns, [])
+        if len(socks) > 0:
+            sock = min(socks, key=lambda s: self._pending_per_socket[s])
+            if self._pending_per_socket[sock] < MAX_QUERIES_PER_SOCKET:
+                return sock
+        sock = self._open_socket(ns)
+        socks.append(sock)
+        return sock
+
+    def _sendquery(self, q):
         self.stats['queries'] += 1
-        log.debug2('query: ', query.query_dn, '; ns = ', query.ns, '; rrtype = ', query.rrtype)
-        self._active_queries[query.id] = query
-        self._query_queue.put(query)
-        return query.id
+        log.debug2('query: ', q.query_dn, '; ns = ', q.ns, '; rrtype = ', q.rrtype)
+        self._active_queries[q.id] = q
+        sock = self._socket_for(q.ns)
+        while True:
+            msg_id = secrets.randbelow(65536)
+            if (sock, msg_id) not in self._pending:
+                break
+        request = query.query_wire(q.query_dn, q.rrtype, msg_id)
+        key = (sock, msg_id)
+        try:
+            sock.send(request)
+        except OSError:
+            # e.g. a full send buffer, handled like a lost packet
+            pass
+        sent = time.monotonic()
+        q.ns.sent_query(sent)
+        timer = self._loop.call_later(q.ns.query_timeout(q.timeout),
+                self._query_timeout, key)
+        self._pending[key] = (q, request, timer, sent)
+        self._pending_per_socket[sock] += 1
+        return q.id
+
+    def _pop_pending(self, key):
+        q, request, timer, sent = self._pending.pop(key)
+        self._pending_per_socket[key[0]] -= 1
+        q.ns.in_flight -= 1
+        timer.cancel()
+        return q, request, sent
+
+    def _add_response(self, qid, res):
+        self._responses.append((qid, res))
+        if (self._response_waiter is not None and
+                not self._response_waiter.done()):
+            self._response_waiter.set_result(None)
+
+    def _read_responses(self, sock):
+        while True:
+            try:
+                data = sock.recv(65535)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                # e.g. an ICMP port unreachable, the query times out
+                continue
+            if len(data) < 2:
+                continue
+            key = (sock, int.from_bytes(data[:2], 'big'))
+            entry = self._pending.get(key)
+            if entry is None:
+                continue
+            q, request, timer, sent = entry
+            if not query.response_matches(data, request):
+                # unexpected, keep waiting
+                continue
+            self._pop_pending(key)
+            now = time.monotonic()
+            if query.truncated(data):
+                # possibly a slipped response of response rate limiting
+                q.ns.congestion(sent, now)
+                task = self._loop.create_task(self._query_tcp(q, request))
+                self._tcp_tasks.add(task)
+                task.add_done_callback(self._tcp_tasks.discard)
+                continue
+            try:
+                res = query.decode_response(data)
+            except dns.exception.DNSException:
+                self._add_response(q.id, QueryError())
+                continue
+            if res.status() == 'SERVFAIL':
+                q.ns.congestion(sent, now)
+            else:
+                q.ns.response(now - sent)
+            self._add_response(q.id, query.checked_result(res))
+
+    async def _query_tcp(self, q, request):
+        try:
+            response = await dns.asyncquery.tcp(
+                    dns.message.from_wire(request), q.ns.ip_str(),
+                    port=q.ns.port, timeout=q.timeout)
+        except dns.exception.Timeout:
+            self._add_response(q.id, TimeOutError())
+            return
+        except (OSError, dns.exception.DNSException):
+            self._add_response(q.id, QueryError())
+            return
+        self._add_response(q.id,
+                query.checked_result(query.DNSPythonResult(response)))
+
+    def _query_timeout(self, key):
+        q, request, sent = self._pop_pending(key)
+        now = time.monotonic()
+        q.ns.congestion(sent, now)
+        if q.ns.timed_out(sent, now):
+            self._add_response(q.id, TimeOutError())
+        else:
+            # timed out together with a query already counted, just resend
+            self._add_response(q.id, None)
+
+    async def _wait_response(self, timeout=None):
+        """Waits for a response or timeout of a query, or at most timeout
+        seconds"""
+        self._response_waiter = self._loop.create_future()
+        try:
+            await asyncio.wait_for(self._response_waiter, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self._response_waiter = None
+
+    def _ready_ns(self):
+        """Returns the next nameserver in line which may be sent a query,
+        or None and the time to wait for one at most (None if until a query
+        completes)"""
+        now = time.monotonic()
+        min_interval = self._min_ns_interval()
+        wait = None
+        for i in range(len(self.ns_list)):
+            ns = self.ns_list[self.next_ns_idx]
+            self._ns_cycle()
+            if not ns.window_open():
+                continue
+            delay = ns.next_send_time(min_interval) - now
+            if delay <= 0:
+                return ns, None
+            wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    def _wait_ns(self):
+        while True:
+            ns, wait = self._ready_ns()
+            if ns is not None:
+                return ns
+            self._loop.run_until_complete(self._wait_response(wait))
+
+    def _retry_ns(self):
+        """Returns the nameserver to resend a query to, without waiting for
+        its window"""
+        ns, wait = self._ready_ns()
+        return ns if ns is not None else self._next_ns()
 
     def _checkresult(self, qid, res):
         q = self._active_queries[qid]
+        if res is None:
+            # a timeout not counted towards --max-retries, see
+            # _query_timeout()
+            self.stats['timeouts_coalesced'] += 1
+            q.ns = self._retry_ns()
+            self._sendquery(q)
+            return
         if not isinstance(res, N3MapError):
             q.ns.retries = 0
             self._results[qid] = (res, q.ns)
@@ -244,7 +534,7 @@ class AggressiveQueryProvider(QueryProvider):
                 # happens when we run out of servers
                 del self._active_queries[qid]
                 raise e
-            q.ns = self._next_ns()
+            q.ns = self._retry_ns()
             self._sendquery(q)
         except (QueryError, UnexpectedResponseStatus) as e:
             log.error("{} from server {}".format(e, q.ns))
@@ -254,19 +544,19 @@ class AggressiveQueryProvider(QueryProvider):
                 # happens when we run out of servers
                 del self._active_queries[qid]
                 raise e
-            q.ns = self._next_ns()
+            q.ns = self._retry_ns()
             self._sendquery(q)
 
 
     def _collectresponses(self, block=True):
-        if block:
-            self._checkresult(*self._result_queue.get(True))
-        has_responses = True
-        while has_responses:
-            try:
-                self._checkresult(*self._result_queue.get(False))
-            except queue.Empty:
-                has_responses = False
+        if block and len(self._responses) == 0:
+            self._loop.run_until_complete(self._wait_response())
+        else:
+            # handle the responses and timeouts which are due
+            self._loop.run_until_complete(asyncio.sleep(0))
+        responses = self._responses
+        while len(responses) > 0:
+            self._checkresult(*responses.popleft())
 
     def collectresponses(self, block=True):
         self._collectresponses(block)
@@ -276,8 +566,8 @@ class AggressiveQueryProvider(QueryProvider):
 
 
     def query_ff(self, query_dn, rrtype='A'):
-        ns = self._next_ns()
-        self._query_timing(query_dn, rrtype, ns)
+        ns = self._wait_ns()
+        self._qr_measurements.append(time.monotonic())
         return self._sendquery(Query(self._gen_query_id(), query_dn, ns, rrtype, self.timeout))
 
 
@@ -290,23 +580,6 @@ class AggressiveQueryProvider(QueryProvider):
                 return res
 
 
-class QueryThread(threading.Thread):
-    def __init__(self, query_queue, result_queue):
-        super(QueryThread, self).__init__()
-        self.daemon = True
-        self._query_queue = query_queue
-        self._result_queue = result_queue
-
-    def run(self):
-        query_queue = self._query_queue
-        result_queue = self._result_queue
-        while True:
-            q = query_queue.get()
-            if q is None:
-                return
-            result_queue.put((q.id,query.query(q.query_dn, q.ns, q.rrtype, q.timeout)))
-
-
 
 class NameServer(object):
     def __init__(self, ip, port, name):
@@ -317,10 +590,128 @@ class NameServer(object):
         self.name = vis.strvis(name.encode()).decode()
         self.retries = 0
         self.errors = 0
+        self.srtt = None
+        self.rttvar = None
+        self.rto = None
+        self._last_backoff = 0.0
+        self.rtt_samples = collections.deque(maxlen=RTT_SAMPLES)
+        self.reset_window(1)
+
+    def query_timeout(self, max_timeout):
+        """Returns the time to wait for a response to a query: the
+        retransmission timeout of RFC 6298, at most max_timeout (and
+        max_timeout until the first response)"""
+        if self.rto is None:
+            return max_timeout
+        return min(self.rto, max_timeout)
+
+    def rtt_sample(self, rtt):
+        """Updates the smoothed RTT, its variation and the retransmission
+        timeout with the RTT of a response.
+
+        Each query, retransmitted ones included, has a message ID of its
+        own, so the samples are never ambiguous (see Karn's algorithm)."""
+        self.rtt_samples.append(rtt)
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt/2
+        else:
+            self.rttvar += RTTVAR_GAIN*(abs(self.srtt - rtt) - self.rttvar)
+            self.srtt += RTT_GAIN*(rtt - self.srtt)
+        self.rto = min(MAX_RTO, max(MIN_RTO,
+            self.srtt + RTTVAR_FACTOR*self.rttvar))
+
+    def expected_completion(self, max_timeout):
+        """Returns the expected time until a response to a query: the
+        smoothed RTT plus a timeout for each recent timeout or error. A
+        server which was not queried yet is expected to respond at once, so
+        that it gets tried, while one which was but never responded is
+        expected to time out."""
+        if self.srtt is None:
+            if (self.last_send is None and
+                    self.retries + self.errors == 0):
+                return 0.0
+            return ((1 + self.retries + self.errors) *
+                    self.query_timeout(max_timeout))
+        return (self.srtt +
+                (self.retries + self.errors)*self.query_timeout(max_timeout))
+
+    def backoff(self):
+        """Doubles the retransmission timeout after a timeout"""
+        if self.rto is not None:
+            self.rto = min(MAX_RTO, 2*self.rto)
+
+    def timed_out(self, sent, now):
+        """Registers the timeout of a query sent at sent, backing off once
+        for the queries in flight at the time. Returns False if it already
+        did for an earlier timeout of those queries."""
+        if sent < self._last_backoff:
+            return False
+        self._last_backoff = now
+        self.backoff()
+        return True
+
+    def reset_window(self, max_window):
+        """Starts the congestion control of the queries to this server, for
+        up to max_window queries in flight.
+
+        The window grows by a query per response while below the slow start
+        threshold, and by a query per window of responses above it
+        (additive increase). Timeouts, truncated responses (which servers
+        rate limiting responses may send instead of dropping them) and
+        SERVFAIL responses halve it (multiplicative decrease), at most once
+        per window: only for queries sent after the last decrease.
+
+        Once the window was decreased, the queries are also paced, so that
+        the server sees a steady rate rather than bursts."""
+        self.max_window = max_window
+        self.window = float(min(INITIAL_WINDOW, max_window))
+        self.ssthresh = float(max_window)
+        self.in_flight = 0
+        self.last_send = None
+        self._last_decrease = 0.0
+
+    def window_open(self):
+        return self.in_flight < int(self.window)
+
+    def next_send_time(self, min_interval=0.0):
+        """Returns the earliest time a query may be sent to this server, at
+        least min_interval after the last one"""
+        if self.last_send is None:
+            return 0.0
+        interval = min_interval
+        if self.srtt is not None and self.ssthresh < self.max_window:
+            # spread the queries of a window over a round trip
+            interval = max(interval, self.srtt/(PACING_GAIN*self.window))
+        return self.last_send + interval
+
+    def sent_query(self, now):
+        self.in_flight += 1
+        self.last_send = now
+
+    def response(self, rtt):
+        """Registers a response which came rtt seconds after its query"""
+        self.rtt_sample(rtt)
+        if self.window < self.ssthresh:
+            self.window += 1
+        else:
+            self.window += 1/self.window
+        self.window = min(self.window, self.max_window)
+
+    def congestion(self, sent, now):
+        """Registers a sign of congestion for a query sent at sent"""
+        if sent < self._last_decrease:
+            return
+        self._last_decrease = now
+        self.window = self.ssthresh = max(MIN_WINDOW,
+                self.window*WINDOW_DECREASE)
+        log.debug2("reducing window of ", str(self), " to ",
+                str(int(self.window)), " queries")
 
     def add_timeouterror(self, max_retries):
+        # counted even without a limit, for expected_completion()
+        self.retries += 1
         if max_retries != -1:
-            self.retries += 1
             retries_left = max_retries - self.retries
             log.warn("timeout reached when waiting for response from ", str(self),
                     ", ", str(max(0,retries_left)), " retries left")
@@ -0,0 +1,188 @@
+import platform
+import struct
+import time
+
+from multiprocessing import shared_memory
+
+from .exception import N3MapError
+
+HAS_ATOMICS = False
+try:
+    from . import nsec3hash
+    HAS_ATOMICS = hasattr(nsec3hash, 'load_acquire')
+except ImportError:
+    pass
+
+# x86 neither reorders stores with other stores nor loads with other loads,
+# which is all the ring buffer needs
+_STRONGLY_ORDERED = platform.machine().lower() in ('x86_64', 'amd64', 'i386',
+        'i486', 'i586', 'i686', 'x86')
+# whether rings can be shared between processes on this platform
+SHARED_SUPPORTED = HAS_ATOMICS or _STRONGLY_ORDERED
+
+# every index lives on a cache line of its own
+_CACHE_LINE = 64
+_HEAD = 0
+# sequence counter of the progress counters, followed by them
+_PROGRESS_SEQ = _CACHE_LINE
+_PROGRESS = _CACHE_LINE + 8
+_TAIL = 2*_CACHE_LINE
+_DATA = 3*_CACHE_LINE
+
+_index = struct.Struct('<Q')
+_progress = struct.Struct('<QQ')
+
+if HAS_ATOMICS:
+    _load = nsec3hash.load_acquire
+    _store = nsec3hash.store_release
+    _fence = nsec3hash.fence
+else:
+    def _load(buf, offset):
+        return _index.unpack_from(buf, offset)[0]
+
+    def _store(buf, offset, value):
+        _index.pack_into(buf, offset, value)
+
+    def _fence():
+        pass
+
+MIN_DELAY = 0.00005
+MAX_DELAY = 0.002
+
+
+def backoff(delay):
+    """Returns the next delay when polling for slots"""
+    return min(MAX_DELAY, 2*delay)
+
+
+class RingBuffer(object):
+    """Lock-free single-producer/single-consumer queue of fixed-width slots in
+    shared memory.
+
+    The producer writes slots after head and then advances head, the consumer
+    reads slots after tail and then advances tail. Both indices only ever
+    grow and are each written by one side only. They are stored with release
+    and loaded with acquire semantics, so that the slots are written before
+    the other side sees the index move. This needs the nsec3hash extension,
+    except on x86, which keeps stores and loads in program order anyway.
+    Shared rings are refused on other platforms without it, see
+    SHARED_SUPPORTED.
+
+    The producer also owns a pair of progress counters which it may update
+    together with head, e.g. to report work that produced no slots. They
+    are guarded by a sequence counter (a seqlock), so the consumer never
+    sees half of an update.
+
+    If shared is False, the ring lives in plain memory for a producer and a
+    consumer in the same process, which then share the RingBuffer object."""
+
+    def __init__(self, slot_size, capacity=None, name=None, shared=True):
+        self.slot_size = slot_size
+        if shared and not SHARED_SUPPORTED:
+            raise N3MapError("ring buffers cannot be shared between "
+                    "processes on this platform without the nsec3hash "
+                    "extension")
+        if not shared:
+            self._shm = None
+            self._owner = False
+            self.buf = memoryview(bytearray(_DATA + capacity*slot_size))
+        elif name is None:
+            self._shm = shared_memory.SharedMemory(create=True,
+                    size=_DATA + capacity*slot_size)
+            self._owner = True
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+            self._owner = False
+        if shared:
+            self.buf = self._shm.buf
+        self.capacity = (len(self.buf) - _DATA)//slot_size
+        self._head = _load(self.buf, _HEAD)
+        self._tail = _load(self.buf, _TAIL)
+
+    @property
+    def name(self):
+        """The name of the shared memory segment, None if not shared"""
+        return self._shm.name if self._shm is not None else None
+
+    def offset(self, i):
+        """Returns the offset in buf of the slot i slots past the producer's
+        head (or the consumer's tail)"""
+        return _DATA + ((self._head + i) % self.capacity)*self.slot_size
+
+    # producer side
+
+    def free(self):
+        """Returns the number of slots the producer may write"""
+        tail = _load(self.buf, _TAIL)
+        return self.capacity - (self._head - tail)
+
+    def commit(self, n, progress=None):
+        """Publishes the next n slots (and the progress counters)"""
+        buf = self.buf
+        if progress is not None:
+            seq = _load(buf, _PROGRESS_SEQ)
+            # odd while the counters are written
+            _store(buf, _PROGRESS_SEQ, seq + 1)
+            _fence()
+            _progress.pack_into(buf, _PROGRESS, *progress)
+            _store(buf, _PROGRESS_SEQ, seq + 2)
+        self._head += n
+        _store(buf, _HEAD, self._head)
+
+    # consumer side
+
+    def available(self):
+        """Returns the number of slots the consumer may read"""
+        return _load(self.buf, _HEAD) - self._tail
+
+    def read_offset(self, i):
+        return _DATA + ((self._tail + i) % self.capacity)*self.slot_size
+
+    def read_slots(self, n):
+        """Returns a copy of the next n slots"""
+        start = self._tail % self.capacity
+        first = min(n, self.capacity - start)
+        offset = _DATA + start*self.slot_size
+        data = bytes(self.buf[offset:offset + first*self.slot_size])
+        if first < n:
+            data += bytes(self.buf[_DATA:_DATA + (n - first)*self.slot_size])
+        return data
+
+    def release(self, n):
+        """Hands the next n slots back to the producer"""
+        self._tail += n
+        _store(self.buf, _TAIL, self._tail)
+
+    def progress(self):
+        buf = self.buf
+        while True:
+            seq = _load(buf, _PROGRESS_SEQ)
+            if seq & 1:
+                # the producer is in the middle of an update
+                time.sleep(0)
+                continue
+            progress = _progress.unpack_from(buf, _PROGRESS)
+            _fence()
+            if _load(buf, _PROGRESS_SEQ) == seq:
+                return progress
+
+    def wait_free(self, n, poll=None):
+        """Blocks the producer until n slots are free. poll(timeout) is used
+        to sleep if given, e.g. to wait for control messages meanwhile"""
+        delay = MIN_DELAY
+        while self.free() < n:
+            if poll is not None:
+                poll(delay)
+            else:
+                time.sleep(delay)
+            delay = backoff(delay)
+
+    def close(self):
+        # plain memory is left to the garbage collector, the producer may
+        # still be writing to it
+        if self._shm is not None:
+            self.buf = None
+            self._shm.close()
+            if self._owner:
+                self._shm.unlink()
+            self._shm = None
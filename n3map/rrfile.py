@@ -6,6 +6,7 @@ from . import log
 from .rrtypes import nsec
 from .rrtypes import nsec3
 from . import rrtypes
+from . import util
 from .exception import (
         FileParseError,
         MaxDomainNameLengthError,
@@ -64,9 +65,21 @@ class RRFileStream(object):
         for k, v in stats.items():
             self.f.write("; " + str(k) + " = " + str(v) + '\n')
 
+    def write_cracked(self, cracked):
+        """Writes the owner names found for hashed owner names"""
+        self.f.write("\n;; cracked owner names\n")
+        for hashed_owner, owner in sorted(cracked.items()):
+            self.f.write("; " +
+                    util.base32_ext_hex_encode(hashed_owner).lower().decode() +
+                    " = " + str(owner) + '\n')
+
     def write_record(self, rr):
         self.f.write(str(rr) + '\n')
 
+    def write_records(self, rrs):
+        # streamed through the file buffer rather than joined in memory
+        self.f.writelines(str(rr) + '\n' for rr in rrs)
+
     def _desc_filename(self):
         return self.f.name
 
@@ -6,10 +6,12 @@ from .. import vis
 from ..exception import NSECError, ParseError
 
 class NSEC(rr.RR):
+    __slots__ = ('owner', 'next_owner', 'types')
+
     def __init__(self, owner, ttl, cls, next_owner, types):
         super(NSEC, self).__init__(owner, ttl, cls)
         self.next_owner = next_owner
-        self.types = types
+        self.types = rr.intern_types(types)
 
     def covers(self, dname):
         return dname.covered_by(self.owner, self.next_owner)
@@ -1,3 +1,4 @@
+import array
 import re
 import hashlib
 
@@ -32,6 +33,9 @@ def covered_by_nsec3_interval(nsec3_hash, hashed_owner, next_hashed_owner):
     return (nsec3_hash >= hashed_owner and nsec3_hash <= next_hashed_owner)
 
 class NSEC3(rr.RR):
+    __slots__ = ('hashed_owner', 'zone', '_algorithm', 'flags', '_iterations',
+            'salt', '_next_hashed_owner', 'types')
+
     def __init__(self, hashed_owner, ttl, cls, algorithm, flags, iterations,
             salt, next_hashed_owner, types):
         super(NSEC3, self).__init__(hashed_owner, ttl, cls)
@@ -40,7 +44,25 @@ class NSEC3(rr.RR):
         self.iterations = iterations
         self.salt = salt
         self.next_hashed_owner = next_hashed_owner
-        self.types = types
+        self.types = rr.intern_types(types)
+
+    @classmethod
+    def from_hashes(cls, hashed_owner, zone, ttl, rrclass, algorithm, flags,
+            iterations, salt, next_hashed_owner, types):
+        """Like NSEC3(), but takes the hashed owner as a digest and the zone
+        instead of the hashed owner name"""
+        nsec3 = cls.__new__(cls)
+        nsec3.hashed_owner = hashed_owner
+        nsec3.zone = zone
+        nsec3.ttl = ttl
+        nsec3.cls = rrclass
+        nsec3.algorithm = algorithm
+        nsec3.flags = flags
+        nsec3.iterations = iterations
+        nsec3.salt = salt
+        nsec3.next_hashed_owner = next_hashed_owner
+        nsec3.types = rr.intern_types(types)
+        return nsec3
 
     @property
     def owner(self):
@@ -104,8 +126,16 @@ class NSEC3(rr.RR):
     def covers_hash(self, nsec3_hash):
         return covered_by_nsec3_interval(nsec3_hash, self.hashed_owner, self.next_hashed_owner)
 
+    def _owner_text(self):
+        # the hashed owner label never needs escaping, unlike the labels
+        # which str(self.owner) would run through vis
+        label = util.base32_ext_hex_encode(self.hashed_owner).lower().decode()
+        if self.zone.is_root():
+            return label + '.'
+        return label + '.' + str(self.zone)
+
     def __str__(self):
-        return '\t'.join((super(NSEC3, self).__str__(),
+        return '\t'.join((self._owner_text(), str(self.ttl), self.cls,
             ' '.join(("NSEC3",
                       str(self.algorithm),
                       str(self.flags),
@@ -120,6 +150,69 @@ class NSEC3(rr.RR):
 
 
 
+class NSEC3List(object):
+    """A compact list of the NSEC3 records of a zone, e.g. those of an input
+    file.
+
+    The hashes are packed into two byte arrays and the other fields are
+    stored once for all records which share them, leaving a few dozen bytes
+    per record. NSEC3 objects are only built when iterating over the list."""
+
+    def __init__(self, zone):
+        self.zone = zone
+        self._hashed_owners = bytearray()
+        self._next_hashed_owners = bytearray()
+        # distinct (ttl, cls, algorithm, flags, iterations, salt, types)
+        self._fields = []
+        self._field_ids = {}
+        # index of the first record with the fields
+        self._first = []
+        self._record_fields = array.array('I')
+
+    def append(self, nsec3):
+        """Appends an NSEC3 record of the zone"""
+        fields = (nsec3.ttl, nsec3.cls, nsec3.algorithm, nsec3.flags,
+                nsec3.iterations, nsec3.salt, tuple(nsec3.types))
+        i = self._field_ids.get(fields)
+        if i is None:
+            i = self._field_ids[fields] = len(self._fields)
+            self._fields.append(fields)
+            self._first.append(len(self))
+        self._record_fields.append(i)
+        self._hashed_owners += nsec3.hashed_owner
+        self._next_hashed_owners += nsec3.next_hashed_owner
+
+    def __len__(self):
+        return len(self._record_fields)
+
+    def __getitem__(self, i):
+        ttl, cls, algorithm, flags, iterations, salt, types = self._fields[
+                self._record_fields[i]]
+        return NSEC3.from_hashes(
+                bytes(self._hashed_owners[i*SHA1_LENGTH:(i+1)*SHA1_LENGTH]),
+                self.zone, ttl, cls, algorithm, flags, iterations, salt,
+                bytes(self._next_hashed_owners[
+                    i*SHA1_LENGTH:(i+1)*SHA1_LENGTH]),
+                types)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def intervals(self):
+        """Yields the (hashed owner, next hashed owner) pairs of all records
+        without building NSEC3 objects"""
+        owners = bytes(self._hashed_owners)
+        next_owners = bytes(self._next_hashed_owners)
+        for i in range(0, len(owners), SHA1_LENGTH):
+            yield (owners[i:i + SHA1_LENGTH], next_owners[i:i + SHA1_LENGTH])
+
+    def prototypes(self):
+        """Returns a record for every distinct combination of the fields other
+        than the hashes"""
+        return [self[i] for i in self._first]
+
+
 def compute_hash(owner_name, salt, iterations, algorithm=SHA1):
     # see RFC5155 for details
     if not (algorithm & SHA1):
@@ -3,8 +3,22 @@ import re
 from .. import name
 from ..exception import ParseError
 
+_interned_types = {}
+
+def intern_types(types):
+    """Returns a list equal to types which is shared by all records with the
+    same types. The lists must not be modified."""
+    key = tuple(types)
+    shared = _interned_types.get(key)
+    if shared is None:
+        shared = _interned_types[key] = list(key)
+    return shared
+
+
 class RR(object):
     """General resource record"""
+    __slots__ = ('ttl', 'cls')
+
     def __init__(self, owner, ttl, cls):
         self.owner = owner
         self.ttl = ttl
@@ -56,6 +56,8 @@ def format_statusline_nsec3(width,
                 records,
                 hashes,
                 coverage,
+                gaps,
+                largest_gap,
                 queryrate,
                 prediction
             ):
@@ -117,8 +119,8 @@ def format_statusline_nsec3(width,
                 [ColorCode(cs.NUMBERS), "{0:3d}".format(prediction),
                     ColorCode(cs.RESET)],
                 ]
-    rightlabels = [['q/s'], ['coverage']]
-    rightshortlabels = [['q/s'], ['c']]
+    rightlabels = [['q/s'], ['coverage'], ['gaps'], ['largest gap']]
+    rightshortlabels = [['q/s'], ['c'], ['g'], ['lg']]
     rightvalues = [
             [ColorCode(cs.gradient(round(queryrate)/100.0)),
                 "{0:.0f}".format(queryrate),
@@ -126,6 +128,11 @@ def format_statusline_nsec3(width,
                 ],
             [ColorCode(cs.NUMBERS), "{0:11.6%}".format(coverage),
                 ColorCode(cs.RESET)],
+            [ColorCode(cs.NUMBERS), "{0:d}".format(gaps),
+                ColorCode(cs.RESET)],
+            # still moves when the coverage rounds to 100%
+            [ColorCode(cs.NUMBERS), "{0:.2e}".format(largest_gap),
+                ColorCode(cs.RESET)],
             ]
     left,right = compose_leftright(cs, leftlabels, leftvalues,
                                    rightlabels, rightvalues)
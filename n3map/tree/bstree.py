@@ -1,5 +1,6 @@
 class BSTreeNode(object):
     """Abstract implementation of a binary search tree node."""
+    __slots__ = ('key', 'value', 'left', 'right', 'parent')
 
     def __init__(self, k, v, nil=None):
         self.key =  k
@@ -35,6 +36,24 @@ class BSTree(object):
         return x if x is not self.nil else None
 
 
+    def floor(self, k):
+        """Finds the node with the largest key <= k. Returns None if there is
+        no such node.
+
+        Time complexity: O(lg n) (balanced)"""
+        x = self.root
+        y = self.nil
+        while x is not self.nil and k != x.key:
+            if k < x.key:
+                x = x.left
+            else:
+                y = x
+                x = x.right
+        if x is not self.nil:
+            y = x
+        return y if y is not self.nil else None
+
+
     def inorder(self, f):
         """Does an inorder traversal and calls f(x) for every node x.
 
@@ -0,0 +1,282 @@
+import abc
+import bisect
+import sys
+
+from ..exception import N3MapError
+
+HAS_NUMPY = False
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:
+    pass
+
+_HASH_MIN = b'\x00'*20
+_HASH_MAX = b'\xff'*20
+
+
+class CoverageIndex(abc.ABC):
+    """Answers covers() for the intervals of an NSEC3Tree.
+
+    The tree remains the authoritative store of the chain and detects
+    overlapping records. It tells its index about every interval it gains or
+    loses."""
+
+    def __init__(self, tree):
+        self.tree = tree
+
+    def add(self, start, end):
+        pass
+
+    def remove(self, start, end):
+        pass
+
+    @abc.abstractmethod
+    def covers(self, h):
+        """Returns True if h lies within one of the intervals"""
+
+    def memory_usage(self):
+        """Returns the bytes taken by the index beyond the tree"""
+        return 0
+
+    def covers_many(self, hashes, stride=20, offset=0):
+        """Returns the indices of the uncovered ones among the digests packed
+        into hashes, which are stride bytes apart starting at offset"""
+        covers = self.covers
+        return [i for i in range(_count(hashes, stride, offset))
+                if not covers(hashes[offset + i*stride:offset + i*stride + 20])]
+
+
+def _count(hashes, stride, offset):
+    if len(hashes) < offset + 20:
+        return 0
+    return (len(hashes) - offset - 20)//stride + 1
+
+
+class TreeIndex(CoverageIndex):
+    """Searches the NSEC3Tree itself, needs no extra memory"""
+
+    def covers(self, h):
+        return self.tree.find_interval(h) is not None
+
+
+class RadixIndex(CoverageIndex):
+    """Direct-addressed buckets over the top bits of the hash, each holding
+    the sorted starts and the ends of the intervals which overlap it.
+
+    An interval is entered into every bucket it overlaps. As the intervals of
+    a chain are disjoint, this adds up to at most one entry per interval plus
+    one per bucket. A lookup then is one bucket access and one bisect over
+    the few intervals of the bucket.
+
+    Unless bits is given, the index starts with MIN_BITS and adds GROW_BITS
+    (up to MAX_BITS) whenever the buckets hold more than BUCKET_LOAD
+    intervals on average, as the size of the chain is not known in
+    advance."""
+
+    MIN_BITS = 16
+    MAX_BITS = 24
+    GROW_BITS = 2
+    BUCKET_LOAD = 4
+
+    def __init__(self, tree, bits=None):
+        super(RadixIndex, self).__init__(tree)
+        self._adaptive = bits is None
+        self._num_pieces = 0
+        self.bits = 0
+        self._starts = []
+        self._ends = []
+        self._resize(self.MIN_BITS if bits is None else bits)
+        # intervals which cover the whole hash space (a single record)
+        self._full = 0
+
+    def _resize(self, bits):
+        """Distributes the intervals over 2**bits buckets"""
+        old_starts, old_ends = self._starts, self._ends
+        old_bits = self.bits
+        self.bits = bits
+        self._prefix_len = (bits + 7)//8
+        self._shift = 8*self._prefix_len - bits
+        self._starts = [None]*(1 << bits)
+        self._ends = [None]*(1 << bits)
+        for b, starts in enumerate(old_starts):
+            if starts is None:
+                continue
+            for piece_start, piece_end in zip(starts, old_ends[b]):
+                # a piece is in all buckets it overlaps, take it once
+                if self._bucket(piece_start) >> (bits - old_bits) == b:
+                    self._add_piece(piece_start, piece_end)
+
+    def _bucket(self, h):
+        return int.from_bytes(h[:self._prefix_len], 'big') >> self._shift
+
+    def _pieces(self, start, end):
+        if start < end:
+            return ((start, end),)
+        # the last interval wraps around
+        return ((start, _HASH_MAX), (_HASH_MIN, end))
+
+    def _add_piece(self, piece_start, piece_end):
+        for b in range(self._bucket(piece_start),
+                self._bucket(piece_end) + 1):
+            starts = self._starts[b]
+            if starts is None:
+                self._starts[b] = [piece_start]
+                self._ends[b] = [piece_end]
+                continue
+            i = bisect.bisect_left(starts, piece_start)
+            starts.insert(i, piece_start)
+            self._ends[b].insert(i, piece_end)
+
+    def add(self, start, end):
+        if start == end:
+            self._full += 1
+            return
+        for piece_start, piece_end in self._pieces(start, end):
+            self._add_piece(piece_start, piece_end)
+            self._num_pieces += 1
+        if (self._adaptive and self.bits < self.MAX_BITS and
+                self._num_pieces > self.BUCKET_LOAD << self.bits):
+            self._resize(min(self.MAX_BITS, self.bits + self.GROW_BITS))
+
+    def remove(self, start, end):
+        if start == end:
+            self._full -= 1
+            return
+        for piece_start, piece_end in self._pieces(start, end):
+            self._num_pieces -= 1
+            for b in range(self._bucket(piece_start),
+                    self._bucket(piece_end) + 1):
+                starts = self._starts[b]
+                i = bisect.bisect_left(starts, piece_start)
+                del starts[i]
+                del self._ends[b][i]
+
+    def memory_usage(self):
+        return (sys.getsizeof(self._starts) + sys.getsizeof(self._ends) +
+                sum(sys.getsizeof(l) for l in self._starts if l is not None) +
+                sum(sys.getsizeof(l) for l in self._ends if l is not None))
+
+    def covers(self, h):
+        if self._full > 0:
+            return True
+        b = int.from_bytes(h[:self._prefix_len], 'big') >> self._shift
+        starts = self._starts[b]
+        if starts is None:
+            return False
+        i = bisect.bisect_right(starts, h) - 1
+        return i >= 0 and h <= self._ends[b][i]
+
+
+class ArrayIndex(CoverageIndex):
+    """Wraps another index to answer covers_many() with NumPy.
+
+    The starts and ends of the intervals are kept interleaved in one sorted
+    array, so that a batch of hashes is looked up with a single vectorized
+    searchsorted(): a hash is covered iff an odd number of points lie at or
+    below it, or if it is the end of an interval.
+
+    New intervals are collected and merged into the array once they amount
+    to a fraction of it, which keeps the cost of the merges linear in the
+    size of the chain. Until then, the hashes which the array reports as
+    uncovered are checked with the wrapped index, which knows all intervals.
+    covers() is the one of the wrapped index."""
+
+    MERGE_MIN = 64
+    MERGE_FRACTION = 8
+
+    def __init__(self, tree, index):
+        super(ArrayIndex, self).__init__(tree)
+        self.index = index
+        # saves a call per lookup over covers() below
+        self.covers = index.covers
+        self._points = np.empty(0, dtype='S20')
+        self._pending = []
+        # the last interval wraps around, kept apart from the array
+        self._wrap = None
+        self._full = 0
+
+    def add(self, start, end):
+        self.index.add(start, end)
+        if start == end:
+            self._full += 1
+        elif start > end:
+            self._wrap = (start, end)
+        else:
+            self._pending.append((start, end))
+
+    def remove(self, start, end):
+        self.index.remove(start, end)
+        if start == end:
+            self._full -= 1
+        elif start > end:
+            self._wrap = None
+        elif (start, end) in self._pending:
+            self._pending.remove((start, end))
+        else:
+            i = self._find(start, end)
+            self._points = np.delete(self._points, (i, i + 1))
+
+    def covers(self, h):
+        return self.index.covers(h)
+
+    def memory_usage(self):
+        return (self.index.memory_usage() + self._points.nbytes +
+                sys.getsizeof(self._pending))
+
+    def _find(self, start, end):
+        """Returns the position of the interval start..end in the array"""
+        # the previous interval may end at start, so the last point equal to
+        # start is the one of the interval. Points are compared as 'S20',
+        # which drops trailing zero bytes.
+        pair = np.array((start, end), dtype='S20')
+        i = int(np.searchsorted(self._points, pair[0], side='right')) - 1
+        if i < 0 or i % 2 != 0 or not (self._points[i:i + 2] == pair).all():
+            raise CoverageIndexError("interval not in the coverage index")
+        return i
+
+    def _merge(self):
+        self._pending.sort()
+        new = np.array([h for interval in self._pending for h in interval],
+                dtype='S20')
+        # a new interval may start where an existing one ends, it goes after
+        # that end
+        positions = np.searchsorted(self._points, new[0::2], side='right')
+        self._points = np.insert(self._points, np.repeat(positions, 2), new)
+        self._pending = []
+
+    def covers_many(self, hashes, stride=20, offset=0):
+        count = _count(hashes, stride, offset)
+        if self._full > 0 or count == 0:
+            return []
+        if len(self._pending) >= max(self.MERGE_MIN,
+                len(self._points)//(2*self.MERGE_FRACTION)):
+            self._merge()
+        q = np.ndarray((count,), dtype='S20', buffer=hashes, offset=offset,
+                strides=(stride,))
+        points = self._points
+        if len(points) > 0:
+            i = np.searchsorted(points, q, side='right')
+            covered = (i & 1).astype(bool)
+            covered |= (i > 0) & (points[i - 1] == q)
+        else:
+            covered = np.zeros(count, dtype=bool)
+        if self._wrap is not None:
+            covered |= (q >= self._wrap[0]) | (q <= self._wrap[1])
+        uncovered = np.flatnonzero(~covered).tolist()
+        if len(self._pending) == 0:
+            return uncovered
+        covers = self.index.covers
+        return [i for i in uncovered
+                if not covers(hashes[offset + i*stride:offset + i*stride + 20])]
+
+
+class CoverageIndexError(N3MapError):
+    pass
+
+
+coverage_indexes = {
+        'tree' : TreeIndex,
+        'radix' : RadixIndex,
+    }
+
@@ -1,11 +1,17 @@
+import sys
+
 from . import rbtree
 from .. import log
 from ..exception import N3MapError
 
 class NSEC3TreeNode(rbtree.RBTreeNode):
+    __slots__ = ('int_end', 'gap')
+
     def __init__(self, k, v, int_end=None, nil=None):
         super(NSEC3TreeNode, self).__init__(k, v, nil)
         self.int_end = int_end
+        # the node of the gap following the interval in NSEC3Tree.gaps
+        self.gap = None
 
     def covers(self, k):
         if self.is_only():
@@ -31,6 +37,17 @@ class NSEC3TreeNode(rbtree.RBTreeNode):
         # 1 record covers entire zone
         return (self.key == self.int_end)
 
+# a gap is keyed by its size and start in one int, which orders like the
+# (size, start) pairs but takes less memory
+_GAP_START_BITS = 160
+
+def _gap_key(size, start):
+    return (size << _GAP_START_BITS) | start
+
+def _split_gap_key(key):
+    return (key >> _GAP_START_BITS,
+            (key & ((1 << _GAP_START_BITS) - 1)).to_bytes(20, "big"))
+
 class NSEC3Tree(rbtree.RBTree):
     def __init__(self, hash_max, node_type=NSEC3TreeNode):
         super(NSEC3Tree, self).__init__(node_type)
@@ -38,6 +55,12 @@ class NSEC3Tree(rbtree.RBTree):
         self.hash_max = hash_max
         self.covered_distance = int(0)
         self.ignore_overlapping = False
+        # a CoverageIndex which is kept up to date with the intervals
+        self.index = None
+        # the uncovered gaps between the intervals, keyed by their size and
+        # start packed into a single int (see _gap_key()) with the end as
+        # value
+        self.gaps = rbtree.RBTree()
 
     def find_interval(self, k):
         """Finds the node n for which n.key <= k <= n.int_end
@@ -75,8 +98,12 @@ class NSEC3Tree(rbtree.RBTree):
                             "zone may have changed")
             self.covered_distance += new.covered_distance(self.hash_max)
             self.covered_distance -= x.covered_distance(self.hash_max)
+            if self.index is not None:
+                self.index.remove(x.key, x.int_end)
+                self.index.add(new.key, new.int_end)
+            x.int_end = new.int_end
+            self._update_gap(x)
         x.value = new.value
-        x.int_end = new.int_end
 
     def _check_overlap(self, node):
         if self.ignore_overlapping:
@@ -97,6 +124,19 @@ class NSEC3Tree(rbtree.RBTree):
         if new is inserted:
             # node didn't already exist
             self.covered_distance += new.covered_distance(self.hash_max)
+            pre = self._cyclic_predecessor(new)
+            succ = self._cyclic_successor(new)
+            # adjacent intervals share the bytes object of their common
+            # bound, which saves one per record of a complete chain
+            if new.key == pre.int_end:
+                new.key = pre.int_end
+            if new.int_end == succ.key:
+                new.int_end = succ.key
+            if self.index is not None:
+                self.index.add(new.key, new.int_end)
+            self._update_gap(new)
+            if pre is not new:
+                self._update_gap(pre)
         else:
             was_updated = True
         new = inserted
@@ -107,14 +147,146 @@ class NSEC3Tree(rbtree.RBTree):
         self._check_overlap(new)
         return (new, was_updated)
 
+    def bulk_load(self, intervals):
+        """Fills the empty tree with intervals, (key, int_end) pairs sorted by
+        their distinct keys.
+
+        Time complexity: O(n), plus sorting the gaps by size"""
+        nodes = [self.node_type(k=k, v=None, int_end=int_end)
+                for k, int_end in intervals]
+        if len(nodes) == 0:
+            return
+        if not self.ignore_overlapping:
+            for i in range(len(nodes) - 1):
+                if nodes[i].int_end > nodes[i+1].key:
+                    raise OverLapError
+        self.load_sorted(nodes)
+        gaps = []
+        for i, node in enumerate(nodes):
+            succ = nodes[(i + 1) % len(nodes)]
+            if node.int_end == succ.key:
+                node.int_end = succ.key
+            self.covered_distance += node.covered_distance(self.hash_max)
+            if self.last is None and node.is_last():
+                self.last = node
+            if self.index is not None:
+                self.index.add(node.key, node.int_end)
+            node.gap = self._gap_node(node, succ)
+            if node.gap is not None:
+                gaps.append(node.gap)
+        gaps.sort(key=lambda g: g.key)
+        self.gaps.load_sorted(gaps)
+
     def delete(self, node):
+        pre = self._cyclic_predecessor(node)
+        if node.gap is not None:
+            self.gaps.delete(node.gap)
+            node.gap = None
         deleted = super(NSEC3Tree, self).delete(node)
+        if pre is not node:
+            self._update_gap(pre)
         if self.last is deleted:
             self.last = None
 
         self.covered_distance -= deleted.covered_distance(self.hash_max)
+        if self.index is not None:
+            self.index.remove(deleted.key, deleted.int_end)
 
         return deleted
 
+    def _cyclic_successor(self, node):
+        succ = self.successor(node)
+        return succ if succ is not None else self.minimum()
+
+    def _cyclic_predecessor(self, node):
+        pre = self.predecessor(node)
+        return pre if pre is not None else self.maximum()
+
+    def _update_gap(self, node):
+        """Enters the gap between the interval of node and the next one into
+        gaps, replacing the previous one"""
+        if node.gap is not None:
+            self.gaps.delete(node.gap)
+            node.gap = None
+        gap = self._gap_node(node, self._cyclic_successor(node))
+        if gap is not None:
+            node.gap = self.gaps.insert_node(gap)
+
+    def _gap_node(self, node, succ):
+        """Returns a node for the gap between node and its successor succ,
+        None if there is no gap"""
+        start = int.from_bytes(node.int_end, "big")
+        end = int.from_bytes(succ.key, "big")
+        if succ.key <= node.key and not node.is_last():
+            # the gap wraps around
+            end += self.hash_max + 1
+        # overlapping intervals leave no gap
+        if end <= start:
+            return None
+        return rbtree.RBTreeNode(k=_gap_key(end - start, start), v=succ.key,
+                nil=self.gaps.nil)
+
+    def _gap_tuple(self, g):
+        size, start = _split_gap_key(g.key)
+        return (size, start, g.value)
+
+    def memory_per_node(self, samples=1000):
+        """Estimates the bytes taken per node from a sample of the nodes,
+        their keys and their gaps"""
+        n = self.size()
+        if n == 0:
+            return 0
+        total = 0
+        ranks = range(0, n, max(1, n//samples))
+        for i in ranks:
+            node = self.select(i)
+            total += sys.getsizeof(node) + sys.getsizeof(node.key)
+            if node.int_end is not self._cyclic_successor(node).key:
+                total += sys.getsizeof(node.int_end)
+            if node.gap is not None:
+                total += sys.getsizeof(node.gap) + sys.getsizeof(node.gap.key)
+        return total/len(ranks)
+
+    def num_gaps(self):
+        return self.gaps.size()
+
+    def gap_at(self, i):
+        """Returns the gap of rank i by size, counting from the smallest, as
+        (size, start, end). start and end are the hashes bounding the gap.
+
+        Time complexity: O(lg n)"""
+        g = self.gaps.select(i)
+        if g is None:
+            return None
+        return self._gap_tuple(g)
+
+    def largest_gaps(self, n):
+        """Returns the n largest gaps, largest first, see gap_at()"""
+        gaps = []
+        if self.gaps.size() == 0:
+            return gaps
+        g = self.gaps.maximum()
+        while g is not None and len(gaps) < n:
+            gaps.append(self._gap_tuple(g))
+            g = self.gaps.predecessor(g)
+        return gaps
+
+    def gap_histogram(self):
+        """Returns the number of gaps by the bit length of their size, for
+        every bit length that occurs.
+
+        Time complexity: O(b lg n), one rank() for every bit length b up to
+        the one of the largest gap"""
+        histogram = {}
+        below = 0
+        for bits in range(1, self.hash_max.bit_length() + 2):
+            n = self.gaps.rank(_gap_key(1 << bits, 0))
+            if n > below:
+                histogram[bits] = n - below
+                below = n
+            if below == self.gaps.size():
+                break
+        return histogram
+
 class OverLapError(N3MapError):
     pass
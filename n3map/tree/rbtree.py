@@ -5,6 +5,7 @@ BLACK = 1
 
 class RBTreeNode(bstree.BSTreeNode):
     """A node of a Red-Black Tree"""
+    __slots__ = ('color', 'size')
 
     def __init__(self, k, v, nil=None):
         super(RBTreeNode, self).__init__(k, v, nil)
@@ -255,6 +256,63 @@ class RBTree(bstree.BSTree):
         return new
 
 
+    def load_sorted(self, nodes):
+        """Makes the tree hold nodes, which must be sorted by their distinct
+        keys, replacing its previous contents.
+
+        The tree is built balanced, with all nodes on its deepest level red
+        and all others black.
+        Time complexity: O(n)"""
+        red_depth = len(nodes).bit_length() - 1
+        if red_depth == 0:
+            red_depth = -1
+
+        def build(lo, hi, depth, parent):
+            if lo >= hi:
+                return self.nil
+            mid = (lo + hi)//2
+            x = nodes[mid]
+            x.parent = parent
+            x.left = build(lo, mid, depth + 1, x)
+            x.right = build(mid + 1, hi, depth + 1, x)
+            x.size = hi - lo
+            x.color = RED if depth == red_depth else BLACK
+            return x
+
+        self.root = build(0, len(nodes), 0, self.nil)
+
+    def select(self, i):
+        """Finds the node with the i-th smallest key, counting from 0.
+        Returns None if i is out of range.
+
+        Time complexity: O(lg n)"""
+        if i < 0 or i >= self.root.size:
+            return None
+        x = self.root
+        while True:
+            r = x.left.size
+            if i == r:
+                return x
+            if i < r:
+                x = x.left
+            else:
+                i -= r + 1
+                x = x.right
+
+    def rank(self, k):
+        """Returns the number of keys smaller than k.
+
+        Time complexity: O(lg n)"""
+        x = self.root
+        r = 0
+        while x is not self.nil:
+            if k <= x.key:
+                x = x.left
+            else:
+                r += x.left.size + 1
+                x = x.right
+        return r
+
     def size(self):
         """Returns the number of nodes stored in the tree.
 
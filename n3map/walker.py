@@ -68,11 +68,26 @@ class Walker(object):
         self._output_file = output_file
 
     def _write_chain(self, chain):
-        for record in chain:
-            print(record)
-            self._write_record(record)
+        """Writes the records read from an input file all at once"""
+        if self._output_file is None:
+            for record in chain:
+                self._store_record(record)
+            return
+        self._output_file.write_records(self._stored_records(chain))
+
+    def _stored_records(self, records):
+        """Stores the records while passing them on, so that they are
+        iterated only once"""
+        for record in records:
+            self._store_record(record)
+            yield record
 
     def _write_record(self, record):
+        self._store_record(record)
+        if self._output_file is not None:
+            self._output_file.write_record(record)
+
+    def _store_record(self, record):
         if hasattr(db, 'database'):
             if hasattr(db.database, 'conn'):
                 if hasattr(record, 'hashed_owner'):
@@ -97,9 +112,6 @@ class Walker(object):
                             next_owner = str(record.next_owner),
                             types = record.types)
 
-        if self._output_file is not None:
-            self._output_file.write_record(record)
-
     def _write_number_of_records(self, num):
         if self._output_file is not None:
             self._output_file.write_number_of_rrs(num)
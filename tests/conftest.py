@@ -0,0 +1,9 @@
+import pytest
+
+from n3map import log
+
+
+@pytest.fixture(autouse=True)
+def logger():
+    log.logger = log.Logger()
+    yield log.logger
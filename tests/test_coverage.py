@@ -0,0 +1,65 @@
+import random
+
+import pytest
+
+from n3map import coverage
+from n3map.coverage import CoverageSnapshotReader, CoverageSnapshotWriter
+
+
+def h(i):
+    return i.to_bytes(20, 'big')
+
+class FakeChain(object):
+    def __init__(self, intervals):
+        self.intervals = intervals
+
+    def packed_intervals(self):
+        return b''.join(h(s) + h(e) for s, e in self.intervals)
+
+    def size(self):
+        return len(self.intervals)
+
+def test_snapshot_roundtrip():
+    writer = CoverageSnapshotWriter(capacity=2)
+    reader = CoverageSnapshotReader(writer.name)
+    try:
+        writer.publish(FakeChain([(10, 20)]))
+        reader.refresh()
+        assert reader.covers(h(15)) and not reader.covers(h(25))
+        # outgrows the segment, the reader must attach to the new one
+        chain = FakeChain([(10, 20), (30, 40), (50, 5)])
+        assert writer.publish(chain)
+        reader.attach(writer.name)
+        reader.refresh()
+        assert [reader.covers(h(i)) for i in (3, 8, 35, 45, 60)] == [
+                True, False, True, False, True]
+    finally:
+        reader.close()
+        writer.close()
+
+@pytest.mark.parametrize('numpy', [True, False])
+@pytest.mark.parametrize('wrap', [True, False])
+def test_covers_many_matches_covers(monkeypatch, numpy, wrap):
+    if not numpy:
+        monkeypatch.setattr(coverage, 'HAS_NUMPY', False)
+    rnd = random.Random(5)
+    points = sorted(rnd.getrandbits(160) for i in range(400))
+    # digests with trailing zero bytes, which 'S20' arrays drop
+    points = [p & ~0xffff if i % 7 == 0 else p for i, p in enumerate(points)]
+    intervals = [(points[i], points[i + 1]) for i in range(0, 400, 2)]
+    if wrap:
+        intervals[-1] = (intervals[-1][0], points[0] // 2)
+    writer = CoverageSnapshotWriter()
+    reader = CoverageSnapshotReader(writer.name)
+    try:
+        writer.publish(FakeChain(intervals))
+        reader.refresh()
+        queries = points + [rnd.getrandbits(160) for i in range(500)] + [0,
+                2**160 - 1]
+        packed = b''.join(b'hdr' + h(q) for q in queries)
+        expected = [i for i, q in enumerate(queries)
+                if not reader.covers(h(q))]
+        assert reader.covers_many(packed, 23, 3) == expected
+    finally:
+        reader.close()
+        writer.close()
@@ -0,0 +1,113 @@
+import random
+import secrets
+
+import pytest
+
+from n3map.tree.nsec3tree import NSEC3Tree
+from n3map.tree import coverageindex
+from n3map.tree.coverageindex import ArrayIndex, RadixIndex, TreeIndex
+
+pytestmark = pytest.mark.skipif(not coverageindex.HAS_NUMPY,
+        reason="numpy is not available")
+
+
+def h(i):
+    return i.to_bytes(20, 'big')
+
+def make_tree(intervals):
+    tree = NSEC3Tree(hash_max=2**160-1)
+    tree.index = ArrayIndex(tree, RadixIndex(tree))
+    for start, end in intervals:
+        tree.insert(h(start), None, h(end))
+    return tree
+
+def uncovered(tree, values):
+    return tree.index.covers_many(b''.join(h(v) for v in values))
+
+def test_update_of_adjacent_interval():
+    tree = make_tree([(10, 20), (20, 30), (40, 50)])
+    # merge the intervals into the array
+    tree.index._merge()
+    tree.insert(h(20), None, h(25))
+    assert not tree.index.covers(h(27))
+    assert uncovered(tree, [27]) == [0]
+    assert uncovered(tree, [15, 20, 25, 45]) == []
+
+def test_remove_digests_with_trailing_zeros():
+    # NumPy drops the trailing zero bytes of 'S20' values
+    tree = make_tree([(0x100, 0x200), (0x200, 0x300), (0x400, 0x500)])
+    tree.index._merge()
+    tree.delete(tree.find(h(0x200)))
+    assert uncovered(tree, [0x280, 0x180, 0x200]) == [0]
+
+def test_covers_many_matches_covers():
+    points = sorted(secrets.token_bytes(20) for i in range(400))
+    intervals = [(int.from_bytes(points[i], 'big'),
+        int.from_bytes(points[i+1], 'big')) for i in range(0, 400, 2)]
+    tree = make_tree(intervals)
+    tree.index._merge()
+    for start, end in intervals[::3]:
+        tree.delete(tree.find(h(start)))
+    queries = [int.from_bytes(secrets.token_bytes(20), 'big')
+            for i in range(2000)]
+    queries += [p for interval in intervals for p in interval]
+    expected = [i for i, q in enumerate(queries)
+            if not tree.index.covers(h(q))]
+    assert uncovered(tree, queries) == expected
+
+def test_radix_index_grows(monkeypatch):
+    monkeypatch.setattr(RadixIndex, 'MIN_BITS', 4)
+    monkeypatch.setattr(RadixIndex, 'MAX_BITS', 10)
+    points = sorted(secrets.randbits(160) for i in range(4000))
+    tree = NSEC3Tree(hash_max=2**160-1)
+    tree.index = RadixIndex(tree)
+    for i in range(0, len(points), 2):
+        tree.insert(h(points[i]), None, h(points[i + 1]))
+    assert tree.index.bits == 10
+    reference = TreeIndex(tree)
+    for i in range(2000):
+        x = h(secrets.randbits(160))
+        assert tree.index.covers(x) == reference.covers(x)
+    for p in points[:50]:
+        assert tree.index.covers(h(p))
+
+def test_merge_adjacent_into_array():
+    tree = make_tree([(10, 20)])
+    tree.index._merge()
+    tree.insert(h(20), None, h(30))
+    tree.insert(h(5), None, h(10))
+    tree.index._merge()
+    points = tree.index._points
+    assert (points[:-1] <= points[1:]).all()
+    assert uncovered(tree, [7, 10, 15, 20, 25, 30, 31, 4]) == [6, 7]
+    # removes the right intervals among the shared points
+    tree.delete(tree.find(h(20)))
+    assert uncovered(tree, [15, 25]) == [1]
+    tree.insert(h(10), None, h(12))
+    assert uncovered(tree, [11, 15]) == [1]
+
+def test_walk_order_matches_covers():
+    rnd = random.Random(3)
+    points = sorted(rnd.getrandbits(160) for i in range(600))
+    # a walk mostly learns intervals which share points with known ones
+    intervals = [(points[i], points[i + 1]) for i in range(len(points) - 1)]
+    rnd.shuffle(intervals)
+    tree = make_tree([])
+    queries = [rnd.getrandbits(160) for i in range(200)] + points
+    for k, (start, end) in enumerate(intervals):
+        tree.insert(h(start), None, h(end))
+        if k % 37 == 0:
+            expected = [i for i, q in enumerate(queries)
+                    if not tree.index.covers(h(q))]
+            assert uncovered(tree, queries) == expected
+    for start, end in intervals[::5]:
+        tree.insert(h(start), None, h((start + end)//2))
+    expected = [i for i, q in enumerate(queries)
+            if not tree.index.covers(h(q))]
+    assert uncovered(tree, queries) == expected
+
+def test_remove_missing_interval_raises():
+    tree = make_tree([(10, 20), (30, 40)])
+    tree.index._merge()
+    with pytest.raises(coverageindex.CoverageIndexError):
+        tree.index.remove(h(10), h(40))
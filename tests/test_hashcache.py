@@ -0,0 +1,83 @@
+import hashlib
+
+from n3map import hashcache
+from n3map import name
+
+ZONE = name.fqdn_from_text('example.com')
+SALT = b'\xab'
+
+
+def fake_hash_range(calls):
+    def hash_range(start, count):
+        calls.append((start, count))
+        return b''.join(hashlib.sha1(i.to_bytes(8, 'big')).digest()
+                for i in range(start, start + count))
+    return hash_range
+
+def open_cache(filename, iterations=1, encoding='hex'):
+    hashcache.prepare(filename, ZONE, SALT, iterations, encoding)
+    return hashcache.HashCache(filename, ZONE, SALT, iterations, encoding, 1)
+
+def test_runs_read_back(tmp_path):
+    filename = str(tmp_path / 'cache')
+    calls = []
+    cache = open_cache(filename)
+    hash_range = cache.hash_range_func(fake_hash_range(calls))
+    first = hash_range(100, 10)
+    second = hash_range(200, 5)
+    cache.close()
+    assert hashcache.prepare(filename, ZONE, SALT, 1, 'hex') == 15
+    cache = open_cache(filename)
+    assert [r[:2] for r in cache.runs] == [(100, 10), (200, 5)]
+    hash_range = cache.hash_range_func(fake_hash_range(calls))
+    assert bytes(hash_range(100, 10)) == first
+    assert bytes(hash_range(203, 2)) == second[60:]
+    assert len(calls) == 2
+    # only partly cached, hashed again
+    hash_range(105, 10)
+    assert calls[-1] == (105, 10)
+    cache.close()
+
+def test_uncached_parts(tmp_path):
+    filename = str(tmp_path / 'cache')
+    cache = open_cache(filename)
+    hash_range = cache.hash_range_func(fake_hash_range([]))
+    hash_range(10, 10)
+    hash_range(30, 10)
+    cache.close()
+    cache = open_cache(filename)
+    assert list(cache.uncached(0, 50)) == [(0, 10), (20, 10), (40, 10)]
+    assert list(cache.uncached(12, 5)) == []
+    assert list(cache.uncached(15, 20)) == [(20, 10)]
+    assert list(cache.ranges(iter([(0, 25)]), 0, 1)) == [(10, 10), (30, 10),
+            (0, 10), (20, 5)]
+    cache.close()
+
+def test_truncated_run_dropped(tmp_path):
+    filename = str(tmp_path / 'cache')
+    cache = open_cache(filename)
+    hash_range = cache.hash_range_func(fake_hash_range([]))
+    hash_range(0, 10)
+    hash_range(10, 10)
+    cache.close()
+    with open(filename, 'r+b') as f:
+        f.truncate(f.seek(0, 2) - 7)
+    size = len(hashcache._header(ZONE, SALT, 1, 'hex'))
+    assert hashcache.prepare(filename, ZONE, SALT, 1, 'hex') == 10
+    with open(filename, 'rb') as f:
+        assert len(f.read()) == size + hashcache._run_header.size + 200
+    cache = open_cache(filename)
+    assert [r[:2] for r in cache.runs] == [(0, 10)]
+    cache.close()
+
+def test_other_parameters_replace_cache(tmp_path):
+    filename = str(tmp_path / 'cache')
+    cache = open_cache(filename)
+    cache.hash_range_func(fake_hash_range([]))(0, 10)
+    cache.close()
+    assert hashcache.prepare(filename, ZONE, SALT, 2, 'hex') == 0
+    assert hashcache.prepare(filename, ZONE, SALT, 2, 'hex') == 0
+    assert hashcache.prepare(filename, ZONE, SALT, 1, 'hex') == 0
+    cache = open_cache(filename, encoding='b32')
+    assert cache.runs == []
+    cache.close()
@@ -0,0 +1,67 @@
+import multiprocessing.connection
+import socket
+import time
+
+from n3map import hashworker
+
+KEY = b'secret'
+
+
+def listener(monkeypatch, timeout):
+    monkeypatch.setattr(hashworker, 'HANDSHAKE_TIMEOUT', timeout)
+    return hashworker.HashWorkerListener('127.0.0.1:0', KEY, 1, 4)
+
+def address(listener):
+    return listener._listener.address
+
+def wait_accepted(listener, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while listener._accepted.empty() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return not listener._accepted.empty()
+
+def test_handshake(monkeypatch):
+    l = listener(monkeypatch, 5.0)
+    try:
+        client = multiprocessing.connection.Client(address(l), authkey=KEY)
+        assert wait_accepted(l)
+        conn = l._accepted.get()
+        # no timeout left once the worker is in
+        conn.send_bytes(b'x')
+        assert client.recv_bytes() == b'x'
+        client.close()
+        conn.close()
+    finally:
+        l.close()
+
+def test_idle_client_dropped(monkeypatch):
+    l = listener(monkeypatch, 0.2)
+    try:
+        with socket.create_connection(address(l)) as sock:
+            sock.settimeout(5.0)
+            # the challenge, then the end of the connection
+            data = sock.recv(4096)
+            while True:
+                more = sock.recv(4096)
+                if more == b'':
+                    break
+                data += more
+            assert len(data) > 0
+        assert not wait_accepted(l, 0.1)
+    finally:
+        l.close()
+
+def test_accept_errors_back_off(monkeypatch):
+    l = listener(monkeypatch, 5.0)
+    calls = []
+    def accept():
+        calls.append(time.monotonic())
+        raise OSError(24, 'Too many open files')
+    try:
+        # the thread is already blocked in the real accept, wake it up
+        monkeypatch.setattr(l._listener, 'accept', accept)
+        multiprocessing.connection.Client(address(l), authkey=KEY).close()
+        time.sleep(0.5)
+        assert 2 <= len(calls) <= 8
+    finally:
+        l.close()
@@ -0,0 +1,104 @@
+import itertools
+
+import pytest
+
+from n3map import name
+from n3map import prehash
+from n3map import util
+from n3map.rrtypes import nsec3
+
+
+ZONES = ['example.com.', 'a-rather-long-zone-name-to-cross-the-sha1-block.'
+        'example.org.']
+SALT_LENGTHS = [0, 1, 35, 36, 255]
+ITERATIONS = [0, 1, 100]
+# a few counters around changes of the label length, and a count which is
+# no multiple of the SIMD lanes
+STARTS = [0, 0xfff8, 1 << 40]
+COUNT = 19
+
+
+def expected_hashes(label_fun, zone, salt, iterations, start, count):
+    return b''.join(nsec3.compute_hash(name.DomainName(
+        name.Label(label_fun(l)), *zone.labels), salt, iterations)
+        for l in range(start, start + count))
+
+@pytest.mark.parametrize('backend', list(prehash.hash_backends))
+@pytest.mark.parametrize('encoding', sorted(name.label_encodings))
+@pytest.mark.parametrize('salt_length', SALT_LENGTHS)
+@pytest.mark.parametrize('iterations', ITERATIONS)
+def test_backend_known_answers(backend, encoding, salt_length, iterations):
+    hash_backend = prehash.hash_backends[backend]
+    label_fun = name.label_encodings[encoding]
+    if not hash_backend.supports(label_fun):
+        pytest.skip("{} does not support {} labels".format(backend, encoding))
+    salt = bytes(range(salt_length))
+    for zone_text, start in itertools.product(ZONES, STARTS):
+        zone = name.fqdn_from_text(zone_text)
+        hash_range = hash_backend.hash_range_func(label_fun, zone, salt,
+                iterations)
+        assert hash_range(start, COUNT) == expected_hashes(label_fun, zone,
+                salt, iterations, start, COUNT), (zone_text, start)
+
+# names of different lengths, so that a group of lanes mixes numbers of
+# SHA-1 blocks
+WORDS = ['www', 'mail', 'a', 'x'*63, 'ftp.internal', 'a.b.c.d.e', 'ns1',
+        'y'*40 + '.' + 'z'*40, 'vpn', 'intranet', 'dev', 'Mixed-Case', 'git',
+        'wiki', 'smtp', 'pop3', 'imap', 'ldap', 'cdn']
+
+@pytest.mark.parametrize('backend', list(prehash.hash_backends))
+@pytest.mark.parametrize('salt_length', SALT_LENGTHS)
+@pytest.mark.parametrize('iterations', ITERATIONS)
+def test_backend_names_known_answers(backend, salt_length, iterations):
+    zone = name.fqdn_from_text(ZONES[0])
+    names = [name.DomainName(*name.domainname_from_text(w).labels,
+        *zone.labels) for w in WORDS]
+    salt = bytes(range(salt_length))
+    hash_names = prehash.hash_backends[backend].hash_names_func(salt,
+            iterations)
+    assert hash_names(names) == b''.join(nsec3.compute_hash(dn, salt,
+        iterations) for dn in names)
+    assert hash_names([]) == b''
+
+@pytest.mark.skipif(not prehash.HAS_NSEC3HASH,
+        reason="the nsec3hash extension is not built")
+def test_compute_names_rejects_invalid_names():
+    from n3map import nsec3hash
+    for names_wire in (b'\x03www', b'\x03www\x07example', b'\xc0\x0c',
+            b'\x3f' + b'a'*63 + b'\x3f' + b'a'*63 + b'\x3f' + b'a'*63 +
+            b'\x3f' + b'a'*63 + b'\x00'):
+        with pytest.raises(ValueError):
+            nsec3hash.compute_names(names_wire, b'', 0)
+
+@pytest.mark.skipif(not prehash.HAS_NSEC3HASH,
+        reason="the nsec3hash extension is not built")
+def test_compute_hash():
+    from n3map import nsec3hash
+    dn = name.fqdn_from_text('www.example.com.')
+    for salt_length, iterations in itertools.product(SALT_LENGTHS,
+            ITERATIONS):
+        salt = bytes(range(salt_length))
+        assert (nsec3hash.compute_hash(dn.to_wire(), salt, iterations) ==
+                nsec3.compute_hash(dn, salt, iterations))
+
+def test_rfc5155_example():
+    # RFC 5155, appendix A
+    dn = name.fqdn_from_text('example.')
+    assert nsec3.compute_hash(dn, bytes.fromhex('aabbccdd'), 12) == \
+            util.base32_ext_hex_decode(b'0p9mhaveqvm6t7vbl5lop2u3t2rp3tom')
+
+@pytest.mark.skipif(not prehash.HAS_NSEC3HASH,
+        reason="the nsec3hash extension is not built")
+def test_compute_hashes_rejects_invalid_ranges():
+    from n3map import nsec3hash
+    zone = name.fqdn_from_text(ZONES[0]).to_wire()
+    for start, count in ((-1, 1), (1 << 64, 1), ((1 << 64) - 1, 2),
+            (0, -1)):
+        with pytest.raises(ValueError):
+            nsec3hash.compute_hashes(start, count, zone, b'', 0)
+    with pytest.raises(ValueError):
+        nsec3hash.compute_hashes(0, 1, zone, b'', -1)
+    last = (1 << 64) - 1
+    assert nsec3hash.compute_hashes(last, 1, zone, b'', 0) == \
+            nsec3.compute_hash(name.DomainName(name.Label(name.hex_label(last)),
+                *name.fqdn_from_text(ZONES[0]).labels), b'', 0)
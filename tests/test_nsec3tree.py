@@ -0,0 +1,97 @@
+import random
+
+import pytest
+
+from n3map.tree import rbtree
+from n3map.tree.nsec3tree import NSEC3Tree
+
+HASH_MAX = 2**160 - 1
+
+
+def h(i):
+    return i.to_bytes(20, 'big')
+
+def random_tree(n, seed):
+    rnd = random.Random(seed)
+    points = sorted({rnd.getrandbits(160) for i in range(2*n)})
+    n = len(points)//2
+    tree = NSEC3Tree(hash_max=HASH_MAX)
+    gaps = []
+    for i in range(n):
+        start, end = points[2*i], points[2*i + 1]
+        tree.insert(h(start), None, h(end))
+        following = points[(2*i + 2) % (2*n)]
+        gaps.append((following - end) % (HASH_MAX + 1))
+    return tree, sorted(gaps)
+
+def test_gaps_match_intervals():
+    tree, gaps = random_tree(200, 1)
+    assert tree.num_gaps() == len(gaps)
+    assert [tree.gap_at(i)[0] for i in range(len(gaps))] == gaps
+    assert [g[0] for g in tree.largest_gaps(5)] == gaps[::-1][:5]
+
+def test_gap_histogram():
+    tree, gaps = random_tree(200, 2)
+    histogram = {}
+    for size in gaps:
+        histogram[size.bit_length()] = histogram.get(size.bit_length(), 0) + 1
+    assert tree.gap_histogram() == histogram
+
+def check_rb(tree):
+    """Checks the red-black properties, the subtree sizes and the order of
+    tree and returns its keys in order"""
+    nil = tree.nil
+    keys = []
+
+    def walk(x):
+        # returns the black height of the subtree at x
+        if x is nil:
+            return 1
+        if x.color == rbtree.RED:
+            assert x.left.color == rbtree.BLACK
+            assert x.right.color == rbtree.BLACK
+        for child in (x.left, x.right):
+            if child is not nil:
+                assert child.parent is x
+        left = walk(x.left)
+        keys.append(x.key)
+        right = walk(x.right)
+        assert left == right
+        assert x.size == 1 + x.left.size + x.right.size
+        return left + (x.color == rbtree.BLACK)
+
+    assert tree.root.color == rbtree.BLACK
+    assert tree.root.parent is nil
+    walk(tree.root)
+    assert keys == sorted(keys)
+    return keys
+
+@pytest.mark.parametrize('n', list(range(1, 34)) + [63, 64, 65, 127, 1000])
+def test_load_sorted_coloring(n):
+    tree = rbtree.RBTree()
+    tree.load_sorted([tree.node_type(k, None) for k in range(n)])
+    assert check_rb(tree) == list(range(n))
+    assert tree.root.size == n
+
+def test_bulk_load_matches_inserts():
+    rnd = random.Random(4)
+    points = sorted({rnd.getrandbits(160) for i in range(600)})
+    intervals = [(h(points[i]), h(points[i + 1]))
+            for i in range(0, len(points) - 1, 2)]
+    loaded = NSEC3Tree(hash_max=HASH_MAX)
+    loaded.bulk_load(intervals)
+    inserted = NSEC3Tree(hash_max=HASH_MAX)
+    for start, end in intervals:
+        inserted.insert(start, None, end)
+    assert check_rb(loaded) == [k for k, e in intervals]
+    check_rb(loaded.gaps)
+    assert loaded.covered_distance == inserted.covered_distance
+    assert ([loaded.gap_at(i)[0] for i in range(loaded.num_gaps())] ==
+            [inserted.gap_at(i)[0] for i in range(inserted.num_gaps())])
+    # the fixups of later changes start from the loaded coloring
+    for start, end in intervals[::3]:
+        loaded.delete(loaded.find(start))
+    for i in range(0, len(points) - 1, 6):
+        loaded.insert(h(points[i]), None, h((points[i] + points[i + 1])//2))
+    check_rb(loaded)
+    check_rb(loaded.gaps)
@@ -0,0 +1,34 @@
+import pytest
+
+from n3map import name
+from n3map import prehash
+
+ZONE = name.fqdn_from_text('example.com')
+
+
+@pytest.mark.parametrize('length,blocks', [(0, 1), (55, 1), (56, 2),
+    (119, 2), (120, 3)])
+def test_sha1_blocks(length, blocks):
+    assert prehash.sha1_blocks(length) == blocks
+
+def input_length(encoding, salt, last):
+    return (len(ZONE.to_wire()) + 1 + len(salt) +
+            len(name.label_encodings[encoding](last)))
+
+def test_hex_preferred():
+    assert prehash.choose_label_encoding(ZONE, b'') == ('hex', 1)
+    # both need two blocks
+    assert prehash.choose_label_encoding(ZONE, b'\0'*40) == ('hex', 2)
+
+@pytest.mark.parametrize('salt_length', [31, 32])
+def test_b32_saves_a_block(salt_length):
+    salt = b'\0'*salt_length
+    last = prehash.LABEL_COUNTER_RANGE
+    assert prehash.sha1_blocks(input_length('hex', salt, last)) == 2
+    assert prehash.choose_label_encoding(ZONE, salt) == ('b32', 1)
+
+def test_label_counter_init():
+    salt = b'\0'*30
+    assert prehash.choose_label_encoding(ZONE, salt) == ('hex', 1)
+    # longer labels for counters further on
+    assert prehash.choose_label_encoding(ZONE, salt, 1 << 45) == ('b32', 1)
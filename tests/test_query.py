@@ -0,0 +1,227 @@
+import socket
+import struct
+import threading
+
+import dns.exception
+import dns.flags
+import dns.message
+import dns.rcode
+import dns.rrset
+import pytest
+
+from n3map import name
+from n3map import query
+
+ZONE = 'example.com.'
+NSEC3_OWNER = '0p9mhaveqvm6t7vbl5lop2u3t2rp3tom.example.com.'
+NSEC3_RDATA = '1 0 10 aabbccdd 2t7b4g4vsa5smi47k61mv5bv1a22bojr A RRSIG'
+RRSIG_RDATA = ('NSEC3 8 3 300 20300101000000 20200101000000 12345 '
+        'example.com. dGVzdA==')
+
+
+def make_request(qname='www.example.com.', rrtype='A', msg_id=1234):
+    dname = name.fqdn_from_text(qname)
+    return query.query_wire(dname, rrtype, msg_id)
+
+def make_response(request, answer=(), authority=(), rcode=dns.rcode.NXDOMAIN,
+        tc=False):
+    msg = dns.message.make_response(dns.message.from_wire(request))
+    msg.set_rcode(rcode)
+    for section, rrsets in ((msg.answer, answer), (msg.authority, authority)):
+        for owner, ttl, rrtype, rdata in rrsets:
+            section.append(dns.rrset.from_text(owner, ttl, 'IN', rrtype,
+                rdata))
+    if tc:
+        msg.flags |= dns.flags.TC
+    return msg.to_wire()
+
+def nsec3_response(request):
+    return make_response(request, authority=[
+        (ZONE, 300, 'SOA', 'ns.example.com. hostmaster.example.com. '
+            '1 7200 3600 1209600 300'),
+        (NSEC3_OWNER, 300, 'NSEC3', NSEC3_RDATA),
+        (NSEC3_OWNER, 300, 'RRSIG', RRSIG_RDATA),
+    ])
+
+def summary(res):
+    """Returns everything the walkers read from a result"""
+    nsec3_owner = name.fqdn_from_text(NSEC3_OWNER)
+    return (res.status(), res.answer_length(),
+            str(res.find_SOA(True)), str(res.find_SOA(False)),
+            str(res.find_NS(True)), str(res.find_NS(False)),
+            str(res.find_DNSKEY()),
+            str(res.find_RRSIG_signer(nsec3_owner, 'NSEC3', False)),
+            [str(rr) for rr in res.find_NSEC3()],
+            [str(rr) for rr in res.all_NSEC_rrs()])
+
+def assert_same_result(wire):
+    res = query.decode_response(wire)
+    assert isinstance(res, query.WireResult)
+    assert summary(res) == summary(
+            query.DNSPythonResult(dns.message.from_wire(wire)))
+    return res
+
+def test_nsec3_response_matches_dnspython():
+    res = assert_same_result(nsec3_response(make_request()))
+    assert len(res.find_NSEC3()) == 1
+    assert res.status() == 'NXDOMAIN'
+
+def test_nsec_response_matches_dnspython():
+    request = make_request('b.example.com.', 'A')
+    wire = make_response(request, rcode=dns.rcode.NOERROR, answer=[
+        ('b.example.com.', 300, 'NSEC', 'c.example.com. A NS SOA RRSIG'),
+        ('b.example.com.', 300, 'NS', 'ns.example.com.'),
+    ], authority=[
+        ('a.example.com.', 300, 'NSEC', 'b.example.com. TXT TYPE1234'),
+    ])
+    res = assert_same_result(wire)
+    assert len(list(res.all_NSEC_rrs())) == 2
+
+def test_compression_pointers():
+    wire = nsec3_response(make_request())
+    # dnspython compresses the owners of the authority section
+    assert b'\xc0' in wire[len(make_request()):]
+    assert_same_result(wire)
+
+def test_forward_compression_pointer_rejected():
+    request = make_request()
+    wire = bytearray(nsec3_response(request))
+    qname_end = 12 + len(name.fqdn_from_text('www.example.com.').to_wire())
+    # replace the end of the qname with a pointer to the answer
+    wire[qname_end - 1:qname_end] = b'\xc0'
+    wire.insert(qname_end, 40)
+    with pytest.raises(dns.exception.DNSException):
+        query.decode_response(bytes(wire))
+
+def test_truncated_rdata():
+    wire = nsec3_response(make_request())
+    # drop the OPT record and the end of the RRSIG before it
+    opt_len = len(query._OPT_RR) + 2
+    wire = wire[:10] + b'\x00\x00' + wire[12:-opt_len - 3]
+    with pytest.raises(ValueError, match='truncated rdata'):
+        query.WireResult(wire)
+    with pytest.raises(dns.exception.DNSException):
+        query.decode_response(wire)
+
+def test_malformed_nsec3_rdata():
+    wire = make_response(make_request(), authority=[
+        (NSEC3_OWNER, 300, 'NSEC3', NSEC3_RDATA)])
+    # shorten the rdata to end within the next hashed owner
+    pos = wire.index(bytes.fromhex('0100000a04aabbccdd'))
+    rdlen = struct.unpack_from('!H', wire, pos - 2)[0]
+    cut = wire[:pos - 2] + struct.pack('!H', 12) + wire[pos:pos + 12]
+    assert rdlen > 12
+    with pytest.raises(ValueError):
+        query.WireResult(cut)
+    with pytest.raises(dns.exception.DNSException):
+        query.decode_response(cut)
+
+def test_extended_rcode():
+    msg = dns.message.make_response(dns.message.from_wire(make_request()))
+    msg.set_rcode(dns.rcode.BADVERS)
+    res = assert_same_result(msg.to_wire())
+    assert res.status() == 'BADVERS'
+
+def test_response_matches():
+    request = make_request('www.Example.com.')
+    wire = nsec3_response(request)
+    assert query.response_matches(wire, request)
+    # the case of the qname may differ
+    assert query.response_matches(wire, make_request('WWW.example.COM.'))
+    assert not query.response_matches(wire, make_request(msg_id=4321))
+    assert not query.response_matches(wire, make_request('xxx.example.com.'))
+    assert not query.response_matches(wire,
+            make_request('www.example.com.', 'NS'))
+    # a query is not a response
+    assert not query.response_matches(request, request)
+    for wire in (nsec3_response(request), make_response(request)):
+        msg = dns.message.from_wire(wire)
+        assert (query.response_matches(wire, request) ==
+                dns.message.from_wire(request).is_response(msg))
+
+def test_response_without_question():
+    request = make_request()
+    header = request[:2] + struct.pack('!HHHHH', 0x8000 | dns.rcode.FORMERR,
+            0, 0, 0, 0)
+    assert query.response_matches(header, request)
+    header = request[:2] + struct.pack('!HHHHH', 0x8000, 0, 0, 0, 0)
+    assert not query.response_matches(header, request)
+
+
+class FakeServer(object):
+    """Answers the queries on a UDP and a TCP socket of the loopback
+    interface with the replies of udp_reply() and tcp_reply()"""
+
+    def __init__(self, udp_reply, tcp_reply=None):
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.bind(('127.0.0.1', 0))
+        self.port = self.udp.getsockname()[1]
+        self.tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.tcp.bind(('127.0.0.1', self.port))
+        self.tcp.listen(1)
+        self.tcp_queries = 0
+        self._threads = [
+                threading.Thread(target=self._serve_udp, args=(udp_reply,),
+                    daemon=True),
+                threading.Thread(target=self._serve_tcp, args=(tcp_reply,),
+                    daemon=True)]
+        for t in self._threads:
+            t.start()
+
+    def _serve_udp(self, reply):
+        request, addr = self.udp.recvfrom(65535)
+        for wire in reply(request):
+            self.udp.sendto(wire, addr)
+
+    def _serve_tcp(self, reply):
+        if reply is None:
+            return
+        conn, addr = self.tcp.accept()
+        with conn:
+            length = struct.unpack('!H', conn.recv(2))[0]
+            request = b''
+            while len(request) < length:
+                request += conn.recv(length - len(request))
+            self.tcp_queries += 1
+            wire = reply(request)
+            conn.sendall(struct.pack('!H', len(wire)) + wire)
+
+    def close(self):
+        self.udp.close()
+        self.tcp.close()
+
+def run_query(server, rrtype='A', timeout=2.0):
+    try:
+        return query.udp_query(name.fqdn_from_text('www.example.com.'),
+                '127.0.0.1', server.port, rrtype, timeout)
+    finally:
+        server.close()
+
+def test_udp_query_ignores_mismatched_responses():
+    def reply(request):
+        other_id = ((int.from_bytes(request[:2], 'big') + 1) % 65536)
+        other = other_id.to_bytes(2, 'big') + request[2:]
+        yield nsec3_response(other)
+        yield nsec3_response(make_request('xxx.example.com.',
+            msg_id=int.from_bytes(request[:2], 'big')))
+        yield nsec3_response(request)
+    res = run_query(FakeServer(reply))
+    assert isinstance(res, query.WireResult)
+    assert len(res.find_NSEC3()) == 1
+
+def test_udp_query_times_out_without_matching_response():
+    def reply(request):
+        yield nsec3_response(make_request('xxx.example.com.'))
+    with pytest.raises(dns.exception.Timeout):
+        run_query(FakeServer(reply), timeout=0.3)
+
+def test_truncated_response_retried_over_tcp():
+    def udp_reply(request):
+        yield make_response(request, tc=True)
+    server = FakeServer(udp_reply, nsec3_response)
+    res = run_query(server)
+    assert server.tcp_queries == 1
+    assert isinstance(res, query.DNSPythonResult)
+    assert summary(res) == summary(query.WireResult(
+        nsec3_response(make_request())))
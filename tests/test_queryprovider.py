@@ -0,0 +1,306 @@
+import ipaddress
+import socket
+import struct
+import threading
+
+import dns.flags
+import dns.message
+import dns.name
+import dns.rrset
+import pytest
+
+from n3map import name
+from n3map import queryprovider
+from n3map.exception import N3MapError
+from n3map.queryprovider import (
+        NameServer,
+        QueryProvider,
+        create_aggressive_qp,
+    )
+
+
+def test_rtt_stats_include_removed_servers():
+    fast = NameServer('192.0.2.1', 53, 'fast')
+    slow = NameServer('192.0.2.2', 53, 'slow')
+    fast.rtt_sample(0.01)
+    for rtt in (0.5, 0.6, 0.7):
+        slow.rtt_sample(rtt)
+    provider = QueryProvider([fast, slow], timeout=1.0, max_retries=1)
+    provider._remove_ns(slow)
+    provider.rtt_stats()
+    assert provider.stats['rtt_p50_ms'] == '600'
+    assert provider.stats['rtt_p99_ms'] == '700'
+
+def test_aggressive_provider_shares_removed_rtts():
+    fast = NameServer('192.0.2.1', 53, 'fast')
+    slow = NameServer('192.0.2.2', 53, 'slow')
+    fast.rtt_sample(0.01)
+    slow.rtt_sample(0.5)
+    provider = QueryProvider([fast, slow], timeout=1.0, max_retries=1)
+    aggressive = create_aggressive_qp(provider, 10)
+    try:
+        aggressive._remove_ns(slow)
+    finally:
+        aggressive.stop()
+    provider.rtt_stats()
+    assert provider.stats['rtt_p99_ms'] == '500'
+
+def test_unresponsive_server_loses_to_untried_and_answering_ones():
+    dead = NameServer('192.0.2.1', 53, 'dead')
+    untried = NameServer('192.0.2.2', 53, 'untried')
+    slow = NameServer('192.0.2.3', 53, 'slow')
+    slow.rtt_sample(0.5)
+    assert untried.expected_completion(1.0) == 0.0
+    dead.last_send = 1.0
+    assert dead.expected_completion(1.0) > slow.expected_completion(1.0)
+    # without a retry limit, timeouts still make it less likely to be picked
+    before = dead.expected_completion(1.0)
+    dead.add_timeouterror(-1)
+    assert dead.retries == 1
+    assert dead.expected_completion(1.0) > before
+
+def test_next_ns_avoids_unresponsive_server():
+    dead = NameServer('192.0.2.1', 53, 'dead')
+    alive = NameServer('192.0.2.2', 53, 'alive')
+    provider = QueryProvider([dead, alive], timeout=1.0, max_retries=-1)
+    dead.last_send = 1.0
+    provider.add_ns_timeout(dead)
+    alive.rtt_sample(0.05)
+    assert all(provider._next_ns() is alive for i in range(20))
+
+
+class FakeServer(object):
+    """A nameserver on the loopback interface. reply(request) returns the
+    responses to send to a query, which it may hold back to send them later
+    with flush()"""
+
+    def __init__(self, reply, tcp=False):
+        self.reply = reply
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.bind(('127.0.0.1', 0))
+        self.port = self.udp.getsockname()[1]
+        self.queries = []
+        self.tcp_queries = []
+        self._held = []
+        self._closed = False
+        threads = [threading.Thread(target=self._serve_udp, daemon=True)]
+        if tcp:
+            self.tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.tcp.bind(('127.0.0.1', self.port))
+            self.tcp.listen(8)
+            threads.append(threading.Thread(target=self._serve_tcp,
+                daemon=True))
+        for t in threads:
+            t.start()
+
+    def nameserver(self):
+        return NameServer(ipaddress.ip_address('127.0.0.1'), self.port,
+                'fake')
+
+    def _serve_udp(self):
+        while not self._closed:
+            try:
+                request, addr = self.udp.recvfrom(65535)
+            except OSError:
+                return
+            self.queries.append(request)
+            for wire in self.reply(request):
+                try:
+                    self.udp.sendto(wire, addr)
+                except OSError:
+                    return
+
+    def _serve_tcp(self):
+        while not self._closed:
+            try:
+                conn, addr = self.tcp.accept()
+            except OSError:
+                return
+            with conn:
+                length = struct.unpack('!H', conn.recv(2))[0]
+                request = b''
+                while len(request) < length:
+                    request += conn.recv(length - len(request))
+                self.tcp_queries.append(request)
+                wire = answer(request)
+                conn.sendall(struct.pack('!H', len(wire)) + wire)
+
+    def close(self):
+        self._closed = True
+        self.udp.close()
+        if hasattr(self, 'tcp'):
+            self.tcp.close()
+
+def qname(request):
+    return dns.message.from_wire(request).question[0].name
+
+def answer(request, tc=False):
+    """Returns a response with an NSEC record owned by the qname"""
+    msg = dns.message.make_response(dns.message.from_wire(request))
+    owner = qname(request)
+    msg.answer.append(dns.rrset.from_text(owner, 300, 'IN', 'NSEC',
+        'next.example.com. A'))
+    if tc:
+        msg.flags |= dns.flags.TC
+    return msg.to_wire()
+
+def collect(provider, count):
+    results = {}
+    while len(results) < count:
+        results.update(provider.collectresponses(block=True))
+    return results
+
+def aggressive_provider(server, timeout=1.0, max_retries=3, max_queries=64):
+    provider = QueryProvider([server.nameserver()], timeout=timeout,
+            max_retries=max_retries)
+    return create_aggressive_qp(provider, max_queries)
+
+def test_aggressive_matches_responses_to_queries():
+    held = []
+    lock = threading.Lock()
+    def reply(request):
+        # answer the queries of each initial window in reverse order
+        with lock:
+            held.append(request)
+            if len(held) < queryprovider.INITIAL_WINDOW:
+                return []
+            responses = [answer(r) for r in reversed(held)]
+            held.clear()
+            return responses
+    server = FakeServer(reply)
+    provider = aggressive_provider(server)
+    try:
+        qids = {}
+        for i in range(20):
+            dn = name.fqdn_from_text('q{:d}.example.com'.format(i))
+            qids[provider.query_ff(dn)] = dn
+        results = collect(provider, 20)
+    finally:
+        provider.stop()
+        server.close()
+    assert set(results) == set(qids)
+    for qid, (res, ns) in results.items():
+        assert str(res.find_NSEC(in_answer=True)[0].owner) == str(qids[qid])
+    assert provider.stats['queries'] == 20
+
+def test_aggressive_ignores_mismatched_responses():
+    def reply(request):
+        other = dns.message.from_wire(request)
+        other.question[0].name = dns.name.from_text('other.example.com.')
+        return [answer(other.to_wire()), answer(request)]
+    server = FakeServer(reply)
+    provider = aggressive_provider(server)
+    try:
+        res, ns = provider.query(name.fqdn_from_text('www.example.com'))
+    finally:
+        provider.stop()
+        server.close()
+    assert str(res.find_NSEC(in_answer=True)[0].owner) == 'www.example.com.'
+
+def test_aggressive_resends_lost_queries():
+    seen = set()
+    def reply(request):
+        # drop the first query for every name
+        if qname(request) not in seen:
+            seen.add(qname(request))
+            return []
+        return [answer(request)]
+    server = FakeServer(reply)
+    provider = aggressive_provider(server, timeout=0.1)
+    try:
+        for i in range(5):
+            provider.query_ff(name.fqdn_from_text(
+                'q{:d}.example.com'.format(i)))
+        results = collect(provider, 5)
+    finally:
+        provider.stop()
+        server.close()
+    assert len(results) == 5
+    assert len(server.queries) == 10
+    # the timeouts of queries sent together count once
+    assert provider.stats['timeouts_coalesced'] >= 1
+
+def test_aggressive_gives_up_on_unresponsive_server():
+    server = FakeServer(lambda request: [])
+    provider = aggressive_provider(server, timeout=0.05, max_retries=2)
+    try:
+        provider.query_ff(name.fqdn_from_text('www.example.com'))
+        with pytest.raises(N3MapError):
+            collect(provider, 1)
+    finally:
+        provider.stop()
+        server.close()
+
+def test_aggressive_truncated_response_retried_over_tcp():
+    server = FakeServer(lambda request: [answer(request, tc=True)], tcp=True)
+    provider = aggressive_provider(server)
+    try:
+        res, ns = provider.query(name.fqdn_from_text('www.example.com'))
+    finally:
+        provider.stop()
+        server.close()
+    assert len(server.tcp_queries) == 1
+    assert str(res.find_NSEC(in_answer=True)[0].owner) == 'www.example.com.'
+
+def window_server(max_window=64):
+    ns = NameServer(ipaddress.ip_address('192.0.2.1'), 53, 'ns')
+    ns.reset_window(max_window)
+    return ns
+
+def test_window_slow_start():
+    ns = window_server()
+    assert ns.window == queryprovider.INITIAL_WINDOW
+    for i in range(10):
+        ns.response(0.01)
+    assert ns.window == queryprovider.INITIAL_WINDOW + 10
+    for i in range(100):
+        ns.response(0.01)
+    assert ns.window == 64
+    assert window_server(2).window == 2
+
+def test_window_halved_once_per_window():
+    ns = window_server()
+    for i in range(12):
+        ns.response(0.01)
+    ns.congestion(sent=1.0, now=2.0)
+    assert ns.window == ns.ssthresh == 8
+    # queries sent before the decrease do not decrease it again
+    ns.congestion(sent=1.5, now=2.1)
+    assert ns.window == 8
+    ns.congestion(sent=2.0, now=3.0)
+    assert ns.window == 4
+    for i in range(10):
+        ns.congestion(sent=10.0 + i, now=10.5 + i)
+    assert ns.window == queryprovider.MIN_WINDOW
+
+def test_window_additive_increase():
+    ns = window_server()
+    for i in range(12):
+        ns.response(0.01)
+    ns.congestion(sent=1.0, now=2.0)
+    # a query per window of responses above the threshold
+    for i in range(8):
+        ns.response(0.01)
+    assert 8.9 < ns.window < 9.0
+    assert ns.window_open() == (ns.in_flight < 8)
+
+def test_window_open():
+    ns = window_server()
+    for i in range(queryprovider.INITIAL_WINDOW):
+        assert ns.window_open()
+        ns.sent_query(1.0)
+    assert not ns.window_open()
+    ns.in_flight -= 1
+    assert ns.window_open()
+
+def test_pacing_after_decrease():
+    ns = window_server()
+    ns.rtt_sample(0.1)
+    ns.sent_query(5.0)
+    # no pacing in slow start
+    assert ns.next_send_time() == 5.0
+    assert ns.next_send_time(0.5) == 5.5
+    ns.congestion(sent=5.0, now=6.0)
+    interval = 0.1/(queryprovider.PACING_GAIN*ns.window)
+    assert ns.next_send_time() == pytest.approx(5.0 + interval)
+    assert ns.next_send_time(1.0) == 6.0
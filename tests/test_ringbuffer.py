@@ -0,0 +1,71 @@
+import multiprocessing
+import multiprocessing.resource_tracker
+import struct
+
+import pytest
+
+from n3map import ringbuffer
+from n3map.ringbuffer import RingBuffer
+
+SLOTS = 200000
+_slot = struct.Struct('<Q20s')
+
+pytestmark = pytest.mark.skipif(not ringbuffer.SHARED_SUPPORTED,
+        reason="shared ring buffers are not supported on this platform")
+
+
+def digest(i):
+    return (i*0x9e3779b97f4a7c15 % (1 << 160)).to_bytes(20, 'big')
+
+def produce(name):
+    ring = RingBuffer(_slot.size, name=name)
+    i = 0
+    while i < SLOTS:
+        n = min(1000, SLOTS - i)
+        ring.wait_free(n)
+        for k in range(n):
+            _slot.pack_into(ring.buf, ring.offset(k), i + k, digest(i + k))
+        i += n
+        # both counters move together, a torn read shows up as a mismatch
+        ring.commit(n, (i, 3*i))
+    ring.close()
+
+def test_push_and_pop_across_processes():
+    multiprocessing.resource_tracker.ensure_running()
+    ring = RingBuffer(_slot.size, 4096)
+    producer = multiprocessing.Process(target=produce, args=(ring.name,))
+    producer.start()
+    try:
+        expected = 0
+        last_progress = 0
+        while expected < SLOTS:
+            tested, tripled = ring.progress()
+            assert tripled == 3*tested
+            assert tested >= last_progress
+            last_progress = tested
+            n = ring.available()
+            data = ring.read_slots(n)
+            ring.release(n)
+            for k in range(n):
+                counter, h = _slot.unpack_from(data, k*_slot.size)
+                assert counter == expected
+                assert h == digest(counter)
+                expected += 1
+        producer.join(10)
+        assert producer.exitcode == 0
+        assert ring.progress() == (SLOTS, 3*SLOTS)
+    finally:
+        if producer.is_alive():
+            producer.terminate()
+        ring.close()
+
+def test_unshared_ring():
+    ring = RingBuffer(_slot.size, 8, shared=False)
+    assert ring.free() == 8
+    _slot.pack_into(ring.buf, ring.offset(0), 7, digest(7))
+    ring.commit(1, (1, 2))
+    assert ring.available() == 1
+    assert _slot.unpack_from(ring.read_slots(1)) == (7, digest(7))
+    ring.release(1)
+    assert ring.progress() == (1, 2)
+    assert ring.free() == 8
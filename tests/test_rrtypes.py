@@ -0,0 +1,52 @@
+import hashlib
+
+from n3map import name
+from n3map.rrtypes import nsec3
+from n3map.rrtypes import rr
+
+ZONE = name.fqdn_from_text('example.com')
+
+
+def digest(i):
+    return hashlib.sha1(bytes([i])).digest()
+
+def record(i, ttl=300, salt=b'\xab', types=('A', 'RRSIG')):
+    return nsec3.NSEC3.from_hashes(digest(i), ZONE, ttl, 'IN', 1, 0, 10,
+            salt, digest(i + 1), list(types))
+
+def test_intern_types():
+    a = rr.intern_types(['A', 'NS'])
+    b = rr.intern_types(('A', 'NS'))
+    assert a == ['A', 'NS']
+    assert a is b
+    assert rr.intern_types(['NS', 'A']) is not a
+
+def test_records_share_types():
+    a = record(1)
+    b = nsec3.NSEC3(record(2).owner, 300, 'IN', 1, 0, 10, b'\xab',
+            digest(3), ['A', 'RRSIG'])
+    assert a.types is b.types
+
+def test_nsec3_list_round_trip():
+    records = [record(i) for i in range(5)] + [record(5, ttl=60),
+            record(6, salt=b''), record(7, types=['NS']), record(8)]
+    l = nsec3.NSEC3List(ZONE)
+    for r in records:
+        l.append(r)
+    assert len(l) == len(records)
+    assert [str(r) for r in l] == [str(r) for r in records]
+    assert str(l[6]) == str(records[6])
+    assert list(l.intervals()) == [(r.hashed_owner, r.next_hashed_owner)
+            for r in records]
+    # a record per distinct set of fields, the first one seen
+    assert [str(r) for r in l.prototypes()] == [str(records[i])
+            for i in (0, 5, 6, 7)]
+    assert l[0].types is l[8].types
+    assert l[3].owner == records[3].owner
+
+def test_empty_nsec3_list():
+    l = nsec3.NSEC3List(ZONE)
+    assert len(l) == 0
+    assert list(l) == []
+    assert list(l.intervals()) == []
+    assert l.prototypes() == []